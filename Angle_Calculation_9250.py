@@ -1,13 +1,30 @@
 import pigpio
 import time
 import numpy as np
-from KalmanAttitude import KalmanAttitude
+import struct
+import os
+import sys
+from KalmanAttitude import KalmanAttitude, AttitudeMEKF
+from QuaternionKernel import *
+#the calibration store is shared with the flight_control package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'flight_controller','GUI','flight_control'))
+from calibration import CalibrationStore, SensorCalibration, mag_affine
+#error state EKF with gyro bias estimation, called the same way
+#KalmanAttitude = AttitudeMEKF(gyro_bias=True)
 
 MPU6050_ADDR = 0x68
 AK8963_ADDR = 0x0C
 AK8963_CONFIG_ADDR = 0x0A
 CONFIG = 0x1A
 
+#rotation from the sensor to the body frame, used until the calibration store holds one
+Q_STATIC_DEFAULT = [0.57349583,-0.81795304,0.02150151,0.02462935]
+
+#offsets and mounting are kept in the calibration store of flight_control/calibration.py, keyed by
+#user and WHO_AM_I. Each script keeps its own record: they remove different accel offsets than
+#the flight_control IMU class and have their own Q_STATIC_DEFAULT
+CALIBRATION_USER = 'angle_calculation_9250'
+
 def setupMPU6050(pi):
     #opens connection at I2C bus 1
     mpu6050_handle = pi.i2c_open(1,MPU6050_ADDR,0)
@@ -22,9 +39,28 @@ def setupMPU6050(pi):
     #Acc_Config = pi.i2c_read_byte_data(mpu6050_handle,0x1C)
     #Acc_Config_4G = (Acc_Config | 1<<3) & (~1<<4)
 
-    #Calculate Offsets
-    acc_offsets = get_acc_offsets(pi,mpu6050_handle)
-    gyro_offsets = get_gyro_offsets(pi,mpu6050_handle)
+    #Load offsets from the calibration store, measure them only if missing or stale
+    who_am_i = pi.i2c_read_byte_data(mpu6050_handle,0x75)
+    count,data = pi.i2c_read_i2c_block_data(mpu6050_handle,0x41,2)
+    temperature = struct.unpack('>h',data)[0]/340+36.53
+    store = CalibrationStore()
+    calibration = store.load(who_am_i,CALIBRATION_USER)
+    if calibration is not None and calibration.is_fresh(temperature):
+        acc_offsets = calibration.acc_offsets
+        gyro_offsets = calibration.gyro_offsets
+    else:
+        acc_offsets = get_acc_offsets(pi,mpu6050_handle)
+        gyro_offsets = get_gyro_offsets(pi,mpu6050_handle)
+        if calibration is None:
+            calibration = SensorCalibration(who_am_i,CALIBRATION_USER,mounting_quaternion=Q_STATIC_DEFAULT)
+        calibration.temperature = temperature
+        calibration.acc_offsets = acc_offsets
+        calibration.gyro_offsets = gyro_offsets
+        calibration.timestamp = time.time()
+        try:
+            store.save(calibration)
+        except (IOError,OSError) as e:
+            print('Could not save calibration: %s' % e)
 
     #magnetometer
     bypass_byte = (pi.i2c_read_byte_data(mpu6050_handle,0x37))|(0b00000010)
@@ -35,7 +71,7 @@ def setupMPU6050(pi):
     pi.i2c_write_byte_data(ak8960_handle,AK8963_CONFIG_ADDR,0b00010110)
     time.sleep(0.1)
 
-    return mpu6050_handle,ak8960_handle,acc_offsets,gyro_offsets
+    return mpu6050_handle,ak8960_handle,acc_offsets,gyro_offsets,calibration
 
 def get_acc_offsets(pi,MPU6050_handle):
     sum_acc_x = 0
@@ -72,30 +108,6 @@ def get_acc_offsets(pi,MPU6050_handle):
 
 
 
-def get_acceleration_data(pi,MPU6050_handle):
-
-    AcX = (pi.i2c_read_byte_data(MPU6050_handle,0x3B) << 8) + pi.i2c_read_byte_data(MPU6050_handle,0x3C)
-    AcY = (pi.i2c_read_byte_data(MPU6050_handle,0x3D) << 8) + pi.i2c_read_byte_data(MPU6050_handle,0x3E)
-    AcZ = (pi.i2c_read_byte_data(MPU6050_handle,0x3F) << 8) + pi.i2c_read_byte_data(MPU6050_handle,0x40)
-    if AcX > 32768:
-        AcX = AcX-65536
-    if AcY > 32768:
-        AcY = AcY-65536
-    if AcZ > 32768:
-        AcZ = AcZ-65536
-
-    #Convert to G's
-    #AcX = AcX*4/65536
-    #AcY = AcY*4/65536
-    #AcZ = AcZ*4/65536
-
-    AcX = AcX*4/65536
-    AcY = AcY*4/65536
-    AcZ = AcZ*4/65536
-
-
-    return np.array([AcX,AcY,AcZ])
-
 def get_gyro_offsets(pi,MPU6050_handle):
     sum_gy_x = 0
     sum_gy_y = 0
@@ -129,40 +141,30 @@ def get_gyro_offsets(pi,MPU6050_handle):
 
     return np.array([GyX_mean,GyY_mean,GyZ_mean])
 
-def get_gyroscope_data(pi,MPU6050_handle):
+def get_magnetometer_data(pi,ak8960_handle):
+    #reads ST1, the six data bytes and ST2 in one transaction, ST2 must be read to release the data
+    count,data = pi.i2c_read_i2c_block_data(ak8960_handle,0x02,8)
+    st1,mx,my,mz,st2 = struct.unpack('<B3hB',data)
 
-    GyX = (pi.i2c_read_byte_data(MPU6050_handle,0x43) << 8) + pi.i2c_read_byte_data(MPU6050_handle,0x44)
-    GyY = (pi.i2c_read_byte_data(MPU6050_handle,0x45) << 8) + pi.i2c_read_byte_data(MPU6050_handle,0x46)
-    GyZ = (pi.i2c_read_byte_data(MPU6050_handle,0x47) << 8) + pi.i2c_read_byte_data(MPU6050_handle,0x48)
-    if GyX > 32768:
-        GyX = GyX-65536
-    if GyY > 32768:
-        GyY = GyY-65536
-    if GyZ > 32768:
-        GyZ = GyZ-65536
+    return np.array([mx,my,mz])
 
-    #Convert to deg/sec
-    GyX = GyX*500/65536
-    GyY = GyY*500/65536
-    GyZ = GyZ*500/65536
+#i2c_zip sequence reading 0x3B-0x48 from the MPU6050 and ST1-ST2 from the AK8963 in one daemon call
+MOTION_ZIP = [2, 4,MPU6050_ADDR,7,1,0x3B,6,14, 4,AK8963_ADDR,7,1,0x02,6,8, 3, 0]
 
+def get_motion_sample(pi,MPU6050_handle):
 
-    return np.pi*np.array([GyX,GyY,GyZ])/180
+    #accel, temperature, gyro and magnetometer from a single batched transaction
+    count,data = pi.i2c_zip(MPU6050_handle,MOTION_ZIP)
+    tick = pi.get_current_tick()
+    AcX,AcY,AcZ,temp,GyX,GyY,GyZ = struct.unpack_from('>7h',data)
+    st1,mx,my,mz,st2 = struct.unpack_from('<B3hB',data,14)
 
-def get_magnetometer_data(pi,ak8960_handle):
-    ctrl1 = pi.i2c_read_byte_data(ak8960_handle,0x02)
-    mx = (pi.i2c_read_byte_data(ak8960_handle,0x04) << 8) + pi.i2c_read_byte_data(ak8960_handle,0x03)
-    my = (pi.i2c_read_byte_data(ak8960_handle,0x06) << 8) + pi.i2c_read_byte_data(ak8960_handle,0x05)
-    mz = (pi.i2c_read_byte_data(ak8960_handle,0x08) << 8) + pi.i2c_read_byte_data(ak8960_handle,0x07)
-    ctrl2 = pi.i2c_read_byte_data(ak8960_handle,0x09)
-    if mx > 32768:
-        mx = mx-65536
-    if my > 32768:
-        my = my-65536
-    if mz > 32768:
-        mz = mz-65536
+    #Convert to G's, deg C and rad/sec
+    accel = np.array([AcX,AcY,AcZ])*4/65536
+    temperature = temp/340+36.53
+    gyro = np.pi*np.array([GyX,GyY,GyZ])*500/65536/180
 
-    return np.array([mx,my,mz])
+    return tick,accel,temperature,gyro,np.array([mx,my,mz])
 
 def calculate_angles(pi,accel_data_rad,gyro_data,sys_time,euler_state):
     #alpha
@@ -240,49 +242,32 @@ def calculate_angles(pi,accel_data_rad,gyro_data,sys_time,euler_state):
 #     P_out = P_k1
 #     return [q_out,P_out]
 
-def quat2euler(q):
-    roll = np.arctan2(2*(q[0,0]*q[0,1]+q[0,2]*q[0,3]),1-2*(q[0,1]**2+q[0,2]**2))
-    pitch = np.arcsin(2*(q[0,0]*q[0,2]-q[0,3]*q[0,1]))
-    yaw = np.arctan2(2*(q[0,0]*q[0,3]+q[0,1]*q[0,2]),1-2*(q[0,2]**2+q[0,3]**2))
-    return 180/np.pi*np.array([roll,pitch,yaw])
-
-def qtoDCM(q):
-    C = np.array([[q[0]**2+q[1]**2-q[2]**2-q[3]**2, 2*q[0]*q[3]+2*q[1]*q[2], -2*q[0]*q[2]+2*q[1]*q[3]],
-    [-2*q[0]*q[3]+2*q[1]*q[2], q[0]**2-q[1]**2+q[2]**2-q[3]**2, 2*q[0]*q[1]+2*q[2]*q[3]],
-    [2*q[0]*q[2]+2*q[1]*q[3], -2*q[0]*q[1]+2*q[2]*q[3], q[0]**2-q[1]**2-q[2]**2+q[3]**2]])
-    return C
-
-def quaternion_multiply(quaternion1, quaternion0):
-    w0, x0, y0, z0 = quaternion0
-    w1, x1, y1, z1 = quaternion1
-    return np.array([[-x1 * x0 - y1 * y0 - z1 * z0 + w1 * w0,
-                     x1 * w0 + y1 * z0 - z1 * y0 + w1 * x0,
-                     -x1 * z0 + y1 * w0 + z1 * x0 + w1 * y0,
-                     x1 * y0 - y1 * x0 + z1 * w0 + w1 * z0]])
-
-def quatmult(p,r):
-    q0 = p[0,0]*r[0,0]-p[0,1]*r[0,1]-p[0,2]*r[0,2]-p[0,3]*r[0,3]
-    q1 = p[0,0]*r[0,1]+p[0,1]*r[0,0]+p[0,2]*r[0,3]-p[0,3]*r[0,2]
-    q2 = p[0,0]*r[0,2]-p[0,1]*r[0,3]+p[0,2]*r[0,0]+p[0,3]*r[0,1]
-    q3 = p[0,0]*r[0,3]+p[0,1]*r[0,2]-p[0,2]*r[0,1]+p[0,3]*r[0,0]
-    return np.array([[q0,q1,q2,q3]])
+#magnetometer hard and soft iron correction fitted by flight_control/magcal.py and kept in the
+#calibration store under its user id, applied as one affine map per sample: mag = mag_A.dot(raw)-mag_b
+MAGCAL_USER = 'default'
 
-def quatinverse(q):
-    q_out = np.array([[q[0,0], -q[0,1],-q[0,2],-q[0,3]]])/np.linalg.norm(q);
-    return q_out
+def load_mag_correction(who_am_i,default_offset):
+    calibration = CalibrationStore().load(who_am_i,MAGCAL_USER)
+    #a record without a fit keeps the zero offset and identity matrix, use the hard iron offset only
+    if calibration is None or (not calibration.mag_offset.any()
+                               and (calibration.mag_matrix == np.identity(3)).all()):
+        return mag_affine(default_offset,np.identity(3))
+    return mag_affine(calibration.mag_offset,calibration.mag_matrix)
 
 
 
 #Setup
 pi = pigpio.pi()
-MPU6050_handle,ak8960_handle,acc_offsets,gyro_offsets = setupMPU6050(pi)
+MPU6050_handle,ak8960_handle,acc_offsets,gyro_offsets,calibration = setupMPU6050(pi)
 whoami = pi.i2c_read_byte_data(MPU6050_handle,0x75)
 q_old = np.array([[1,0,0,0]])
 P_old = np.diag(np.array([100,100,100,100]))
 sys_time = pi.get_current_tick()
-magcal = np.array([75.5,181.5,-122.5])
+mag_A,mag_b = load_mag_correction(calibration.who_am_i,np.array([75.5,181.5,-122.5]))
+#the offset is already removed by the affine correction
+magcal = np.zeros(3)
 cornerfreq = 50
-q_static = np.array([[ 0.57349583, -0.81795304,  0.02150151,  0.02462935]])
+q_static = np.array([calibration.mounting_quaternion])
 #q_static = np.array([[ 0.20118842, -0.35939725, -0.73926535,  0.53262364]])
 
 
@@ -296,8 +281,8 @@ while(True):
         dt=0
     sys_time = sys_time_new
 
-    accel_data_new = get_acceleration_data(pi,MPU6050_handle)
     #Get accelerometer and gyroscope data and compute angles
+    imu_tick,accel_data_new,imu_temp,gyro_data,mag_data = get_motion_sample(pi,MPU6050_handle)
     if first_iter == 1:
         accel_data = accel_data_new
         first_iter = 0
@@ -305,12 +290,11 @@ while(True):
         alpha = dt/(1/cornerfreq+dt)
         accel_data = (1-alpha)*accel_data_old+alpha*accel_data_new;
         
-    gyro_data = get_gyroscope_data(pi,MPU6050_handle)#-gyro_offsets
     #print(gyro_data)
-    mag_data = get_magnetometer_data(pi,ak8960_handle)
     #euler_state = calculate_angles(pi,accel_data,gyro_data,dt,euler_state)
     #[q_new,P_new] = KalmanAttitude(pi,accel_data,gyro_data,mag_data,dt,q_old,P_old)
     #print(q_new)
+    mag_data = mag_A.dot(mag_data)-mag_b
     [q_new,P_new] = KalmanAttitude(accel_data,gyro_data,mag_data,magcal,dt,q_old,P_old)
     #print(q_new)
     #print(quat2euler(q_new))
@@ -1,6 +1,7 @@
 import numpy as np
 import pigpio
 import math
+from Online_BNO055 import BNO055, PigpioI2C
 
 BNO055_ADDR = 0x28
 OPR_MODE = 0x3D
@@ -19,32 +20,23 @@ def setupBNO055(pi):
 
 	return bno055_handle
 
-def _read_vector(pi, bno055_handle,LSBaddress):
+def _read_vector(pi, bno055_handle,LSBaddress,count=1):
         # Read count number of 16-bit signed values starting from the provided
-        # address. Returns a tuple of the values that were read.
-        LSB = pi.i2c_read_byte_data(bno055_handle, LSBaddress)
-        MSB = pi.i2c_read_byte_data(bno055_handle, LSBaddress+1)
-        result = (pi.i2c_read_byte_data(bno055_handle,LSBaddress+1) << 8) | pi.i2c_read_byte_data(bno055_handle,LSBaddress)
-        if result > 32767:
-            result -= 65536
-        return result
+        # address in one block read. Returns a numpy array of the values that were read.
+        n, data = pi.i2c_read_i2c_block_data(bno055_handle, LSBaddress, count*2)
+        if n != count*2:
+            raise IOError('Short BNO055 block read')
+        return np.frombuffer(bytes(data), dtype='<i2')
 
 
 def get_euler(pi,bno055_handle):
-	roll = (pi.i2c_read_byte_data(bno055_handle,0x1D) << 8) | pi.i2c_read_byte_data(bno055_handle,0x1C)
-	if roll > 32767:
-		roll = roll- 65536
-
+	roll = _read_vector(pi,bno055_handle,0x1C)[0]
 
 	return roll/16
 
 def get_quaternion(pi,bno055_handle):
-	w = _read_vector(pi,bno055_handle,0x20)
-	x = _read_vector(pi,bno055_handle,0x22)
-	y = _read_vector(pi,bno055_handle,0x24)
-	z = _read_vector(pi,bno055_handle,0x26)
-	
-	return np.array([w,x,y,z])
+	#w, x, y, z in one transaction
+	return _read_vector(pi,bno055_handle,0x20,4)
 
 def quaternion_to_euler_angle(w, x, y, z):
 	
@@ -65,11 +57,14 @@ def quaternion_to_euler_angle(w, x, y, z):
 
 
 pi = pigpio.pi()
-bno055_handle = setupBNO055(pi)
+
+#same BNO055 class as over serial, with pigpio block reads
+bno = BNO055(i2c=PigpioI2C(pi))
+if not bno.begin():
+	raise RuntimeError('Failed to initialize BNO055')
 
 
 while(True):
-	roll = get_euler(pi,bno055_handle)
 	#q = get_quaternion(pi,bno055_handle)
 	#roll,pitch,yaw = quaternion_to_euler_angle(q[0],q[1],q[2],q[3])
 	heading, roll, pitch = bno.read_euler()
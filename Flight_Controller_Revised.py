@@ -3,7 +3,19 @@ import time
 import numpy as np
 import atexit
 import csv
-from KalmanAttitude import KalmanAttitude
+import os
+import sys
+import struct
+import threading
+import multiprocessing
+from KalmanAttitude import KalmanAttitude, AttitudeMEKF
+from QuaternionKernel import *
+#the calibration store and the sample ring are shared with the flight_control package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'flight_controller','GUI','flight_control'))
+from calibration import CalibrationStore, SensorCalibration, mag_affine
+from sample_ring import SampleRing, FLAG_READ_ERROR
+#error state EKF with gyro bias estimation, called the same way
+#KalmanAttitude = AttitudeMEKF(gyro_bias=True)
 
  #PIN DESIGNATIONS
 RECIEVER_CH1 = 17 #GPIO 11
@@ -15,6 +27,7 @@ MOTOR1 = 10 #GPIO 19
 MOTOR2 = 9 #GPIO 21
 MOTOR3 = 25 #GPIO 22
 MOTOR4 = 8 #GPIO 24
+IMU_INT = 24 #GPIO 18
 
 #MPU6050 REGISTERS
 MPU6050_ADDR = 0x68
@@ -22,6 +35,14 @@ AK8963_ADDR = 0x0C
 AK8963_CONFIG_ADDR = 0x0A
 CONFIG = 0x1A
 
+#rotation from the sensor to the body frame, used until the calibration store holds one
+Q_STATIC_DEFAULT = [0.5709,-0.8206,0.0157,0.0226]
+
+#offsets and mounting are kept in the calibration store of flight_control/calibration.py, keyed by
+#user and WHO_AM_I. Each script keeps its own record: they remove different accel offsets than
+#the flight_control IMU class and have their own Q_STATIC_DEFAULT
+CALIBRATION_USER = 'flight_controller_revised'
+
  #GLOBAL VARIABLES FOR PWM MEASUREMENT
 rising_1 = 0
 pulse_width_ch1 = 0
@@ -37,11 +58,33 @@ pulse_width_ch5= 0
 ARM = 0
 AUTOARM = 1
 
+ #GLOBAL VARIABLES FOR IMU DATA READY INTERRUPT
+imu_ready = threading.Event()
+imu_int_tick = 0
+
+ #SHARED MEMORY RING OF IMU SAMPLES
+ #a flight_control SampleRing written by the acquisition process, read by the flight loop without locks
+RING_SIZE = 256
+
+ #BUS STATISTICS KEPT BY THE ACQUISITION PROCESS IN THE RING COUNTERS
+ #latency histogram bin b counts reads that took [2^(b-1),2^b) microseconds
+BUS_READS = 0
+BUS_ERRORS = 1
+BUS_NACKS = 2
+BUS_RETRIES = 3
+BUS_STALE_MAG = 4
+BUS_TOTAL_US = 5
+BUS_MAX_US = 6
+BUS_HISTOGRAM = 7
+BUS_HISTOGRAM_BINS = 24
+BUS_COUNTERS = BUS_HISTOGRAM+BUS_HISTOGRAM_BINS
+
 def cbf1(gpio,level,tick):
 
     #connects global and local variables
     global rising_1
     global pulse_width_ch1
+    global AUTOARM
     
     #If rising edge, store time
     if level == 1:
@@ -63,6 +106,7 @@ def cbf2(gpio,level,tick):
     #connects global and local variables
     global rising_2
     global pulse_width_ch2
+    global AUTOARM
     
     #If rising edge, store time
     if level == 1:
@@ -84,6 +128,7 @@ def cbf3(gpio,level,tick):
     #connects global and local variables
     global rising_3
     global pulse_width_ch3
+    global AUTOARM
     
     #If rising edge, store time
     if level == 1:
@@ -105,6 +150,7 @@ def cbf4(gpio,level,tick):
     #connects global and local variables
     global rising_4
     global pulse_width_ch4
+    global AUTOARM
     
     #If rising edge, store time
     if level == 1:
@@ -146,6 +192,15 @@ def cbf5(gpio,level,tick):
             elif pulse_width_ch5< 1.4 or pulse_width_ch5>2:
                 ARM = 0
 
+def cbf_imu(gpio,level,tick):
+
+    #connects global and local variables
+    global imu_int_tick
+
+    #only record the tick here, the sample is read by the acquisition loop
+    imu_int_tick = tick
+    imu_ready.set()
+
 def setupMPU6050(pi):
     #opens connection at I2C bus 1
     mpu6050_handle = pi.i2c_open(1,MPU6050_ADDR,0)
@@ -160,9 +215,28 @@ def setupMPU6050(pi):
     #Acc_Config = pi.i2c_read_byte_data(mpu6050_handle,0x1C)
     #Acc_Config_4G = (Acc_Config | 1<<3) & (~1<<4)
 
-    #Calculate Offsets
-    acc_offsets = get_acc_offsets(pi,mpu6050_handle)
-    gyro_offsets = get_gyro_offsets(pi,mpu6050_handle)
+    #Load offsets from the calibration store, measure them only if missing or stale
+    who_am_i = pi.i2c_read_byte_data(mpu6050_handle,0x75)
+    count,data = pi.i2c_read_i2c_block_data(mpu6050_handle,0x41,2)
+    temperature = struct.unpack('>h',data)[0]/340+36.53
+    store = CalibrationStore()
+    calibration = store.load(who_am_i,CALIBRATION_USER)
+    if calibration is not None and calibration.is_fresh(temperature):
+        acc_offsets = calibration.acc_offsets
+        gyro_offsets = calibration.gyro_offsets
+    else:
+        acc_offsets = get_acc_offsets(pi,mpu6050_handle)
+        gyro_offsets = get_gyro_offsets(pi,mpu6050_handle)
+        if calibration is None:
+            calibration = SensorCalibration(who_am_i,CALIBRATION_USER,mounting_quaternion=Q_STATIC_DEFAULT)
+        calibration.temperature = temperature
+        calibration.acc_offsets = acc_offsets
+        calibration.gyro_offsets = gyro_offsets
+        calibration.timestamp = time.time()
+        try:
+            store.save(calibration)
+        except (IOError,OSError) as e:
+            print('Could not save calibration: %s' % e)
 
     #magnetometer
     bypass_byte = (pi.i2c_read_byte_data(mpu6050_handle,0x37))|(0b00000010)
@@ -173,7 +247,7 @@ def setupMPU6050(pi):
     pi.i2c_write_byte_data(ak8960_handle,AK8963_CONFIG_ADDR,0b00010110)
     time.sleep(0.1)
 
-    return mpu6050_handle,ak8960_handle,acc_offsets,gyro_offsets
+    return mpu6050_handle,ak8960_handle,acc_offsets,gyro_offsets,calibration
 
 def get_acc_offsets(pi,MPU6050_handle):
     sum_acc_x = 0
@@ -209,21 +283,16 @@ def get_acc_offsets(pi,MPU6050_handle):
     return np.array([AcX_mean-4/5,AcY_mean-3/5,AcZ_mean])
 
 def get_acceleration_data(pi,MPU6050_handle):
+    global AUTOARM
 
+    #reads 0x3B-0x40 in one transaction instead of six
     try:
-        AcX = (pi.i2c_read_byte_data(MPU6050_handle,0x3B) << 8) + pi.i2c_read_byte_data(MPU6050_handle,0x3C)
-        AcY = (pi.i2c_read_byte_data(MPU6050_handle,0x3D) << 8) + pi.i2c_read_byte_data(MPU6050_handle,0x3E)
-        AcZ = (pi.i2c_read_byte_data(MPU6050_handle,0x3F) << 8) + pi.i2c_read_byte_data(MPU6050_handle,0x40)
+        count,data = pi.i2c_read_i2c_block_data(MPU6050_handle,0x3B,6)
+        AcX,AcY,AcZ = struct.unpack('>3h',data)
     except:
         print('Lost IMU Connection')
         AUTOARM = 0
-
-    if AcX > 32768:
-        AcX = AcX-65536
-    if AcY > 32768:
-        AcY = AcY-65536
-    if AcZ > 32768:
-        AcZ = AcZ-65536
+        AcX,AcY,AcZ = 0,0,0
 
     #Convert to G's
     AcX = AcX*4/65536
@@ -267,19 +336,16 @@ def get_gyro_offsets(pi,MPU6050_handle):
     return np.array([GyX_mean,GyY_mean,GyZ_mean])
 
 def get_gyroscope_data(pi,MPU6050_handle):
+    global AUTOARM
+
+    #reads 0x43-0x48 in one transaction instead of six
     try:
-        GyX = (pi.i2c_read_byte_data(MPU6050_handle,0x43) << 8) + pi.i2c_read_byte_data(MPU6050_handle,0x44)
-        GyY = (pi.i2c_read_byte_data(MPU6050_handle,0x45) << 8) + pi.i2c_read_byte_data(MPU6050_handle,0x46)
-        GyZ = (pi.i2c_read_byte_data(MPU6050_handle,0x47) << 8) + pi.i2c_read_byte_data(MPU6050_handle,0x48)
+        count,data = pi.i2c_read_i2c_block_data(MPU6050_handle,0x43,6)
+        GyX,GyY,GyZ = struct.unpack('>3h',data)
     except:
-        AUTOARM == 0
-
-    if GyX > 32768:
-        GyX = GyX-65536
-    if GyY > 32768:
-        GyY = GyY-65536
-    if GyZ > 32768:
-        GyZ = GyZ-65536
+        print('Lost IMU Connection')
+        AUTOARM = 0
+        GyX,GyY,GyZ = 0,0,0
 
     #Convert to deg/sec
     GyX = GyX/65535*500
@@ -289,43 +355,138 @@ def get_gyroscope_data(pi,MPU6050_handle):
 
     return np.pi*np.array([GyX,GyY,GyZ])/180
 
+def get_imu_sample(pi,MPU6050_handle):
+    global AUTOARM
+
+    #reads accel, temperature and gyro (0x3B-0x48) in a single block transaction
+    try:
+        count,data = pi.i2c_read_i2c_block_data(MPU6050_handle,0x3B,14)
+        tick = pi.get_current_tick()
+        AcX,AcY,AcZ,temp,GyX,GyY,GyZ = struct.unpack('>7h',data)
+    except:
+        print('Lost IMU Connection')
+        AUTOARM = 0
+        return None
+
+    #Convert to G's, deg C and rad/sec
+    accel = np.array([AcX,AcY,AcZ])*4/65536
+    temperature = temp/340+36.53
+    gyro = np.pi*np.array([GyX,GyY,GyZ])/65535*500/180
+
+    return tick,accel,temperature,gyro
+
 def get_magnetometer_data(pi,ak8960_handle):
-    ctrl1 = pi.i2c_read_byte_data(ak8960_handle,0x02)
-    mx = (pi.i2c_read_byte_data(ak8960_handle,0x04) << 8) + pi.i2c_read_byte_data(ak8960_handle,0x03)
-    my = (pi.i2c_read_byte_data(ak8960_handle,0x06) << 8) + pi.i2c_read_byte_data(ak8960_handle,0x05)
-    mz = (pi.i2c_read_byte_data(ak8960_handle,0x08) << 8) + pi.i2c_read_byte_data(ak8960_handle,0x07)
-    ctrl2 = pi.i2c_read_byte_data(ak8960_handle,0x09)
-    if mx > 32768:
-        mx = mx-65536
-    if my > 32768:
-        my = my-65536
-    if mz > 32768:
-        mz = mz-65536
+    #reads ST1, the six data bytes and ST2 in one transaction, ST2 must be read to release the data
+    count,data = pi.i2c_read_i2c_block_data(ak8960_handle,0x02,8)
+    st1,mx,my,mz,st2 = struct.unpack('<B3hB',data)
 
     return np.array([mx,my,mz])
 
-def quat2euler(q):
-    roll = np.arctan2(2*(q[0,0]*q[0,1]+q[0,2]*q[0,3]),1-2*(q[0,1]**2+q[0,2]**2))
-    pitch = np.arcsin(2*(q[0,0]*q[0,2]-q[0,3]*q[0,1]))
-    yaw = np.arctan2(2*(q[0,0]*q[0,3]+q[0,1]*q[0,2]),1-2*(q[0,2]**2+q[0,3]**2))
-    return 180/np.pi*np.array([roll,pitch,yaw])
-
-def qtoDCM(q):
-    C = np.array([[q[0]**2+q[1]**2-q[2]**2-q[3]**2, 2*q[0]*q[3]+2*q[1]*q[2], -2*q[0]*q[2]+2*q[1]*q[3]],
-    [-2*q[0]*q[3]+2*q[1]*q[2], q[0]**2-q[1]**2+q[2]**2-q[3]**2, 2*q[0]*q[1]+2*q[2]*q[3]],
-    [2*q[0]*q[2]+2*q[1]*q[3], -2*q[0]*q[1]+2*q[2]*q[3], q[0]**2-q[1]**2-q[2]**2+q[3]**2]])
-    return C
-
-def quatmult(p,r):
-    q0 = p[0,0]*r[0,0]-p[0,1]*r[0,1]-p[0,2]*r[0,2]-p[0,3]*r[0,3]
-    q1 = p[0,0]*r[0,1]+p[0,1]*r[0,0]+p[0,2]*r[0,3]-p[0,3]*r[0,2]
-    q2 = p[0,0]*r[0,2]-p[0,1]*r[0,3]+p[0,2]*r[0,0]+p[0,3]*r[0,1]
-    q3 = p[0,0]*r[0,3]+p[0,1]*r[0,2]-p[0,2]*r[0,1]+p[0,3]*r[0,0]
-    return np.array([[q0,q1,q2,q3]])
+#i2c_zip sequence reading 0x3B-0x48 from the MPU6050 and ST1-ST2 from the AK8963 in one daemon call
+MOTION_ZIP = [2, 4,MPU6050_ADDR,7,1,0x3B,6,14, 4,AK8963_ADDR,7,1,0x02,6,8, 3, 0]
+
+def get_motion_sample(pi,MPU6050_handle,counters=None):
+    global AUTOARM
+
+    #accel, temperature, gyro and magnetometer from a single batched transaction
+    #with counters the read is timed, retried once and counted in the bus statistics
+    attempts = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            count,data = pi.i2c_zip(MPU6050_handle,MOTION_ZIP)
+            tick = pi.get_current_tick()
+            AcX,AcY,AcZ,temp,GyX,GyY,GyZ = struct.unpack_from('>7h',data)
+            st1,mx,my,mz,st2 = struct.unpack_from('<B3hB',data,14)
+            error = None
+        except Exception as e:
+            error = e
+        if counters is not None:
+            record_bus_read(counters,time.perf_counter()-start,error)
+        if error is None:
+            break
+        if counters is None or attempts >= 1:
+            print('Lost IMU Connection')
+            AUTOARM = 0
+            return None
+        attempts += 1
+        counters[BUS_RETRIES] += 1
+
+    #the AK8963 had no new measurement, its data registers still hold the last one
+    if counters is not None and not st1 & 0x01:
+        counters[BUS_STALE_MAG] += 1
+
+    #Convert to G's, deg C and rad/sec
+    accel = np.array([AcX,AcY,AcZ])*4/65536
+    temperature = temp/340+36.53
+    gyro = np.pi*np.array([GyX,GyY,GyZ])/65535*500/180
+
+    return tick,accel,temperature,gyro,np.array([mx,my,mz])
+
+def record_bus_read(counters,seconds,error):
+    #latency histogram, counts and NACKs (pigpio reports them as I2C read/write failed)
+    us = int(seconds*1e6)
+    counters[BUS_READS] += 1
+    counters[BUS_TOTAL_US] += us
+    counters[BUS_MAX_US] = max(counters[BUS_MAX_US],us)
+    counters[BUS_HISTOGRAM+min(us.bit_length(),BUS_HISTOGRAM_BINS-1)] += 1
+    if error is not None:
+        counters[BUS_ERRORS] += 1
+        if 'failed' in str(error).lower():
+            counters[BUS_NACKS] += 1
+
+def print_bus_stats(counters):
+    reads = int(counters[BUS_READS])
+    if reads == 0:
+        return
+    histogram = counters[BUS_HISTOGRAM:BUS_HISTOGRAM+BUS_HISTOGRAM_BINS]
+    p99 = 1 << int(np.searchsorted(np.cumsum(histogram),0.99*reads))
+    print('IMU bus: %d reads, mean %.1f us, p99 < %d us, max %d us, %d errors (%d NACK), %d retries, %d stale mag'
+          % (reads,counters[BUS_TOTAL_US]/reads,p99,counters[BUS_MAX_US],counters[BUS_ERRORS],counters[BUS_NACKS],
+             counters[BUS_RETRIES],counters[BUS_STALE_MAG]))
+
+#magnetometer hard and soft iron correction fitted by flight_control/magcal.py and kept in the
+#calibration store under its user id, applied as one affine map per sample: mag = mag_A.dot(raw)-mag_b
+MAGCAL_USER = 'default'
+
+def load_mag_correction(who_am_i,default_offset):
+    calibration = CalibrationStore().load(who_am_i,MAGCAL_USER)
+    #a record without a fit keeps the zero offset and identity matrix, use the hard iron offset only
+    if calibration is None or (not calibration.mag_offset.any()
+                               and (calibration.mag_matrix == np.identity(3)).all()):
+        return mag_affine(default_offset,np.identity(3))
+    return mag_affine(calibration.mag_offset,calibration.mag_matrix)
+
+def acquisition_loop(ring_name,stop):
+    #runs in its own process so a slow read never stalls the motors
+    ring = SampleRing.attach(ring_name)
+    pi = pigpio.pi()
+    MPU6050_handle = pi.i2c_open(1,MPU6050_ADDR,0)
+    cb_imu = pi.callback(IMU_INT, pigpio.RISING_EDGE,cbf_imu)
+
+    while not stop.is_set():
+        #read on the data ready interrupt, stamped with its tick
+        imu_sample = None
+        if imu_ready.wait(0.1):
+            imu_ready.clear()
+            tick = imu_int_tick
+            imu_sample = get_motion_sample(pi,MPU6050_handle,ring.counters)
+
+        if imu_sample is None:
+            ring.write(0,np.zeros(3),np.zeros(3),flags=FLAG_READ_ERROR)
+        else:
+            ring.write(tick,imu_sample[1],imu_sample[3],imu_sample[4],imu_sample[2])
 
-def quatinverse(q):
-    q_out = np.array([[q[0,0], -q[0,1],-q[0,2],-q[0,3]]])/np.linalg.norm(q);
-    return q_out
+    cb_imu.cancel()
+    pi.i2c_close(MPU6050_handle)
+    pi.stop()
+    ring.close()
+
+def stop_acquisition(stop,process,ring):
+    stop.set()
+    process.join(1.0)
+    ring.close()
+    ring.unlink()
 
 
 def map(num,a,b,c,d):
@@ -478,9 +639,23 @@ pi.set_PWM_frequency(MOTOR1,400)
 pi.set_PWM_frequency(MOTOR2,400)
 pi.set_PWM_frequency(MOTOR3,400)
 pi.set_PWM_frequency(MOTOR4,400)
+ #set IMU data ready interrupt pin
+pi.set_mode(IMU_INT,pigpio.INPUT)
 
 #setup IMU
-MPU6050_handle,ak8960_handle,acc_offsets,gyro_offsets = setupMPU6050(pi)
+MPU6050_handle,ak8960_handle,acc_offsets,gyro_offsets,calibration = setupMPU6050(pi)
+mag_A,mag_b = load_mag_correction(calibration.who_am_i,np.array([210,-70,-200]))
+
+#start the acquisition process, the flight loop reads its samples from shared memory
+#this script runs at import, so the child is forked: spawn or forkserver would re-import it and
+#run the whole flight script again in the child
+ring = SampleRing(RING_SIZE,counters=BUS_COUNTERS)
+fork = multiprocessing.get_context('fork')
+acquisition_stop = fork.Event()
+acquisition = fork.Process(target=acquisition_loop,args=(ring.name,acquisition_stop))
+acquisition.daemon = True
+acquisition.start()
+atexit.register(stop_acquisition,acquisition_stop,acquisition,ring)
 
 #Machine Loop
 while(True):
@@ -512,14 +687,16 @@ while(True):
     P_old = np.diag(np.array([100,100,100,100]))
     sys_time = pi.get_current_tick()
     #magcal = np.array([75.5,181.5,-122.5])
-    magcal = np.array([210,-70,-200])
+    #the offset is already removed by the affine correction
+    magcal = np.zeros(3)
     sys_time = pi.get_current_tick()
     K = 0.5*np.array([[13.4164,0,0,1.0425,0,0],[0,13.4164,0,0,1.0425,0],[0,0,13.4164,0,0,1.3803]])
     km = 5.73
     l = 0.123
     pw0 =1.16
     #q_static = np.array([[ 0.57349583, -0.81795304,  0.02150151,  0.02462935]])
-    q_static = np.array([[0.5709,-0.8206,0.0157,0.0226]])
+    q_static = np.array([calibration.mounting_quaternion])
+    q_static_inv = qinverse(as_tuple(q_static))
     #q_static = np.array([[ 0.57349583, 0.81795304,  -0.02150151,  -0.02462935]])
     first_iter = 1
     cornerfreq = 30
@@ -527,12 +704,26 @@ while(True):
     #start data collection
     file = open('data.csv','w+')
 
+    #only samples written after arming are used
+    ring_seq = ring.write_count()
+
     
     #flight loop
     #while(True):
     while(ARM == 1 and AUTOARM == 1):
-        #Get Delta Time
-        sys_time_new = pi.get_current_tick()
+        #Wait for the acquisition process to publish a new sample
+        imu_sample,ring_seq = ring.wait_latest(ring_seq,0.1)
+        if imu_sample is None:
+            print('Lost IMU Interrupt')
+            AUTOARM = 0
+            break
+        if imu_sample['flags'] & FLAG_READ_ERROR:
+            print('Lost IMU Connection')
+            AUTOARM = 0
+            break
+
+        #Get Delta Time from the interrupt ticks
+        sys_time_new = int(imu_sample['tick'])
         dt = (sys_time_new-sys_time)/1e6
         #correct for rollover
         if dt<0:
@@ -546,7 +737,10 @@ while(True):
         control_angles = map_control_input()
 
         #Get accelerometer and gyroscope data and compute angles
-        accel_data_new = get_acceleration_data(pi,MPU6050_handle)
+        accel_data_new = imu_sample['accel']
+        imu_temp = imu_sample['temperature']
+        gyro_data = imu_sample['gyro']
+        mag_data = imu_sample['mag']
         if first_iter == 1:
             accel_data = accel_data_new
             first_iter = 0
@@ -554,8 +748,7 @@ while(True):
             alpha = dt/(1/(2*np.pi*cornerfreq)+dt)
             accel_data = (1-alpha)*accel_data_old+alpha*accel_data_new;
 
-        gyro_data = get_gyroscope_data(pi,MPU6050_handle)#-gyro_offsets
-        mag_data = get_magnetometer_data(pi,ak8960_handle)
+        mag_data = mag_A.dot(mag_data)-mag_b
         [q_new,P_new] = KalmanAttitude(accel_data,gyro_data,mag_data,magcal,dt,q_old,P_old)
         #print(quat2euler(q_new))
         #print(accel_data)
@@ -563,13 +756,14 @@ while(True):
         q_old = q_new
         P_old = P_new
 
-        q_adj = quatmult(q_new,quatinverse(q_static))
+        #tuple quaternions from here on, see QuaternionKernel.py
+        q_adj = qmult(as_tuple(q_new),q_static_inv)
 
         #write q_adj to file
-        file.write(str(sys_time)+','+str(q_adj[0,0])+','+str(q_adj[0,1])+','+str(q_adj[0,2])+','+str(q_adj[0,3])+'\n')
+        file.write(str(sys_time)+','+str(q_adj[0])+','+str(q_adj[1])+','+str(q_adj[2])+','+str(q_adj[3])+'\n')
 
         #print(q_adj)
-        print(quat2euler(q_adj))
+        print(qeuler(q_adj))
 
         #LQR Controller
         q_ref_in = control_into_qref(control_angles)
@@ -577,8 +771,8 @@ while(True):
         q_ref = np.array([[1,0,0,0]])
         #q_ref = np.array([[0.9997,0,-0.0262,0]])
         #Compute quaternon error
-        q_err = quatmult(q_ref_in, quatinverse(q_adj))
-        x_err = np.transpose(np.array([[q_err[0,1],q_err[0,2],q_err[0,3],-gyro_data[1],gyro_data[0],gyro_data[2]]])) 
+        q_err = qerror(as_tuple(q_ref_in),q_adj)
+        x_err = np.transpose(np.array([[q_err[1],q_err[2],q_err[3],-gyro_data[1],gyro_data[0],gyro_data[2]]])) 
         tau_in = -np.dot(K,x_err)
         #print(tau_in)
         thrust_desired = control_angles[3]
@@ -595,6 +789,7 @@ while(True):
         # set_motor_pulse(pi,MOTOR4,1.0)
 
     file.close()
+    print_bus_stats(ring.counters)
 
 
 
@@ -0,0 +1,584 @@
+import math
+import numpy as np
+
+#Quaternion Kalman filter for the MPU9250: gyro propagation, corrected by the quaternion
+#measured from the accelerometer (tilt) and the magnetometer (heading).
+#Same maths as the numpy version that used to live in Angle_Calculation_9250.py, unrolled
+#into scalars so a step allocates nothing but its outputs:
+#  - R is diagonal, so with S = P_proj+R the gain is K = I-R*inv(S), which gives
+#      q_new = z-R*inv(S)*(z-q_proj)    P_new = R-R*inv(S)*R
+#    and the only matrix work left is inverting the symmetric 4x4 S (Cholesky)
+#  - q_acc and q_mag come from closed forms, q_mag only has w and z components
+#  - P_proj is symmetric, only its upper triangle is computed
+
+#gyro noise variance, (rad/s)^2
+GYRO_COV = (0.0008,0.0013,0.0014)
+#measured quaternion noise variance
+MEAS_COV = (0.0012,0.0132,0.0525,0.4489)
+
+SQRT2 = math.sqrt(2)
+
+#one filter step
+#accel, gyro (rad/s), mag and magcal are 3 element arrays, q_old is 1x4, P_old 4x4
+#returns [q_new (1x4), P_new (4x4)], written into q_out and P_out if they are given
+def KalmanAttitude(accel,gyro,mag,magcal,dt,q_old,P_old,q_out=None,P_out=None):
+    ax,ay,az = accel.tolist()
+    gx,gy,gz = gyro.tolist()
+    mx,my,mz = mag.tolist()
+    cx,cy,cz = magcal.tolist()
+    mx,my,mz = mx-cx,my-cy,mz-cz
+    q0,q1,q2,q3 = q_old.ravel().tolist()
+    (p00,p01,p02,p03,
+     p10,p11,p12,p13,
+     p20,p21,p22,p23,
+     p30,p31,p32,p33) = P_old.ravel().tolist()
+    r0,r1,r2,r3 = MEAS_COV
+
+    #tilt quaternion from the normalised accelerometer
+    n = math.sqrt(ax*ax+ay*ay+az*az)
+    if n > 0:
+        ax /= n
+        ay /= n
+        az /= n
+    else:
+        ax,ay,az = 0.0,0.0,1.0
+    if az >= 0:
+        s = math.sqrt(2*(az+1))
+        a0,a1,a2,a3 = 0.5*s,-ay/s,ax/s,0.0
+    else:
+        s = math.sqrt(2*(1-az))
+        a0,a1,a2,a3 = -ay/s,0.5*s,0.0,ax/s
+
+    #magnetometer in the level frame, x and y swapped onto the accelerometer axes
+    n = math.sqrt(mx*mx+my*my+mz*mz)
+    if n > 0:
+        mx,my,mz = my/n,mx/n,mz/n
+    #first two rows of transpose(qtoDCM(q_acc)) times m
+    l0 = (a0*a0+a1*a1-a2*a2-a3*a3)*mx+2*(a1*a2-a0*a3)*my+2*(a0*a2+a1*a3)*mz
+    l1 = 2*(a0*a3+a1*a2)*mx+(a0*a0-a1*a1+a2*a2-a3*a3)*my+2*(a2*a3-a0*a1)*mz
+
+    #heading quaternion, rotation about z only
+    gam = l0*l0+l1*l1
+    if gam > 0:
+        sg = math.sqrt(gam)
+        if l0 >= 0:
+            t = math.sqrt(gam+l0*sg)
+            m0,m3 = t/math.sqrt(2*gam),l1/(SQRT2*t)
+        else:
+            t = math.sqrt(gam-l0*sg)
+            m0,m3 = l1/(SQRT2*t),t/math.sqrt(2*gam)
+    else:
+        m0,m3 = 1.0,0.0
+
+    #measured quaternion q_acc*q_mag
+    z0 = a0*m0-a3*m3
+    z1 = a1*m0+a2*m3
+    z2 = a2*m0-a1*m3
+    z3 = a3*m0+a0*m3
+
+    #F = I+dt/4*Omega(gyro)
+    c = dt/4
+    wx,wy,wz = c*gx,c*gy,c*gz
+
+    #predicted quaternion F*q
+    x0 = q0+wx*q1+wy*q2+wz*q3
+    x1 = -wx*q0+q1-wz*q2+wy*q3
+    x2 = -wy*q0+wz*q1+q2-wx*q3
+    x3 = -wz*q0-wy*q1+wx*q2+q3
+
+    #A = F*P
+    b00 = p00+wx*p10+wy*p20+wz*p30
+    b01 = p01+wx*p11+wy*p21+wz*p31
+    b02 = p02+wx*p12+wy*p22+wz*p32
+    b03 = p03+wx*p13+wy*p23+wz*p33
+    b10 = -wx*p00+p10-wz*p20+wy*p30
+    b11 = -wx*p01+p11-wz*p21+wy*p31
+    b12 = -wx*p02+p12-wz*p22+wy*p32
+    b13 = -wx*p03+p13-wz*p23+wy*p33
+    b20 = -wy*p00+wz*p10+p20-wx*p30
+    b21 = -wy*p01+wz*p11+p21-wx*p31
+    b22 = -wy*p02+wz*p12+p22-wx*p32
+    b23 = -wy*p03+wz*p13+p23-wx*p33
+    b30 = -wz*p00-wy*p10+wx*p20+p30
+    b31 = -wz*p01-wy*p11+wx*p21+p31
+    b32 = -wz*p02-wy*p12+wx*p22+p32
+    b33 = -wz*p03-wy*p13+wx*p23+p33
+
+    #process noise Q = dt^2/4*G*diag(GYRO_COV)*G', G from the previous quaternion
+    k = dt*dt/4
+    c0,c1,c2 = k*GYRO_COV[0],k*GYRO_COV[1],k*GYRO_COV[2]
+    g00,g01,g02 = q1,q2,q3
+    g10,g11,g12 = -q0,q3,-q2
+    g20,g21,g22 = -q3,-q0,q1
+    g30,g31,g32 = q2,-q1,-q0
+
+    #S = A*F'+Q+R, upper triangle
+    s00 = b00+wx*b01+wy*b02+wz*b03+c0*g00*g00+c1*g01*g01+c2*g02*g02+r0
+    s01 = -wx*b00+b01-wz*b02+wy*b03+c0*g00*g10+c1*g01*g11+c2*g02*g12
+    s02 = -wy*b00+wz*b01+b02-wx*b03+c0*g00*g20+c1*g01*g21+c2*g02*g22
+    s03 = -wz*b00-wy*b01+wx*b02+b03+c0*g00*g30+c1*g01*g31+c2*g02*g32
+    s11 = -wx*b10+b11-wz*b12+wy*b13+c0*g10*g10+c1*g11*g11+c2*g12*g12+r1
+    s12 = -wy*b10+wz*b11+b12-wx*b13+c0*g10*g20+c1*g11*g21+c2*g12*g22
+    s13 = -wz*b10-wy*b11+wx*b12+b13+c0*g10*g30+c1*g11*g31+c2*g12*g32
+    s22 = -wy*b20+wz*b21+b22-wx*b23+c0*g20*g20+c1*g21*g21+c2*g22*g22+r2
+    s23 = -wz*b20-wy*b21+wx*b22+b23+c0*g20*g30+c1*g21*g31+c2*g22*g32
+    s33 = -wz*b30-wy*b31+wx*b32+b33+c0*g30*g30+c1*g31*g31+c2*g32*g32+r3
+
+    #Cholesky S = L*L', kept as the reciprocal diagonal
+    d0 = 1/math.sqrt(s00)
+    l10 = s01*d0
+    l20 = s02*d0
+    l30 = s03*d0
+    d1 = 1/math.sqrt(s11-l10*l10)
+    l21 = (s12-l20*l10)*d1
+    l31 = (s13-l30*l10)*d1
+    d2 = 1/math.sqrt(s22-l20*l20-l21*l21)
+    l32 = (s23-l30*l20-l31*l21)*d2
+    d3 = 1/math.sqrt(s33-l30*l30-l31*l31-l32*l32)
+
+    #M = inv(L), lower triangular
+    m10 = -l10*d0*d1
+    m21 = -l21*d1*d2
+    m20 = -(l20*d0+l21*m10)*d2
+    m32 = -l32*d2*d3
+    m31 = -(l31*d1+l32*m21)*d3
+    m30 = -(l30*d0+l31*m10+l32*m20)*d3
+
+    #inv(S) = M'*M
+    i00 = d0*d0+m10*m10+m20*m20+m30*m30
+    i01 = m10*d1+m20*m21+m30*m31
+    i02 = m20*d2+m30*m32
+    i03 = m30*d3
+    i11 = d1*d1+m21*m21+m31*m31
+    i12 = m21*d2+m31*m32
+    i13 = m31*d3
+    i22 = d2*d2+m32*m32
+    i23 = m32*d3
+    i33 = d3*d3
+
+    #q_new = z-R*inv(S)*(z-F*q)
+    e0,e1,e2,e3 = z0-x0,z1-x1,z2-x2,z3-x3
+    q_new = (z0-r0*(i00*e0+i01*e1+i02*e2+i03*e3),
+             z1-r1*(i01*e0+i11*e1+i12*e2+i13*e3),
+             z2-r2*(i02*e0+i12*e1+i22*e2+i23*e3),
+             z3-r3*(i03*e0+i13*e1+i23*e2+i33*e3))
+
+    #P_new = R-R*inv(S)*R
+    n01 = -r0*r1*i01
+    n02 = -r0*r2*i02
+    n03 = -r0*r3*i03
+    n12 = -r1*r2*i12
+    n13 = -r1*r3*i13
+    n23 = -r2*r3*i23
+    P_new = (r0-r0*r0*i00,n01,n02,n03,
+             n01,r1-r1*r1*i11,n12,n13,
+             n02,n12,r2-r2*r2*i22,n23,
+             n03,n13,n23,r3-r3*r3*i33)
+
+    if q_out is None:
+        q_out = np.array([q_new])
+    else:
+        q_out.flat[:] = q_new
+    if P_out is None:
+        P_out = np.array(P_new).reshape(4,4)
+    else:
+        P_out.flat[:] = P_new
+    return [q_out,P_out]
+
+
+
+#Multiplicative (error state) EKF, a drop in replacement for KalmanAttitude:
+#    KalmanAttitude = AttitudeMEKF(gyro_bias=True)
+#The quaternion is propagated exactly with the gyro and the filter only tracks the small
+#attitude error in the body frame (3 states, plus 3 gyro bias states with gyro_bias), so the
+#covariance is 3x3 or 6x6 instead of the 4x4 of a constrained quaternion and the quaternion
+#stays unit length without renormalisation. The accelerometer (gravity direction) and the
+#magnetometer (heading only, so it cannot pull on roll and pitch) are applied as sequential
+#scalar updates, so no matrix is ever inverted.
+#q_old/q_new use the same convention as KalmanAttitude, P_old/P_new are the error covariance.
+#A P_old of any other shape (e.g. the np.diag([100,100,100,100]) used for KalmanAttitude)
+#starts the filter from the attitude measured by the accelerometer and magnetometer.
+
+#accelerometer direction noise variance and the |accel| (G's) within which it is trusted
+ACCEL_COV = 0.005
+ACCEL_GATE = 0.2
+#magnetometer heading noise variance, rad^2
+HEADING_COV = 0.01
+#gyro bias random walk, (rad/s)^2 per second
+BIAS_COV = 1e-7
+#covariance the filter starts from
+INITIAL_ANGLE_COV = 0.01
+INITIAL_BIAS_COV = 1e-4
+
+class AttitudeMEKF(object):
+    def __init__(self,gyro_bias=False):
+        self.n = 6 if gyro_bias else 3
+        self.gyro_bias = gyro_bias
+        #estimated gyro bias, rad/s
+        self.bias = (0.0,0.0,0.0)
+        #unique entries of the symmetric error covariance, see unpack(), and the array it is
+        #returned in
+        self.P = None
+        self.P_array = np.zeros((self.n,self.n))
+        self.P_flat = self.P_array.reshape(-1)
+        if gyro_bias:
+            self.propagate,self.update = self.propagate6,self.update6
+        else:
+            self.propagate,self.update = self.propagate3,self.update3
+
+    #P_new is the filter's own array unless P_out is given, it is overwritten by the next call
+    def __call__(self,accel,gyro,mag,magcal,dt,q_old,P_old,q_out=None,P_out=None):
+        n = self.n
+        ax,ay,az = accel.tolist()
+        gx,gy,gz = gyro.tolist()
+        #magnetometer x and y swapped onto the accelerometer axes, as in KalmanAttitude
+        mx,my,mz = mag.tolist()
+        cx,cy,cz = magcal.tolist()
+        my,mx,mz = mx-cx,my-cy,mz-cz
+
+        if P_old.shape != (n,n):
+            pw,px,py,pz = self.measured_attitude(ax,ay,az,mx,my,mz)
+            P = np.diag([INITIAL_ANGLE_COV]*3+[INITIAL_BIAS_COV]*(n-3))
+            P = self.pack(P)
+            self.bias = (0.0,0.0,0.0)
+        else:
+            #the filter works with the body to world quaternion, the conjugate of q
+            qw,qx,qy,qz = q_old.ravel().tolist()
+            pw,px,py,pz = qw,-qx,-qy,-qz
+            P = self.P if P_old is self.P_array and self.P is not None else self.pack(P_old)
+
+        #propagate the quaternion through the rotation the gyro measured
+        bx,by,bz = self.bias
+        rx,ry,rz = (gx-bx)*dt,(gy-by)*dt,(gz-bz)*dt
+        angle = math.sqrt(rx*rx+ry*ry+rz*rz)
+        if angle > 1e-12:
+            dw = math.cos(0.5*angle)
+            k = math.sin(0.5*angle)/angle
+        else:
+            dw,k = 1.0,0.5
+        dx,dy,dz = k*rx,k*ry,k*rz
+        pw,px,py,pz = (pw*dw-px*dx-py*dy-pz*dz,
+                       pw*dx+px*dw+py*dz-pz*dy,
+                       pw*dy-px*dz+py*dw+pz*dx,
+                       pw*dz+px*dy-py*dx+pz*dw)
+
+        #the attitude error rotates back through the same rotation, transpose(R(dq))
+        A = (1-2*(dy*dy+dz*dz),2*(dx*dy+dw*dz),2*(dx*dz-dw*dy),
+             2*(dx*dy-dw*dz),1-2*(dx*dx+dz*dz),2*(dy*dz+dw*dx),
+             2*(dx*dz+dw*dy),2*(dy*dz-dw*dx),1-2*(dx*dx+dy*dy))
+        P = self.propagate(P,A,dt)
+
+        #body to world rotation matrix
+        c00,c01,c02 = 1-2*(py*py+pz*pz),2*(px*py-pw*pz),2*(px*pz+pw*py)
+        c10,c11,c12 = 2*(px*py+pw*pz),1-2*(px*px+pz*pz),2*(py*pz-pw*px)
+        c20,c21,c22 = 2*(px*pz-pw*py),2*(py*pz+pw*px),1-2*(px*px+py*py)
+
+        err = (0.0,)*n
+        #gravity: the accelerometer should measure world up in the body frame, the last row
+        #of the rotation matrix; a small error e moves it by up x e
+        norm = math.sqrt(ax*ax+ay*ay+az*az)
+        if abs(norm-1) < ACCEL_GATE:
+            ax,ay,az = ax/norm,ay/norm,az/norm
+            P,err = self.update(P,err,0.0,-c22,c21,ax-c20,ACCEL_COV)
+            P,err = self.update(P,err,c22,0.0,-c20,ay-c21,ACCEL_COV)
+            P,err = self.update(P,err,-c21,c20,0.0,az-c22,ACCEL_COV)
+
+        #heading: the level magnetometer should point along world x
+        wx = c00*mx+c01*my+c02*mz
+        wy = c10*mx+c11*my+c12*mz
+        if wx*wx+wy*wy > 1e-12:
+            P,err = self.update(P,err,-c20,-c21,-c22,math.atan2(wy,wx),HEADING_COV)
+
+        #fold the error into the quaternion and the bias
+        ex,ey,ez = 0.5*err[0],0.5*err[1],0.5*err[2]
+        pw,px,py,pz = (pw-px*ex-py*ey-pz*ez,
+                       pw*ex+px+py*ez-pz*ey,
+                       pw*ey-px*ez+py+pz*ex,
+                       pw*ez+px*ey-py*ex+pz)
+        norm = 1/math.sqrt(pw*pw+px*px+py*py+pz*pz)
+        q_new = (pw*norm,-px*norm,-py*norm,-pz*norm)
+        if self.gyro_bias:
+            self.bias = (bx+err[3],by+err[4],bz+err[5])
+
+        self.P = P
+        if q_out is None:
+            q_out = np.array([q_new])
+        else:
+            q_out.flat[:] = q_new
+        if P_out is None:
+            P_out = self.P_array
+            self.P_flat[:] = self.unpack(P)
+        else:
+            P_out.flat[:] = self.unpack(P)
+        return [q_out,P_out]
+
+    #covariance array to its unique entries: the upper triangle of the attitude block, then
+    #for the bias states the attitude-bias block row by row and the upper triangle of the bias block
+    def pack(self,P):
+        P = P.tolist()
+        packed = (P[0][0],P[0][1],P[0][2],P[1][1],P[1][2],P[2][2])
+        if self.n == 6:
+            packed += tuple(P[0][3:6]+P[1][3:6]+P[2][3:6])
+            packed += (P[3][3],P[3][4],P[3][5],P[4][4],P[4][5],P[5][5])
+        return packed
+
+    #unique entries back to the full matrix, row major
+    def unpack(self,P):
+        if self.n == 3:
+            t00,t01,t02,t11,t12,t22 = P
+            return (t00,t01,t02,t01,t11,t12,t02,t12,t22)
+        (t00,t01,t02,t11,t12,t22,
+         c00,c01,c02,c10,c11,c12,c20,c21,c22,
+         b00,b01,b02,b11,b12,b22) = P
+        return (t00,t01,t02,c00,c01,c02,
+                t01,t11,t12,c10,c11,c12,
+                t02,t12,t22,c20,c21,c22,
+                c00,c10,c20,b00,b01,b02,
+                c01,c11,c21,b01,b11,b12,
+                c02,c12,c22,b02,b12,b22)
+
+    #P = A*P*A'+Q
+    def propagate3(self,P,A,dt):
+        t00,t01,t02,t11,t12,t22 = P
+        a00,a01,a02,a10,a11,a12,a20,a21,a22 = A
+        #X = A*P
+        x00,x01,x02 = a00*t00+a01*t01+a02*t02,a00*t01+a01*t11+a02*t12,a00*t02+a01*t12+a02*t22
+        x10,x11,x12 = a10*t00+a11*t01+a12*t02,a10*t01+a11*t11+a12*t12,a10*t02+a11*t12+a12*t22
+        x20,x21,x22 = a20*t00+a21*t01+a22*t02,a20*t01+a21*t11+a22*t12,a20*t02+a21*t12+a22*t22
+        d = dt*dt
+        return (x00*a00+x01*a01+x02*a02+GYRO_COV[0]*d,
+                x00*a10+x01*a11+x02*a12,
+                x00*a20+x01*a21+x02*a22,
+                x10*a10+x11*a11+x12*a12+GYRO_COV[1]*d,
+                x10*a20+x11*a21+x12*a22,
+                x20*a20+x21*a21+x22*a22+GYRO_COV[2]*d)
+
+    #P = Phi*P*Phi'+Q with Phi = [[A,-dt*I],[0,I]]
+    def propagate6(self,P,A,dt):
+        (t00,t01,t02,t11,t12,t22,
+         c00,c01,c02,c10,c11,c12,c20,c21,c22,
+         b00,b01,b02,b11,b12,b22) = P
+        a00,a01,a02,a10,a11,a12,a20,a21,a22 = A
+        #X = A*Ptt-dt*Pbt
+        x00 = a00*t00+a01*t01+a02*t02-dt*c00
+        x01 = a00*t01+a01*t11+a02*t12-dt*c10
+        x02 = a00*t02+a01*t12+a02*t22-dt*c20
+        x10 = a10*t00+a11*t01+a12*t02-dt*c01
+        x11 = a10*t01+a11*t11+a12*t12-dt*c11
+        x12 = a10*t02+a11*t12+a12*t22-dt*c21
+        x20 = a20*t00+a21*t01+a22*t02-dt*c02
+        x21 = a20*t01+a21*t11+a22*t12-dt*c12
+        x22 = a20*t02+a21*t12+a22*t22-dt*c22
+        #Y = A*Ptb-dt*Pbb, the new attitude-bias block
+        y00 = a00*c00+a01*c10+a02*c20-dt*b00
+        y01 = a00*c01+a01*c11+a02*c21-dt*b01
+        y02 = a00*c02+a01*c12+a02*c22-dt*b02
+        y10 = a10*c00+a11*c10+a12*c20-dt*b01
+        y11 = a10*c01+a11*c11+a12*c21-dt*b11
+        y12 = a10*c02+a11*c12+a12*c22-dt*b12
+        y20 = a20*c00+a21*c10+a22*c20-dt*b02
+        y21 = a20*c01+a21*c11+a22*c21-dt*b12
+        y22 = a20*c02+a21*c12+a22*c22-dt*b22
+        #Ptt = X*A'-dt*Y
+        d = dt*dt
+        q = BIAS_COV*dt
+        return (x00*a00+x01*a01+x02*a02-dt*y00+GYRO_COV[0]*d,
+                x00*a10+x01*a11+x02*a12-dt*y01,
+                x00*a20+x01*a21+x02*a22-dt*y02,
+                x10*a10+x11*a11+x12*a12-dt*y11+GYRO_COV[1]*d,
+                x10*a20+x11*a21+x12*a22-dt*y12,
+                x20*a20+x21*a21+x22*a22-dt*y22+GYRO_COV[2]*d,
+                y00,y01,y02,y10,y11,y12,y20,y21,y22,
+                b00+q,b01,b02,b11+q,b12,b22+q)
+
+    #sequential scalar measurement y = h*e+noise, h only touches the attitude error
+    def update3(self,P,err,h0,h1,h2,y,r):
+        t00,t01,t02,t11,t12,t22 = P
+        e0,e1,e2 = err
+        f0 = t00*h0+t01*h1+t02*h2
+        f1 = t01*h0+t11*h1+t12*h2
+        f2 = t02*h0+t12*h1+t22*h2
+        s = 1/(h0*f0+h1*f1+h2*f2+r)
+        k = (y-h0*e0-h1*e1-h2*e2)*s
+        g0,g1,g2 = f0*s,f1*s,f2*s
+        return ((t00-g0*f0,t01-g0*f1,t02-g0*f2,t11-g1*f1,t12-g1*f2,t22-g2*f2),
+                (e0+f0*k,e1+f1*k,e2+f2*k))
+
+    def update6(self,P,err,h0,h1,h2,y,r):
+        (t00,t01,t02,t11,t12,t22,
+         c00,c01,c02,c10,c11,c12,c20,c21,c22,
+         b00,b01,b02,b11,b12,b22) = P
+        e0,e1,e2,e3,e4,e5 = err
+        #P*h'
+        f0 = t00*h0+t01*h1+t02*h2
+        f1 = t01*h0+t11*h1+t12*h2
+        f2 = t02*h0+t12*h1+t22*h2
+        f3 = c00*h0+c10*h1+c20*h2
+        f4 = c01*h0+c11*h1+c21*h2
+        f5 = c02*h0+c12*h1+c22*h2
+        s = 1/(h0*f0+h1*f1+h2*f2+r)
+        k = (y-h0*e0-h1*e1-h2*e2)*s
+        g0,g1,g2,g3,g4,g5 = f0*s,f1*s,f2*s,f3*s,f4*s,f5*s
+        return ((t00-g0*f0,t01-g0*f1,t02-g0*f2,t11-g1*f1,t12-g1*f2,t22-g2*f2,
+                 c00-g0*f3,c01-g0*f4,c02-g0*f5,
+                 c10-g1*f3,c11-g1*f4,c12-g1*f5,
+                 c20-g2*f3,c21-g2*f4,c22-g2*f5,
+                 b00-g3*f3,b01-g3*f4,b02-g3*f5,b11-g4*f4,b12-g4*f5,b22-g5*f5),
+                (e0+f0*k,e1+f1*k,e2+f2*k,e3+f3*k,e4+f4*k,e5+f5*k))
+
+    #body to world quaternion from gravity and the magnetic field (TRIAD): the rows of the
+    #rotation matrix are the world axes in the body frame
+    @staticmethod
+    def measured_attitude(ax,ay,az,mx,my,mz):
+        norm = math.sqrt(ax*ax+ay*ay+az*az)
+        z0,z1,z2 = ax/norm,ay/norm,az/norm
+        y0,y1,y2 = z1*mz-z2*my,z2*mx-z0*mz,z0*my-z1*mx
+        norm = math.sqrt(y0*y0+y1*y1+y2*y2)
+        y0,y1,y2 = y0/norm,y1/norm,y2/norm
+        x0,x1,x2 = y1*z2-y2*z1,y2*z0-y0*z2,y0*z1-y1*z0
+        #rotation matrix to quaternion, branching on the largest component
+        trace = x0+y1+z2
+        if trace > 0:
+            s = 2*math.sqrt(1+trace)
+            return 0.25*s,(z1-y2)/s,(x2-z0)/s,(y0-x1)/s
+        if x0 > y1 and x0 > z2:
+            s = 2*math.sqrt(1+x0-y1-z2)
+            return (z1-y2)/s,0.25*s,(x1+y0)/s,(x2+z0)/s
+        if y1 > z2:
+            s = 2*math.sqrt(1+y1-x0-z2)
+            return (x2-z0)/s,(x1+y0)/s,0.25*s,(y2+z1)/s
+        s = 2*math.sqrt(1+z2-x0-y1)
+        return (y0-x1)/s,(x2+z0)/s,(y2+z1)/s,0.25*s
+
+
+if __name__ == "__main__":
+    import timeit
+
+    def qtoDCM(q):
+        C = np.array([[q[0]**2+q[1]**2-q[2]**2-q[3]**2, 2*q[0]*q[3]+2*q[1]*q[2], -2*q[0]*q[2]+2*q[1]*q[3]],
+        [-2*q[0]*q[3]+2*q[1]*q[2], q[0]**2-q[1]**2+q[2]**2-q[3]**2, 2*q[0]*q[1]+2*q[2]*q[3]],
+        [2*q[0]*q[2]+2*q[1]*q[3], -2*q[0]*q[1]+2*q[2]*q[3], q[0]**2-q[1]**2-q[2]**2+q[3]**2]])
+        return C
+
+    def quaternion_multiply(quaternion1, quaternion0):
+        w0, x0, y0, z0 = quaternion0
+        w1, x1, y1, z1 = quaternion1
+        return np.array([[-x1 * x0 - y1 * y0 - z1 * z0 + w1 * w0,
+                         x1 * w0 + y1 * z0 - z1 * y0 + w1 * x0,
+                         -x1 * z0 + y1 * w0 + z1 * x0 + w1 * y0,
+                         x1 * y0 - y1 * x0 + z1 * w0 + w1 * z0]])
+
+    #the original numpy implementation, for comparison
+    def KalmanAttitudeNaive(accel,gyro,mag,magcal,dt,qin,Pin):
+        a = accel/np.linalg.norm(accel)
+        if a[2] >=0:
+            q_acc = np.array([np.sqrt((a[2]+1)/2), -a[1]/np.sqrt(2*(a[2]+1)),  a[0]/np.sqrt(2*(a[2]+1)),0])
+        else:
+            q_acc = np.array([-a[1]/np.sqrt(2*(1-a[2])), np.sqrt((1-a[2])/2), 0, a[0]/np.sqrt(2*(1-a[2]))])
+        m_raw = (mag-magcal)/np.linalg.norm(mag-magcal)
+        m_aligned = np.array([m_raw[1],m_raw[0],m_raw[2]])
+        R_acc = np.transpose(qtoDCM(q_acc))
+        l = R_acc.dot(np.transpose(m_aligned))
+        gam = l[0]**2+l[1]**2
+        if l[0]>=0:
+            q_mag = np.array([np.sqrt(gam+l[0]*np.sqrt(gam))/np.sqrt(2*gam),0,0,l[1]/(np.sqrt(2)*np.sqrt(gam+l[0]*np.sqrt(gam)))])
+        else:
+            q_mag = [l[1]/(np.sqrt(2)*np.sqrt(gam-l[0]*np.sqrt(gam))),0,0,np.sqrt(gam-l[0]*np.sqrt(gam))/np.sqrt(2*gam)]
+        q_est = quaternion_multiply(q_acc,q_mag);
+        omega = -1/2*np.array([[0,-gyro[0],-gyro[1],-gyro[2]],
+                [gyro[0], 0, gyro[2], -gyro[1]],
+                [gyro[1], -gyro[2], 0, gyro[0]],
+                [gyro[2], gyro[1], -gyro[0], 0]])
+        F = np.identity(4)+1/2*omega*dt;
+        xhat_proj = F.dot(np.transpose(qin))
+        Gk = np.array([[qin[0,1], qin[0,2], qin[0,3]],
+            [-qin[0,0],qin[0,3], -qin[0,2]],
+            [-qin[0,3], -qin[0,0], qin[0,1]],
+            [qin[0,2],-qin[0,1], -qin[0,0]]])
+        GyroCov = np.diag(np.array(GYRO_COV))
+        Qk = (dt**2)/4*Gk.dot(GyroCov.dot(np.transpose(Gk)))
+        R = np.diag(np.array(MEAS_COV))
+        P_proj = F.dot(Pin.dot(np.transpose(F)))+Qk
+        Gain = P_proj.dot(np.linalg.inv(P_proj+R))
+        xhat_k1 = xhat_proj + Gain.dot((np.transpose(q_est)-xhat_proj))
+        P_k1 = np.dot((np.identity(4)-Gain),P_proj)
+        return [np.transpose(xhat_k1),P_k1]
+
+    #run over a random walk and check every step against the numpy version from the same state
+    #(over many steps the two drift apart slowly, (I-K)*P_proj in the numpy version loses
+    #precision while P is large)
+    rng = np.random.default_rng(1)
+    magcal = np.array([0.5,-0.2,0.1])
+    dt = 0.002
+    q_fast = np.array([[1,0,0,0]])
+    P_fast = np.diag(np.array([100,100,100,100]))
+    q_buf,P_buf = np.zeros((1,4)),np.zeros((4,4))
+    worst = 0.0
+    for i in range(2000):
+        accel = np.array([0.1,-0.05,1.0])+0.05*rng.standard_normal(3)
+        if i % 2:
+            accel = -accel
+        gyro = 0.5*rng.standard_normal(3)
+        mag = np.array([20.0,5.0,-40.0])+rng.standard_normal(3)
+        q_slow,P_slow = KalmanAttitudeNaive(accel,gyro,mag,magcal,dt,q_fast,P_fast)
+        #into caller owned buffers
+        KalmanAttitude(accel,gyro,mag,magcal,dt,q_fast,P_fast,q_buf,P_buf)
+        q_fast,P_fast = KalmanAttitude(accel,gyro,mag,magcal,dt,q_fast,P_fast)
+        worst = max(worst,np.abs(q_fast-q_slow).max(),np.abs(P_fast-P_slow).max(),
+                    np.abs(q_buf-q_fast).max(),np.abs(P_buf-P_fast).max())
+    print("largest difference from the numpy version: {0:.3g}".format(worst))
+
+    args = (accel,gyro,mag,magcal,dt,q_fast,P_fast)
+    number = 20000
+    naive = timeit.timeit(lambda: KalmanAttitudeNaive(*args),number=number)/number
+    fast = timeit.timeit(lambda: KalmanAttitude(*args),number=number)/number
+    inplace = timeit.timeit(lambda: KalmanAttitude(*(args+(q_buf,P_buf))),number=number)/number
+    print("numpy version:     {0:6.1f} us per step".format(naive*1e6))
+    print("scalar version:    {0:6.1f} us per step ({1:.1f}x)".format(fast*1e6,naive/fast))
+    print("into out buffers:  {0:6.1f} us per step ({1:.1f}x)".format(inplace*1e6,naive/inplace))
+
+    #accuracy on a simulated slow rotation with a constant gyro bias, q in the KalmanAttitude
+    #convention is the world to body rotation
+    def qmult(a,b):
+        return np.array([a[0]*b[0]-a[1]*b[1]-a[2]*b[2]-a[3]*b[3],
+                         a[0]*b[1]+a[1]*b[0]+a[2]*b[3]-a[3]*b[2],
+                         a[0]*b[2]-a[1]*b[3]+a[2]*b[0]+a[3]*b[1],
+                         a[0]*b[3]+a[1]*b[2]-a[2]*b[1]+a[3]*b[0]])
+
+    def rotate(q,v):
+        q = q/np.linalg.norm(q)
+        return qmult(qmult(q,np.r_[0,v]),q*np.array([1,-1,-1,-1]))[1:]
+
+    filters = [('KalmanAttitude',KalmanAttitude),
+               ('AttitudeMEKF',AttitudeMEKF()),
+               ('AttitudeMEKF(gyro_bias=True)',AttitudeMEKF(gyro_bias=True))]
+    states = [(np.array([[1,0,0,0]]),np.diag(np.array([100,100,100,100]))) for f in filters]
+    tilt = [[] for f in filters]
+    error = [[] for f in filters]
+    elapsed = [0.0 for f in filters]
+    q_true = np.array([1.0,0,0,0])
+    up = np.array([0,0,1.0])
+    field = np.array([0.4,0,-0.9])
+    bias = np.array([0.02,-0.01,0.015])
+    steps = 10000
+    for i in range(steps):
+        t = i*dt
+        rate = 0.05*np.array([np.sin(0.7*t),np.cos(0.5*t),np.sin(0.3*t)])
+        angle = np.linalg.norm(rate)*dt
+        q_true = qmult(np.r_[np.cos(angle/2),-np.sin(angle/2)*rate/np.linalg.norm(rate)],q_true)
+        accel = rotate(q_true,up)+0.01*rng.standard_normal(3)
+        mag = rotate(q_true,field)+0.01*rng.standard_normal(3)
+        mag = np.array([mag[1],mag[0],mag[2]])
+        gyro = rate+bias+0.02*rng.standard_normal(3)
+        for j,(name,f) in enumerate(filters):
+            start = timeit.default_timer()
+            states[j] = f(accel,gyro,mag,np.zeros(3),dt,*states[j])
+            elapsed[j] += timeit.default_timer()-start
+            q = states[j][0][0]/np.linalg.norm(states[j][0])
+            if i >= steps//2:
+                tilt[j].append(np.degrees(np.arccos(min(1.0,rotate(q,up).dot(rotate(q_true,up))))))
+                error[j].append(np.degrees(2*np.arccos(min(1.0,abs(q.dot(q_true))))))
+    print("simulated rotation with a gyro bias of {0} rad/s:".format(bias))
+    for j,(name,f) in enumerate(filters):
+        print("{0:>28}: tilt error {1:6.3f} deg rms, attitude error {2:6.3f} deg rms, {3:5.1f} us per step".format(
+            name,np.sqrt(np.mean(np.square(tilt[j]))),np.sqrt(np.mean(np.square(error[j]))),elapsed[j]/steps*1e6))
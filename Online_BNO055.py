@@ -20,6 +20,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 import binascii
+import collections
+import json
 import logging
 import struct
 import time
@@ -207,13 +209,260 @@ OPERATION_MODE_NDOF_FMC_OFF          = 0X0B
 OPERATION_MODE_NDOF                  = 0X0C
 
 
+# SYS_STAT values (section 4.3.58 of the datasheet).
+SYS_STAT_IDLE                        = 0x00
+SYS_STAT_ERROR                       = 0x01
+SYS_STAT_FUSION_RUNNING              = 0x05
+SYS_STAT_SENSORS_RUNNING             = 0x06
+
+# Length of the sensor offset and radius registers from 0x55 to 0x6A.
+CALIBRATION_LENGTH                   = 22
+
+# Default file for the calibration profile restored by fast_begin.
+DEFAULT_CALIBRATION_PROFILE          = 'bno055_calibration.json'
+
+# Every fusion output from 0x08 (ACC_DATA_X_LSB) to 0x35 (CALIB_STAT): 22 signed 16-bit
+# little endian words, a signed temperature byte and the calibration status byte.
+SNAPSHOT_LENGTH = BNO055_CALIB_STAT_ADDR - BNO055_ACCEL_DATA_X_LSB_ADDR + 1
+_SNAPSHOT_STRUCT = struct.Struct('<22hbB')
+
+# All outputs of one read_all() call, in the same units as the individual read_* methods.
+BNO055Snapshot = collections.namedtuple('BNO055Snapshot',
+    ['accelerometer', 'magnetometer', 'gyroscope', 'euler', 'quaternion',
+     'linear_acceleration', 'gravity', 'temp', 'calibration_status'])
+
+
 logger = logging.getLogger(__name__)
 
 
+class PigpioI2CDevice(object):
+    """The subset of the Adafruit_GPIO.I2C device interface used by the BNO055
+    class, implemented with pigpio block transfers.  Any object with pigpio's
+    I2C methods can be used as pi.
+    """
+
+    def __init__(self, pi, handle, error=IOError):
+        self._pi = pi
+        self._handle = handle
+        self._error = error
+
+    def readList(self, register, length):
+        # One combined transaction, the register write and the read joined by a
+        # repeated start: unlike SMBus block reads, which stop at 32 bytes, it
+        # returns the whole read_all snapshot from a single sensor update.
+        # pigpio zip commands: combined on, write 1 byte, read length bytes,
+        # combined off, end.
+        try:
+            count, data = self._pi.i2c_zip(self._handle, [2, 7, 1, register & 0xFF, 6, length, 3, 0])
+        except self._error as e:
+            raise IOError(str(e))
+        if count != length:
+            raise IOError('Short BNO055 read: expected {0} bytes, got {1}'.format(length, count))
+        return bytearray(data)
+
+    def readU8(self, register):
+        try:
+            return self._pi.i2c_read_byte_data(self._handle, register)
+        except self._error as e:
+            raise IOError(str(e))
+
+    def write8(self, register, value):
+        try:
+            self._pi.i2c_write_byte_data(self._handle, register, value & 0xFF)
+        except self._error as e:
+            raise IOError(str(e))
+
+    def writeList(self, register, data):
+        try:
+            self._pi.i2c_write_i2c_block_data(self._handle, register, [x & 0xFF for x in data])
+        except self._error as e:
+            raise IOError(str(e))
+
+
+class PigpioI2C(object):
+    """Pass as the i2c parameter of BNO055 to talk to the chip through pigpio
+    instead of Adafruit_GPIO, for example BNO055(i2c=PigpioI2C(pi)).
+    """
+
+    def __init__(self, pi, bus=1):
+        self._pi = pi
+        self._bus = bus
+        # pigpio raises pigpio.error on bus failures, which the BNO055 class
+        # expects to see as IOError.
+        try:
+            import pigpio
+            self._error = (IOError, pigpio.error)
+        except ImportError:
+            self._error = IOError
+
+    def get_i2c_device(self, address, busnum=None, **kwargs):
+        bus = self._bus if busnum is None else busnum
+        handle = self._pi.i2c_open(bus, address, 0)
+        return PigpioI2CDevice(self._pi, handle, self._error)
+
+
+class _UARTRequest(object):
+    # One command sent to the BNO055 UART and, once complete, its response.
+    def __init__(self, command, is_read):
+        self.command = command
+        self.is_read = is_read
+        self.attempts = 0
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class BNO055UART(object):
+    """Pipelined transport for the BNO055 UART protocol.  Commands are written
+    without flushing the input, responses are parsed incrementally out of a
+    persistent receive buffer and matched to their commands in order, so up to
+    max_in_flight reads can be outstanding at once.  Commands answered with a
+    bus over run error (0xEE 0x07) are resent without holding up the others,
+    up to max_attempts times.
+    """
+
+    def __init__(self, port, max_in_flight=4, max_attempts=5):
+        self._serial = port
+        self._max_in_flight = max_in_flight
+        self._max_attempts = max_attempts
+        self._rx = bytearray()
+        # Requests waiting for a response, oldest first.
+        self._in_flight = collections.deque()
+        # Set after an unacknowledged write, like a reset, whose aftermath may
+        # leave stray bytes on the line.
+        self._flush_pending = False
+
+    def _send(self, request):
+        if self._flush_pending:
+            self._serial.flushInput()
+            self._rx = bytearray()
+            self._flush_pending = False
+        request.attempts += 1
+        self._serial.write(request.command)
+        logger.debug('Serial send: 0x{0}'.format(binascii.hexlify(request.command)))
+        self._in_flight.append(request)
+
+    def _receive(self):
+        # Block for at least one byte, then take whatever else has arrived.
+        data = self._serial.read(max(1, self._serial.in_waiting))
+        if not data:
+            # Nothing in flight will be matched any more, start over clean.  A
+            # late response may still arrive, so flush it before the next
+            # command rather than match it to that command.
+            self._in_flight.clear()
+            self._rx = bytearray()
+            self._flush_pending = True
+            raise RuntimeError('Timeout waiting for serial response, is the BNO055 connected?')
+        logger.debug('Serial receive: 0x{0}'.format(binascii.hexlify(data)))
+        self._rx += data
+
+    def _parse(self):
+        # Match every complete response in the receive buffer to the oldest
+        # request in flight.
+        while self._in_flight and len(self._rx) >= 2:
+            if self._rx[0] == 0xBB:
+                length = self._rx[1]
+                if len(self._rx) < 2 + length:
+                    return
+                response = self._rx[2:2 + length]
+                del self._rx[:2 + length]
+            elif self._rx[0] == 0xEE:
+                response = None
+                status = self._rx[1]
+                del self._rx[:2]
+            else:
+                # Not the start of a response, resynchronize on the next byte.
+                del self._rx[0]
+                continue
+            request = self._in_flight.popleft()
+            if response is None and status == 0x07 and request.attempts < self._max_attempts:
+                # Bus over run, resend as recommended in the UART app note at:
+                #   http://ae-bst.resource.bosch.com/media/products/dokumente/bno055/BST-BNO055-AN012-00.pdf
+                self._send(request)
+                continue
+            request.done = True
+            if request.is_read and response is not None:
+                request.result = response
+            elif not request.is_read and response is None and status == 0x01:
+                request.result = status
+            elif response is None and status == 0x07:
+                request.error = 'Exceeded maximum attempts to acknowledge serial command without bus error!'
+            else:
+                request.error = 'Register {0} error: 0x{1:02X}'.format(
+                    'read' if request.is_read else 'write', 0xBB if response is not None else status)
+
+    def _wait_room(self):
+        while len(self._in_flight) >= self._max_in_flight:
+            self._receive()
+            self._parse()
+
+    def wait(self, request):
+        """Block until the request completes and return its result, raising
+        RuntimeError if the BNO055 reported an error.
+        """
+        while not request.done:
+            self._receive()
+            self._parse()
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.result
+
+    def submit_read(self, address, length):
+        """Send a register read command without waiting for the response and
+        return a request to pass to wait().
+        """
+        self._wait_room()
+        request = _UARTRequest(bytearray([0xAA, 0x01, address & 0xFF, length & 0xFF]), True)
+        self._send(request)
+        return request
+
+    def submit_write(self, address, data):
+        """Send a register write command without waiting for the
+        acknowledgement and return a request to pass to wait().
+        """
+        self._wait_room()
+        command = bytearray([0xAA, 0x00, address & 0xFF, len(data) & 0xFF])
+        command += bytearray(x & 0xFF for x in data)
+        request = _UARTRequest(command, False)
+        self._send(request)
+        return request
+
+    def read(self, address, length):
+        """Read length bytes starting at address."""
+        return self.wait(self.submit_read(address, length))
+
+    def read_many(self, blocks):
+        """Read a list of (address, length) blocks with all of them in flight
+        together, returning a list of bytearrays in the same order.
+        """
+        requests = [self.submit_read(address, length) for address, length in blocks]
+        return [self.wait(request) for request in requests]
+
+    def write(self, address, data, ack=True):
+        """Write data starting at address.  If ack is False no acknowledgement
+        is expected (like when resetting the device), so everything in flight
+        is completed first and the input is flushed before the next command.
+        """
+        if ack:
+            self.wait(self.submit_write(address, data))
+            return
+        while self._in_flight:
+            self._receive()
+            self._parse()
+        command = bytearray([0xAA, 0x00, address & 0xFF, len(data) & 0xFF])
+        command += bytearray(x & 0xFF for x in data)
+        self._serial.write(command)
+        logger.debug('Serial send: 0x{0}'.format(binascii.hexlify(command)))
+        # Give a response the chip might still send time to arrive so the
+        # flush discards it instead of it being taken for the next response.
+        time.sleep(0.02)
+        self._flush_pending = True
+
+
 class BNO055(object):
 
     def __init__(self, rst=None, address=BNO055_ADDRESS_A, i2c=None, gpio=None,
-                 serial_port=None, serial_timeout_sec=5, **kwargs):
+                 serial_port=None, serial_timeout_sec=5, serial_max_in_flight=4, **kwargs):
         # If reset pin is provided save it and a reference to provided GPIO
         # bus (or the default system GPIO bus if none is provided).
         self._rst = rst
@@ -228,13 +477,19 @@ class BNO055(object):
             # Wait a 650 milliseconds in case setting the reset high reset the chip.
             time.sleep(0.65)
         self._serial = None
+        self._uart = None
         self._i2c_device = None
-        if serial_port is not None:
+        if serial_port is not None and not isinstance(serial_port, str):
+            # Use an already open port object, for example a simulated BNO055.
+            self._serial = serial_port
+        elif serial_port is not None:
             # Use serial communication if serial_port name is provided.
             # Open the serial port at 115200 baud, 8N1.  Add a 5 second timeout
             # to prevent hanging if device is disconnected.
             self._serial = serial.Serial(serial_port, 115200, timeout=serial_timeout_sec,
                                          writeTimeout=serial_timeout_sec)
+        if self._serial is not None:
+            self._uart = BNO055UART(self._serial, max_in_flight=serial_max_in_flight)
         else:
             # Use I2C if no serial port is provided.
             # Assume we're using platform's default I2C bus if none is specified.
@@ -244,54 +499,14 @@ class BNO055(object):
             # Save a reference to the I2C device instance for later communication.
             self._i2c_device = i2c.get_i2c_device(address, **kwargs)
 
-    def _serial_send(self, command, ack=True, max_attempts=5):
-        # Send a serial command and automatically handle if it needs to be resent
-        # because of a bus error.  If ack is True then an ackowledgement is
-        # expected and only up to the maximum specified attempts will be made
-        # to get a good acknowledgement (default is 5).  If ack is False then
-        # no acknowledgement is expected (like when resetting the device).
-        attempts = 0
-        while True:
-            # Flush any pending received data to get into a clean state.
-            self._serial.flushInput()
-            # Send the data.
-            self._serial.write(command)
-            logger.debug('Serial send: 0x{0}'.format(binascii.hexlify(command)))
-            # Stop if no acknowledgment is expected.
-            if not ack:
-                return
-            # Read acknowledgement response (2 bytes).
-            resp = bytearray(self._serial.read(2))
-            logger.debug('Serial receive: 0x{0}'.format(binascii.hexlify(resp)))
-            if resp is None or len(resp) != 2:
-                raise RuntimeError('Timeout waiting for serial acknowledge, is the BNO055 connected?')
-            # Stop if there's no bus error (0xEE07 response) and return response bytes.
-            if not (resp[0] == 0xEE and resp[1] == 0x07):
-                return resp
-            # Else there was a bus error so resend, as recommended in UART app
-            # note at:
-            #   http://ae-bst.resource.bosch.com/media/products/dokumente/bno055/BST-BNO055-AN012-00.pdf
-            attempts += 1
-            if attempts >=  max_attempts:
-                raise RuntimeError('Exceeded maximum attempts to acknowledge serial command without bus error!')
-
     def _write_bytes(self, address, data, ack=True):
         # Write a list of 8-bit values starting at the provided register address.
         if self._i2c_device is not None:
             # I2C write.
             self._i2c_device.writeList(address, data)
         else:
-            # Build and send serial register write command.
-            command = bytearray(4+len(data))
-            command[0] = 0xAA  # Start byte
-            command[1] = 0x00  # Write
-            command[2] = address & 0xFF
-            command[3] = len(data) & 0xFF
-            command[4:] = map(lambda x: x & 0xFF, data)
-            resp = self._serial_send(command, ack=ack)
-            # Verify register write succeeded if there was an acknowledgement.
-            if resp[0] != 0xEE and resp[1] != 0x01:
-                raise RuntimeError('Register write error: 0x{0}'.format(binascii.hexlify(resp)))
+            # Serial register write, the transport checks the acknowledgement.
+            self._uart.write(address, data, ack=ack)
 
     def _write_byte(self, address, value, ack=True):
         # Write an 8-bit value to the provided register address.  If ack is True
@@ -301,17 +516,8 @@ class BNO055(object):
             # I2C write.
             self._i2c_device.write8(address, value)
         else:
-            # Build and send serial register write command.
-            command = bytearray(5)
-            command[0] = 0xAA  # Start byte
-            command[1] = 0x00  # Write
-            command[2] = address & 0xFF
-            command[3] = 1     # Length (1 byte)
-            command[4] = value & 0xFF
-            resp = self._serial_send(command, ack=ack)
-            # Verify register write succeeded if there was an acknowledgement.
-            if ack and resp[0] != 0xEE and resp[1] != 0x01:
-                raise RuntimeError('Register write error: 0x{0}'.format(binascii.hexlify(resp)))
+            # Serial register write, the transport checks the acknowledgement.
+            self._uart.write(address, [value], ack=ack)
 
     def _read_bytes(self, address, length):
         # Read a number of unsigned byte values starting from the provided address.
@@ -319,23 +525,8 @@ class BNO055(object):
             # I2C read.
             return bytearray(self._i2c_device.readList(address, length))
         else:
-            # Build and send serial register read command.
-            command = bytearray(4)
-            command[0] = 0xAA  # Start byte
-            command[1] = 0x01  # Read
-            command[2] = address & 0xFF
-            command[3] = length & 0xFF
-            resp = self._serial_send(command)
-            # Verify register read succeeded.
-            if resp[0] != 0xBB:
-                 raise RuntimeError('Register read error: 0x{0}'.format(binascii.hexlify(resp)))
-            # Read the returned bytes.
-            length = resp[1]
-            resp = bytearray(self._serial.read(length))
-            logger.debug('Received: 0x{0}'.format(binascii.hexlify(resp)))
-            if resp is None or len(resp) != length:
-                raise RuntimeError('Timeout waiting to read data, is the BNO055 connected?')
-            return resp
+            # Serial register read.
+            return self._uart.read(address, length)
 
     def _read_byte(self, address):
         # Read an 8-bit unsigned value from the provided register address.
@@ -408,6 +599,137 @@ class BNO055(object):
         self._operation_mode()
         return True
 
+    def _poll(self, address, done, timeout, interval=0.002):
+        # Read a register until done(value) is True or timeout seconds pass and
+        # return the last value read, or None if the chip never answered.  Read
+        # errors are expected while the chip boots, so they are retried.
+        end = time.time() + timeout
+        value = None
+        port_timeout = None
+        if self._serial is not None:
+            # Don't block for the full port timeout on every unanswered poll.
+            port_timeout = self._serial.timeout
+            self._serial.timeout = max(interval, 0.01)
+        try:
+            while True:
+                try:
+                    value = self._read_byte(address)
+                    if done(value):
+                        return value
+                except (IOError, RuntimeError):
+                    pass
+                if time.time() >= end:
+                    return value
+                time.sleep(interval)
+        finally:
+            if port_timeout is not None:
+                self._serial.timeout = port_timeout
+
+    def _set_mode_polled(self, mode, timeout=0.1):
+        # Switch operation mode and poll SYS_STAT until the switch has taken
+        # effect instead of sleeping the worst case 30 milliseconds.
+        self._write_byte(BNO055_OPR_MODE_ADDR, mode & 0xFF)
+        if mode == OPERATION_MODE_CONFIG:
+            expected = (SYS_STAT_IDLE,)
+        elif mode >= OPERATION_MODE_IMUPLUS:
+            expected = (SYS_STAT_FUSION_RUNNING,)
+        else:
+            expected = (SYS_STAT_SENSORS_RUNNING,)
+        status = self._poll(BNO055_SYS_STAT_ADDR, lambda value: value in expected, timeout)
+        return status in expected
+
+    def fast_begin(self, mode=OPERATION_MODE_NDOF, calibration_path=DEFAULT_CALIBRATION_PROFILE,
+                   timeout=1.0):
+        """Initialize the BNO055 as quickly as possible.  Unlike begin, the
+        reset is skipped when the chip already reports its ID and no system
+        error, status registers are polled instead of sleeping fixed delays,
+        and the calibration profile saved with save_calibration_profile is
+        restored when the chip has lost its calibration.  Returns a tuple of
+        whether the BNO055 was initialized and a dict of the seconds spent in
+        each stage ('probe', 'reset', 'calibration', 'mode' and 'total'),
+        which is also kept in the startup_timings attribute.
+        """
+        self._mode = mode
+        timings = collections.OrderedDict()
+        start = time.time()
+        stage = start
+
+        # Probe the current state without resetting anything.
+        try:
+            self._write_byte(BNO055_PAGE_ID_ADDR, 0)
+        except (IOError, RuntimeError):
+            pass
+        bno_id = self._poll(BNO055_CHIP_ID_ADDR, lambda value: value == BNO055_ID, timeout)
+        if bno_id != BNO055_ID:
+            return False, timings
+        status = self._read_byte(BNO055_SYS_STAT_ADDR)
+        error = self._read_byte(BNO055_SYS_ERR_ADDR)
+        now = time.time()
+        timings['probe'] = now - stage
+        stage = now
+
+        # Only reset a chip that reports a problem.
+        reset = status == SYS_STAT_ERROR or error != 0
+        if reset:
+            logger.debug('Resetting BNO055, SYS_STAT 0x{0:02X} SYS_ERR 0x{1:02X}'.format(status, error))
+            self._set_mode_polled(OPERATION_MODE_CONFIG)
+            if self._rst is not None:
+                self._gpio.set_low(self._rst)
+                time.sleep(0.01)  # 10ms
+                self._gpio.set_high(self._rst)
+            else:
+                self._write_byte(BNO055_SYS_TRIGGER_ADDR, 0x20, ack=False)
+            # The chip doesn't answer until it has booted, typically 650ms.
+            bno_id = self._poll(BNO055_CHIP_ID_ADDR, lambda value: value == BNO055_ID, timeout, interval=0.01)
+            if bno_id != BNO055_ID:
+                return False, timings
+            self._write_byte(BNO055_PWR_MODE_ADDR, POWER_MODE_NORMAL)
+            self._write_byte(BNO055_SYS_TRIGGER_ADDR, 0x0)
+        now = time.time()
+        timings['reset'] = now - stage
+        stage = now
+
+        # A freshly booted chip has no calibration, so restore the saved one.
+        cal_status = self._read_byte(BNO055_CALIB_STAT_ADDR)
+        profile = self.load_calibration_profile(calibration_path) if calibration_path else None
+        if profile is not None and (reset or cal_status == 0):
+            self._set_mode_polled(OPERATION_MODE_CONFIG)
+            self._write_bytes(ACCEL_OFFSET_X_LSB_ADDR, profile)
+        now = time.time()
+        timings['calibration'] = now - stage
+        stage = now
+
+        ok = self._set_mode_polled(mode, timeout)
+        now = time.time()
+        timings['mode'] = now - stage
+        timings['total'] = now - start
+        self.startup_timings = timings
+        logger.info('BNO055 startup: ' + ', '.join('{0} {1:.1f} ms'.format(name, seconds * 1000)
+                                                   for name, seconds in timings.items()))
+        return ok, timings
+
+    def save_calibration_profile(self, path=DEFAULT_CALIBRATION_PROFILE):
+        """Save the sensor's current 22 bytes of calibration data to a JSON
+        file so fast_begin can restore it on the next start.
+        """
+        data = self.get_calibration()
+        with open(path, 'w') as f:
+            json.dump({'calibration': data, 'status': list(self.get_calibration_status()),
+                       'timestamp': time.time()}, f)
+
+    def load_calibration_profile(self, path=DEFAULT_CALIBRATION_PROFILE):
+        """Return the 22 bytes of calibration data saved in path, or None if
+        there is no valid profile.
+        """
+        try:
+            with open(path) as f:
+                data = json.load(f)['calibration']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+        if len(data) != CALIBRATION_LENGTH:
+            return None
+        return data
+
     def set_mode(self, mode):
         """Set operation mode for BNO055 sensor.  Mode should be a value from
         table 3-3 and 3-5 of the datasheet:
@@ -686,4 +1008,29 @@ class BNO055(object):
 
     def read_temp(self):
         """Return the current temperature in Celsius."""
-        return self._read_signed_byte(BNO055_TEMP_ADDR)
\ No newline at end of file
+        return self._read_signed_byte(BNO055_TEMP_ADDR)
+
+    def read_all(self):
+        """Return every fusion output in a single bus transaction as a
+        BNO055Snapshot of accelerometer, magnetometer, gyroscope, euler,
+        quaternion, linear_acceleration, gravity, temp and calibration_status.
+        Each field has the same units and ordering as the matching read_*
+        method, and all of them come from the same instant so they are
+        consistent with each other.  Use this instead of several read_* calls
+        per loop, especially in serial mode where each call is a round trip.
+        """
+        data = self._read_bytes(BNO055_ACCEL_DATA_X_LSB_ADDR, SNAPSHOT_LENGTH)
+        values = _SNAPSHOT_STRUCT.unpack_from(data)
+        scale = (1.0 / (1<<14))
+        cal_status = values[23]
+        return BNO055Snapshot(
+            accelerometer=(values[0]/100.0, values[1]/100.0, values[2]/100.0),
+            magnetometer=(values[3]/16.0, values[4]/16.0, values[5]/16.0),
+            gyroscope=(values[6]/900.0, values[7]/900.0, values[8]/900.0),
+            euler=(values[9]/16.0, values[10]/16.0, values[11]/16.0),
+            quaternion=(values[13]*scale, values[14]*scale, values[15]*scale, values[12]*scale),
+            linear_acceleration=(values[16]/100.0, values[17]/100.0, values[18]/100.0),
+            gravity=(values[19]/100.0, values[20]/100.0, values[21]/100.0),
+            temp=values[22],
+            calibration_status=((cal_status >> 6) & 0x03, (cal_status >> 4) & 0x03,
+                                (cal_status >> 2) & 0x03, cal_status & 0x03))
@@ -0,0 +1,142 @@
+import math
+import numpy as np
+
+#Quaternion helpers shared by the flight scripts, quaternions are (w,x,y,z).
+#The q* functions work on plain 4-tuples of floats and are the fast path: a product is a
+#handful of float operations with no numpy overhead. The quat*/qtoDCM functions keep the
+#(1,4) numpy interface the scripts used before and accept an out array to write into
+#instead of allocating a new one.
+
+#--- tuple kernel ---
+
+#q as a tuple of floats, from a tuple, a (4,) or a (1,4) array
+def as_tuple(q):
+    if isinstance(q,tuple):
+        return q
+    return tuple(np.ravel(q).tolist())
+
+def qmult(p,r):
+    p0,p1,p2,p3 = p
+    r0,r1,r2,r3 = r
+    return (p0*r0-p1*r1-p2*r2-p3*r3,
+            p0*r1+p1*r0+p2*r3-p3*r2,
+            p0*r2-p1*r3+p2*r0+p3*r1,
+            p0*r3+p1*r2-p2*r1+p3*r0)
+
+def qconj(q):
+    q0,q1,q2,q3 = q
+    return (q0,-q1,-q2,-q3)
+
+def qnormalize(q):
+    q0,q1,q2,q3 = q
+    n = 1/math.sqrt(q0*q0+q1*q1+q2*q2+q3*q3)
+    return (q0*n,q1*n,q2*n,q3*n)
+
+#conjugate of the normalised quaternion, the inverse of its rotation (same as quatinverse)
+def qinverse(q):
+    q0,q1,q2,q3 = q
+    n = 1/math.sqrt(q0*q0+q1*q1+q2*q2+q3*q3)
+    return (q0*n,-q1*n,-q2*n,-q3*n)
+
+#q_ref*inverse(q) in one step, the attitude error of the controller
+def qerror(q_ref,q):
+    p0,p1,p2,p3 = q_ref
+    q0,q1,q2,q3 = q
+    n = 1/math.sqrt(q0*q0+q1*q1+q2*q2+q3*q3)
+    r0,r1,r2,r3 = q0*n,-q1*n,-q2*n,-q3*n
+    return (p0*r0-p1*r1-p2*r2-p3*r3,
+            p0*r1+p1*r0+p2*r3-p3*r2,
+            p0*r2-p1*r3+p2*r0+p3*r1,
+            p0*r3+p1*r2-p2*r1+p3*r0)
+
+#(roll,pitch,yaw) in degrees
+def qeuler(q):
+    q0,q1,q2,q3 = q
+    s = 2*(q0*q2-q3*q1)
+    s = 1.0 if s > 1.0 else (-1.0 if s < -1.0 else s)
+    return (math.degrees(math.atan2(2*(q0*q1+q2*q3),1-2*(q1*q1+q2*q2))),
+            math.degrees(math.asin(s)),
+            math.degrees(math.atan2(2*(q0*q3+q1*q2),1-2*(q2*q2+q3*q3))))
+
+#rotation matrix rows as a 9-tuple, row major, same convention as qtoDCM
+def qdcm(q):
+    q0,q1,q2,q3 = q
+    w2,x2,y2,z2 = q0*q0,q1*q1,q2*q2,q3*q3
+    return (w2+x2-y2-z2,2*(q0*q3+q1*q2),2*(q1*q3-q0*q2),
+            2*(q1*q2-q0*q3),w2-x2+y2-z2,2*(q0*q1+q2*q3),
+            2*(q0*q2+q1*q3),2*(q2*q3-q0*q1),w2-x2-y2+z2)
+
+#--- numpy interface ---
+
+#writes the tuple t into out, or returns it as a new array of the given shape
+def _to_array(t,out,shape):
+    if out is None:
+        return np.array(t).reshape(shape)
+    out.flat[:] = t
+    return out
+
+def quatmult(p,r,out=None):
+    return _to_array(qmult(as_tuple(p),as_tuple(r)),out,(1,4))
+
+def quatinverse(q,out=None):
+    return _to_array(qinverse(as_tuple(q)),out,(1,4))
+
+#same product as quatmult, taking flat quaternions
+def quaternion_multiply(quaternion1,quaternion0,out=None):
+    return _to_array(qmult(as_tuple(quaternion1),as_tuple(quaternion0)),out,(1,4))
+
+#np.array([roll,pitch,yaw]) in degrees
+def quat2euler(q,out=None):
+    return _to_array(qeuler(as_tuple(q)),out,(3,))
+
+def qtoDCM(q,out=None):
+    return _to_array(qdcm(as_tuple(q)),out,(3,3))
+
+
+if __name__ == "__main__":
+    import timeit
+
+    #the helpers as they were copied into the flight scripts
+    def quatmult_old(p,r):
+        q0 = p[0,0]*r[0,0]-p[0,1]*r[0,1]-p[0,2]*r[0,2]-p[0,3]*r[0,3]
+        q1 = p[0,0]*r[0,1]+p[0,1]*r[0,0]+p[0,2]*r[0,3]-p[0,3]*r[0,2]
+        q2 = p[0,0]*r[0,2]-p[0,1]*r[0,3]+p[0,2]*r[0,0]+p[0,3]*r[0,1]
+        q3 = p[0,0]*r[0,3]+p[0,1]*r[0,2]-p[0,2]*r[0,1]+p[0,3]*r[0,0]
+        return np.array([[q0,q1,q2,q3]])
+
+    def quatinverse_old(q):
+        return np.array([[q[0,0], -q[0,1],-q[0,2],-q[0,3]]])/np.linalg.norm(q)
+
+    def quat2euler_old(q):
+        roll = np.arctan2(2*(q[0,0]*q[0,1]+q[0,2]*q[0,3]),1-2*(q[0,1]**2+q[0,2]**2))
+        pitch = np.arcsin(2*(q[0,0]*q[0,2]-q[0,3]*q[0,1]))
+        yaw = np.arctan2(2*(q[0,0]*q[0,3]+q[0,1]*q[0,2]),1-2*(q[0,2]**2+q[0,3]**2))
+        return 180/np.pi*np.array([roll,pitch,yaw])
+
+    def qtoDCM_old(q):
+        return np.array([[q[0]**2+q[1]**2-q[2]**2-q[3]**2, 2*q[0]*q[3]+2*q[1]*q[2], -2*q[0]*q[2]+2*q[1]*q[3]],
+        [-2*q[0]*q[3]+2*q[1]*q[2], q[0]**2-q[1]**2+q[2]**2-q[3]**2, 2*q[0]*q[1]+2*q[2]*q[3]],
+        [2*q[0]*q[2]+2*q[1]*q[3], -2*q[0]*q[1]+2*q[2]*q[3], q[0]**2-q[1]**2-q[2]**2+q[3]**2]])
+
+    p = np.array([[0.9,0.1,-0.3,0.2]])
+    r = np.array([[0.57349583,-0.81795304,0.02150151,0.02462935]])
+    assert np.allclose(quatmult(p,r),quatmult_old(p,r))
+    assert np.allclose(quatinverse(p),quatinverse_old(p))
+    assert np.allclose(quat2euler(qnormalize(as_tuple(p))),quat2euler_old(np.array([qnormalize(as_tuple(p))])))
+    assert np.allclose(qtoDCM(p[0]),qtoDCM_old(p[0]))
+    assert np.allclose(qerror(as_tuple(p),as_tuple(r)),quatmult_old(p,quatinverse_old(r)))
+
+    pt,rt = as_tuple(p),as_tuple(r)
+    q_out = np.zeros((1,4))
+    C_out = np.zeros((3,3))
+    number = 100000
+    cases = [('attitude error',lambda: quatmult_old(p,quatinverse_old(r)),
+              lambda: quatmult(p,quatinverse(r)),lambda: qerror(pt,rt)),
+             ('quatmult',lambda: quatmult_old(p,r),lambda: quatmult(p,r,q_out),lambda: qmult(pt,rt)),
+             ('quatinverse',lambda: quatinverse_old(p),lambda: quatinverse(p,q_out),lambda: qinverse(pt)),
+             ('quat2euler',lambda: quat2euler_old(p),lambda: quat2euler(p),lambda: qeuler(pt)),
+             ('qtoDCM',lambda: qtoDCM_old(p[0]),lambda: qtoDCM(p[0],C_out),lambda: qdcm(pt))]
+    print("{0:>15} {1:>10} {2:>10} {3:>10}".format('us per call','old','numpy','tuple'))
+    for name,old,array,fast in cases:
+        t_old,t_array,t_fast = [timeit.timeit(f,number=number)/number*1e6 for f in (old,array,fast)]
+        print("{0:>15} {1:10.2f} {2:10.2f} {3:10.2f}  ({4:.0f}x)".format(name,t_old,t_array,t_fast,t_old/t_fast))
@@ -0,0 +1,52 @@
+import struct
+import time
+import numpy as np
+
+# AK8963 magnetometer inside the MPU9250, reached through the MPU6050 I2C bypass
+AK8963_ADDR = 0x0C
+
+# AK8963 registers
+WIA = 0x00
+ST1 = 0x02
+HXL = 0x03
+ST2 = 0x09
+CNTL1 = 0x0A
+
+# MPU6050 INT_PIN_CFG register and its I2C bypass bit
+INT_PIN_CFG = 0x37
+BYPASS_EN = 0x02
+
+# continuous measurement mode 2 (100 Hz) with 16 bit output
+CNTL1_CONTINUOUS_100HZ_16BIT = 0b00010110
+
+# ST1 data ready bit and ST2 magnetic sensor overflow bit
+ST1_DRDY = 0x01
+ST2_HOFL = 0x08
+
+# ST1, six little endian data bytes and ST2; ST2 has to be read to release the data registers
+MAG_BLOCK_LENGTH = 8
+
+# ST1, HX, HY, HZ, ST2
+_MAG_STRUCT = struct.Struct('<B3hB')
+
+
+# enables the MPU6050 bypass and starts the AK8963 measuring, returns the AK8963 handle
+def setup_ak8963(pi, mpu6050_handle, bus=1):
+    bypass_byte = pi.i2c_read_byte_data(mpu6050_handle, INT_PIN_CFG) | BYPASS_EN
+    pi.i2c_write_byte_data(mpu6050_handle, INT_PIN_CFG, bypass_byte)
+    ak8963_handle = pi.i2c_open(bus, AK8963_ADDR, 0)
+    pi.i2c_write_byte_data(ak8963_handle, CNTL1, CNTL1_CONTINUOUS_100HZ_16BIT)
+    time.sleep(0.1)
+    return ak8963_handle
+
+
+# decodes the ST1..ST2 block into (raw field counts, data ready, overflow)
+def decode_mag(data):
+    st1, mx, my, mz, st2 = _MAG_STRUCT.unpack_from(data)
+    return np.array([mx, my, mz]), bool(st1 & ST1_DRDY), bool(st2 & ST2_HOFL)
+
+
+# reads ST1 through ST2 in one block transaction
+def read_mag(pi, ak8963_handle):
+    count, data = pi.i2c_read_i2c_block_data(ak8963_handle, ST1, MAG_BLOCK_LENGTH)
+    return decode_mag(data)
@@ -0,0 +1,224 @@
+import errno
+import time
+import numpy as np
+
+# Per device latency and error accounting for the I2C transports. InstrumentedTransport wraps
+# any object with the pigpio I2C interface (pigpio.pi or one of the i2c_transport classes)
+# and records every transaction against the device it was addressed to, so the flight loop,
+# telemetry or the GUI can see which device is eating the loop budget.
+
+# latency histogram bin b counts transactions that took [2^(b-1), 2^b) microseconds,
+# bin 0 is under 1 us and the last bin everything from about 8 seconds up
+HISTOGRAM_BINS = 24
+
+# errno values the kernel i2c-dev driver reports when a device does not acknowledge
+_NACK_ERRNOS = (errno.ENXIO, errno.EREMOTEIO, errno.EIO)
+
+
+# counters for one device
+class DeviceStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.error_count = 0
+        self.nack_count = 0
+        self.retry_count = 0
+        # reads that returned exactly the same data as the previous read of a watched block
+        self.stale_count = 0
+        self.bytes_read = 0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total_time += seconds
+        if seconds > self.max_time:
+            self.max_time = seconds
+        self.histogram[min(int(seconds * 1e6).bit_length(), HISTOGRAM_BINS - 1)] += 1
+
+    # latency in microseconds below which fraction of the transactions completed,
+    # resolved to the upper edge of a histogram bin
+    def percentile(self, fraction):
+        if self.count == 0:
+            return 0.0
+        index = int(np.searchsorted(np.cumsum(self.histogram), fraction * self.count))
+        return float(1 << index)
+
+    def summary(self):
+        return {'count': self.count,
+                'mean_us': self.total_time / self.count * 1e6 if self.count else 0.0,
+                'p50_us': self.percentile(0.5),
+                'p99_us': self.percentile(0.99),
+                'max_us': self.max_time * 1e6,
+                'total_s': self.total_time,
+                'errors': self.error_count,
+                'nacks': self.nack_count,
+                'retries': self.retry_count,
+                'stale': self.stale_count,
+                'bytes_read': self.bytes_read}
+
+    def reset(self):
+        self.__init__(self.name)
+
+
+# an error that means the device did not acknowledge its address or data
+def is_nack(error):
+    if getattr(error, 'errno', None) in _NACK_ERRNOS:
+        return True
+    # pigpio reports PI_I2C_READ_FAILED and PI_I2C_WRITE_FAILED as 'I2C read failed' and similar
+    message = str(error).lower()
+    return 'i2c read failed' in message or 'i2c write failed' in message
+
+
+class InstrumentedTransport(object):
+    # failed transactions are retried up to retries times before the error is raised, off by
+    # default because only plain register reads are safe to repeat: a failed FIFO read may have
+    # popped bytes already, and repeating it would misalign every sample after it
+    def __init__(self, transport, retries=0):
+        self.transport = transport
+        self.retries = retries
+        # handle -> DeviceStats, devices on the same address share their stats
+        self.handles = {}
+        # (bus, address) -> DeviceStats
+        self.devices = {}
+        # (bus, address) -> name
+        self.names = {}
+        # (bus, address, register) -> offset into the data where the stale comparison starts
+        self.watched = {}
+        # (handle, register) -> last data read
+        self.last_data = {}
+        # pigpio raises pigpio.error rather than IOError
+        try:
+            import pigpio
+            self.errors = (IOError, OSError, pigpio.error)
+        except ImportError:
+            self.errors = (IOError, OSError)
+
+    # gives a device a readable name in the statistics, e.g. 'mpu6050'
+    def name_device(self, bus, address, name):
+        self.names[(bus, address)] = name
+        if (bus, address) in self.devices:
+            self.devices[(bus, address)].name = name
+
+    # counts block reads of register on the device that return the same data as the previous
+    # read as stale; start skips leading status bytes that change even when the data does not
+    def watch_stale(self, bus, address, register, start=0):
+        self.watched[(bus, address, register)] = start
+
+    def stats(self, bus, address):
+        key = (bus, address)
+        if key not in self.devices:
+            self.devices[key] = DeviceStats(self.names.get(key, '{0}-0x{1:02X}'.format(bus, address)))
+        return self.devices[key]
+
+    # every device's summary keyed by name
+    def statistics(self):
+        return dict((stats.name, stats.summary()) for stats in self.devices.values())
+
+    def reset_statistics(self):
+        for stats in self.devices.values():
+            stats.reset()
+
+    # runs one transaction with timing, retries and error classification
+    def call(self, handle, function, *args):
+        stats = self.handles[handle][0]
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                result = function(handle, *args)
+            except self.errors as e:
+                stats.record(time.perf_counter() - start)
+                stats.error_count += 1
+                if is_nack(e):
+                    stats.nack_count += 1
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                stats.retry_count += 1
+                continue
+            stats.record(time.perf_counter() - start)
+            return result
+
+    def i2c_open(self, bus, address, flags=0):
+        handle = self.transport.i2c_open(bus, address, flags)
+        self.handles[handle] = (self.stats(bus, address), bus, address)
+        return handle
+
+    def i2c_close(self, handle):
+        self.transport.i2c_close(handle)
+        del self.handles[handle]
+
+    def i2c_read_byte_data(self, handle, register):
+        value = self.call(handle, self.transport.i2c_read_byte_data, register)
+        self.handles[handle][0].bytes_read += 1
+        return value
+
+    def i2c_write_byte_data(self, handle, register, value):
+        self.call(handle, self.transport.i2c_write_byte_data, register, value)
+
+    def i2c_read_i2c_block_data(self, handle, register, count):
+        result = self.call(handle, self.transport.i2c_read_i2c_block_data, register, count)
+        stats, bus, address = self.handles[handle]
+        if result[0] > 0:
+            stats.bytes_read += result[0]
+        start = self.watched.get((bus, address, register))
+        if start is not None:
+            data = bytes(result[1][start:])
+            if self.last_data.get((handle, register)) == data:
+                stats.stale_count += 1
+            self.last_data[(handle, register)] = data
+        return result
+
+    def i2c_write_i2c_block_data(self, handle, register, data):
+        self.call(handle, self.transport.i2c_write_i2c_block_data, register, data)
+
+    # a zip is counted against the device it was issued on, even if it addresses others too
+    def i2c_zip(self, handle, data):
+        result = self.call(handle, self.transport.i2c_zip, data)
+        if result[0] > 0:
+            self.handles[handle][0].bytes_read += result[0]
+        return result
+
+    def get_current_tick(self):
+        return self.transport.get_current_tick()
+
+
+# prints one line per device
+def print_statistics(transport):
+    for name, summary in sorted(transport.statistics().items()):
+        print("{0:>10}: {1:7d} transactions, mean {2:7.1f} us, p99 < {3:7.0f} us, max {4:7.1f} us, "
+              "{5} errors ({6} NACK), {7} retries, {8} stale".format(
+                  name, summary['count'], summary['mean_us'], summary['p99_us'], summary['max_us'],
+                  summary['errors'], summary['nacks'], summary['retries'], summary['stale']))
+
+
+if __name__ == "__main__":
+    from sim_devices import sim_transport, RotatingTrajectory
+    from mpu6050 import read_sample, GYRO_CONFIG
+    from ak8963 import setup_ak8963, read_mag
+
+    # overhead of the instrumentation itself on top of a zero latency simulated bus
+    raw = sim_transport(RotatingTrajectory())
+    bus = InstrumentedTransport(sim_transport(RotatingTrajectory()))
+    for transport in (raw, bus):
+        handle = transport.i2c_open(1, 0x68, 0)
+        start = time.perf_counter()
+        for i in range(5000):
+            read_sample(transport, handle)
+        print("{0:>12}: {1:.1f} us per sample read".format(type(transport).__name__,
+                                                          (time.perf_counter() - start) / 5000 * 1e6))
+
+    bus.name_device(1, 0x68, 'mpu6050')
+    bus.name_device(1, 0x0C, 'ak8963')
+    bus.watch_stale(1, 0x0C, 0x02, start=1)
+    handle = bus.i2c_open(1, 0x68, 0)
+    bus.i2c_write_byte_data(handle, GYRO_CONFIG, 0x08)
+    ak8963_handle = setup_ak8963(bus, handle)
+    # reading the magnetometer at 1 kHz shows up as mostly stale samples
+    for i in range(500):
+        read_sample(bus, handle)
+        read_mag(bus, ak8963_handle)
+        time.sleep(0.001)
+    print_statistics(bus)
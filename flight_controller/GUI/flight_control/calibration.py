@@ -0,0 +1,285 @@
+import json
+import os
+import time
+import numpy as np
+
+# bump whenever the stored fields change meaning, older files are then ignored
+CALIBRATION_VERSION = 1
+
+DEFAULT_CALIBRATION_PATH = os.path.join(os.path.expanduser('~'), '.flight_control', 'calibration.json')
+
+
+# everything measured about one sensor, so it does not have to be measured again on every start
+class SensorCalibration(object):
+    def __init__(self, who_am_i, user_id, temperature=None, acc_offsets=None, gyro_offsets=None,
+                 acc_scale=None, gyro_scale=None, mag_offset=None, mag_matrix=None,
+                 mounting_quaternion=None, statistics=None, timestamp=None, thermal_bias=None):
+        # WHO_AM_I register value and a user chosen name for the board
+        self.who_am_i = who_am_i
+        self.user_id = user_id
+        # die temperature in degrees Celsius while calibrating
+        self.temperature = temperature
+        # biases in G's and deg/s
+        self.acc_offsets = np.zeros(3) if acc_offsets is None else np.asarray(acc_offsets, dtype=float)
+        self.gyro_offsets = np.zeros(3) if gyro_offsets is None else np.asarray(gyro_offsets, dtype=float)
+        # per axis scale factors
+        self.acc_scale = np.ones(3) if acc_scale is None else np.asarray(acc_scale, dtype=float)
+        self.gyro_scale = np.ones(3) if gyro_scale is None else np.asarray(gyro_scale, dtype=float)
+        # magnetometer hard iron offset and soft iron correction, corrected = mag_matrix (raw - mag_offset)
+        self.mag_offset = np.zeros(3) if mag_offset is None else np.asarray(mag_offset, dtype=float)
+        self.mag_matrix = np.identity(3) if mag_matrix is None else np.asarray(mag_matrix, dtype=float)
+        # rotation from the sensor frame to the body frame (q_static in the flight scripts)
+        self.mounting_quaternion = np.array([1.0, 0.0, 0.0, 0.0]) if mounting_quaternion is None \
+            else np.asarray(mounting_quaternion, dtype=float)
+        # sample statistics of the calibration run, e.g. sample count and standard deviations
+        self.statistics = {} if statistics is None else statistics
+        self.timestamp = time.time() if timestamp is None else timestamp
+        # ThermalBiasModel, None if the sensor was only calibrated at one temperature
+        self.thermal_bias = thermal_bias
+
+    # key identifying the sensor in the store
+    @property
+    def sensor_id(self):
+        return sensor_id(self.who_am_i, self.user_id)
+
+    # seconds since the calibration was made
+    def age(self):
+        return time.time() - self.timestamp
+
+    # True if the calibration is recent enough and was made at a similar temperature
+    def is_fresh(self, temperature=None, max_age=7 * 24 * 3600, max_temperature_delta=10.0):
+        if max_age is not None and self.age() > max_age:
+            return False
+        if temperature is not None and self.temperature is not None and \
+                abs(temperature - self.temperature) > max_temperature_delta:
+            return False
+        return True
+
+    def to_dict(self):
+        return {'who_am_i': self.who_am_i,
+                'user_id': self.user_id,
+                'temperature': self.temperature,
+                'acc_offsets': self.acc_offsets.tolist(),
+                'gyro_offsets': self.gyro_offsets.tolist(),
+                'acc_scale': self.acc_scale.tolist(),
+                'gyro_scale': self.gyro_scale.tolist(),
+                'mag_offset': self.mag_offset.tolist(),
+                'mag_matrix': self.mag_matrix.tolist(),
+                'mounting_quaternion': self.mounting_quaternion.tolist(),
+                'statistics': self.statistics,
+                'timestamp': self.timestamp,
+                'thermal_bias': None if self.thermal_bias is None else self.thermal_bias.to_dict()}
+
+    @staticmethod
+    def from_dict(d):
+        return SensorCalibration(d['who_am_i'], d['user_id'], d.get('temperature'), d.get('acc_offsets'),
+                                 d.get('gyro_offsets'), d.get('acc_scale'), d.get('gyro_scale'),
+                                 d.get('mag_offset'), d.get('mag_matrix'), d.get('mounting_quaternion'),
+                                 d.get('statistics'), d.get('timestamp'),
+                                 None if d.get('thermal_bias') is None else ThermalBiasModel.from_dict(d['thermal_bias']))
+
+
+# key identifying a sensor by its WHO_AM_I value and a user chosen board name
+def sensor_id(who_am_i, user_id):
+    return '{0}-0x{1:02X}'.format(user_id, who_am_i)
+
+
+# a versioned JSON file holding the calibration of every known sensor
+class CalibrationStore(object):
+    def __init__(self, path=DEFAULT_CALIBRATION_PATH):
+        self.path = path
+
+    # returns {sensor_id: SensorCalibration}, empty if the file is missing or from another version
+    def load_all(self):
+        try:
+            with open(self.path, 'r') as f:
+                contents = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if contents.get('version') != CALIBRATION_VERSION:
+            return {}
+        return {key: SensorCalibration.from_dict(value) for key, value in contents.get('sensors', {}).items()}
+
+    # returns the stored calibration for the sensor, or None
+    def load(self, who_am_i, user_id):
+        return self.load_all().get(sensor_id(who_am_i, user_id))
+
+    # adds or replaces the calibration of one sensor
+    def save(self, calibration):
+        calibrations = self.load_all()
+        calibrations[calibration.sensor_id] = calibration
+        contents = {'version': CALIBRATION_VERSION,
+                    'sensors': {key: value.to_dict() for key, value in calibrations.items()}}
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # write to a temporary file first so a crash never leaves half a file behind
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(contents, f, indent=2)
+        os.replace(temp_path, self.path)
+
+
+# per axis mean, variance and outlier rejected mean of an (N, 3) array of samples
+# samples further than k scaled median absolute deviations from the median are rejected
+def robust_statistics(samples, k=3.0):
+    samples = np.asarray(samples, dtype=float)
+    mean = samples.mean(axis=0)
+    variance = samples.var(axis=0)
+    median = np.median(samples, axis=0)
+    # 1.4826 scales the MAD to the standard deviation of normally distributed data
+    mad = 1.4826 * np.median(np.abs(samples - median), axis=0)
+    inliers = np.abs(samples - median) <= k * np.maximum(mad, 1e-12)
+    bias = np.where(inliers, samples, 0.0).sum(axis=0) / np.maximum(inliers.sum(axis=0), 1)
+    return mean, variance, bias, inliers.mean(axis=0)
+
+
+# overlapping Allan deviation of an (N, 3) array sampled at sample_rate Hz
+# returns the averaging times in seconds and an (len(taus), 3) array of deviations
+def allan_deviation(samples, sample_rate, points=30):
+    samples = np.asarray(samples, dtype=float)
+    n = samples.shape[0]
+    # cluster sizes spaced logarithmically from one sample up to a third of the record
+    m = np.unique(np.logspace(0, np.log10(max(n // 3, 1)), points).astype(int))
+    taus = m / sample_rate
+
+    # integrated signal, one row longer than the samples
+    theta = np.vstack((np.zeros((1, samples.shape[1])), np.cumsum(samples, axis=0))) / sample_rate
+
+    adev = np.empty((m.size, samples.shape[1]))
+    for i, mi in enumerate(m):
+        d = theta[2 * mi:] - 2 * theta[mi:-mi] + theta[:-2 * mi]
+        adev[i] = np.sqrt(np.mean(d * d, axis=0) / (2 * taus[i] ** 2))
+    return taus, adev
+
+
+# noise figures of a stationary IMU recording, and the filter covariances derived from them
+class NoiseCalibration(object):
+    def __init__(self, accel, gyro, sample_rate, mag=None, yaw_variance=0.4489 * 4):
+        self.sample_rate = sample_rate
+        self.sample_count = accel.shape[0]
+
+        # accel in G's, gyro in deg/s
+        self.acc_mean, self.acc_variance, self.acc_bias, self.acc_inlier_ratio = robust_statistics(accel)
+        self.gyro_mean, self.gyro_variance, self.gyro_bias, self.gyro_inlier_ratio = robust_statistics(gyro)
+        self.acc_taus, self.acc_adev = allan_deviation(accel, sample_rate)
+        self.gyro_taus, self.gyro_adev = allan_deviation(gyro, sample_rate)
+
+        # yaw noise comes from the magnetometer when it was recorded too
+        if mag is not None:
+            mag_mean, mag_variance, mag_bias, mag_inlier_ratio = robust_statistics(mag)
+            yaw_variance = np.sum(mag_variance[0:2]) / np.sum(mag_mean[0:2] ** 2)
+        self.yaw_variance = yaw_variance
+
+    # gyro noise covariance in (rad/s)^2, the GyroCov of the Kalman filter
+    def gyro_covariance(self):
+        return np.diag(self.gyro_variance * (np.pi / 180) ** 2)
+
+    # covariance of the accel/mag quaternion measurement, the R of the Kalman filter
+    # small angle approximation: each vector component is half the angle error, and the
+    # scalar part is bounded by the combined error
+    def measurement_covariance(self):
+        g = np.linalg.norm(self.acc_mean)
+        roll_variance = self.acc_variance[1] / g ** 2
+        pitch_variance = self.acc_variance[0] / g ** 2
+        angle_variance = np.array([roll_variance + pitch_variance + self.yaw_variance,
+                                   roll_variance, pitch_variance, self.yaw_variance])
+        return np.diag(angle_variance / 4)
+
+    # statistics in a form that can be kept in a SensorCalibration
+    def to_statistics(self):
+        return {'samples': int(self.sample_count),
+                'sample_rate': self.sample_rate,
+                'acc_std': np.sqrt(self.acc_variance).tolist(),
+                'gyro_std': np.sqrt(self.gyro_variance).tolist(),
+                'acc_inlier_ratio': self.acc_inlier_ratio.tolist(),
+                'gyro_inlier_ratio': self.gyro_inlier_ratio.tolist(),
+                'acc_allan': {'taus': self.acc_taus.tolist(), 'adev': self.acc_adev.tolist()},
+                'gyro_allan': {'taus': self.gyro_taus.tolist(), 'adev': self.gyro_adev.tolist()}}
+
+
+# least squares ellipsoid fit of (N, 3) magnetometer samples taken while rotating the vehicle
+# returns (offset, matrix) such that matrix.dot(raw - offset) lies on a sphere whose radius is
+# the geometric mean of the fitted ellipsoid radii, removing hard and soft iron distortion
+def fit_ellipsoid(samples):
+    samples = np.asarray(samples, dtype=float)
+    x = samples[:, 0]
+    y = samples[:, 1]
+    z = samples[:, 2]
+
+    # a x^2 + b y^2 + c z^2 + 2d xy + 2e xz + 2f yz + 2g x + 2h y + 2i z = 1
+    design = np.column_stack((x * x, y * y, z * z, 2 * x * y, 2 * x * z, 2 * y * z, 2 * x, 2 * y, 2 * z))
+    p = np.linalg.lstsq(design, np.ones(samples.shape[0]), rcond=None)[0]
+
+    quadric = np.array([[p[0], p[3], p[4]],
+                        [p[3], p[1], p[5]],
+                        [p[4], p[5], p[2]]])
+    offset = -np.linalg.solve(quadric, p[6:9])
+
+    # (raw - offset)^T shape (raw - offset) = 1
+    shape = quadric / (1 + offset.dot(quadric).dot(offset))
+    eigenvalues, eigenvectors = np.linalg.eigh(shape)
+    if np.any(eigenvalues <= 0):
+        raise ValueError('Magnetometer samples do not describe an ellipsoid, rotate through more orientations')
+
+    radii = 1 / np.sqrt(eigenvalues)
+    radius = np.prod(radii) ** (1 / 3)
+    matrix = eigenvectors.dot(np.diag(np.sqrt(eigenvalues) * radius)).dot(eigenvectors.T)
+    return offset, matrix
+
+
+# combines the fit into one affine map, corrected = A.dot(raw) - b, evaluated once per sample
+def mag_affine(offset, matrix):
+    return matrix, matrix.dot(offset)
+
+
+# accel and gyro offsets as a function of die temperature
+# a low order polynomial is fitted per axis and tabulated, so that the runtime lookup is an
+# index computation and one linear interpolation between two table rows
+class ThermalBiasModel(object):
+    def __init__(self, temperature_min, temperature_step, table):
+        self.temperature_min = temperature_min
+        self.temperature_step = temperature_step
+        # (K, 6) table of accel offsets in G's followed by gyro offsets in deg/s
+        self.table = np.asarray(table, dtype=float)
+        self.last_index = self.table.shape[0] - 1
+
+    # fits the model to offsets recorded at different temperatures
+    # temperatures is (N,), acc_offsets and gyro_offsets are (N, 3)
+    @staticmethod
+    def fit(temperatures, acc_offsets, gyro_offsets, order=2, temperature_step=0.5):
+        temperatures = np.asarray(temperatures, dtype=float)
+        offsets = np.hstack((acc_offsets, gyro_offsets))
+        # a polynomial of higher order than the temperature spread supports would be noise
+        order = min(order, len(np.unique(np.round(temperatures / temperature_step))) - 1)
+        coefficients = np.polyfit(temperatures, offsets, max(order, 0))
+
+        temperature_min = np.floor(temperatures.min() / temperature_step) * temperature_step
+        temperature_max = np.ceil(temperatures.max() / temperature_step) * temperature_step
+        grid = np.arange(temperature_min, temperature_max + temperature_step / 2, temperature_step)
+        # evaluate every axis at every grid temperature at once
+        powers = np.vander(grid, coefficients.shape[0])
+        return ThermalBiasModel(temperature_min, temperature_step, powers.dot(coefficients))
+
+    # returns (acc_offsets, gyro_offsets) at the given temperature, held constant outside the fitted range
+    def offsets(self, temperature):
+        x = (temperature - self.temperature_min) / self.temperature_step
+        if x <= 0:
+            row = self.table[0]
+        elif x >= self.last_index:
+            row = self.table[self.last_index]
+        else:
+            i = int(x)
+            f = x - i
+            row = self.table[i] + f * (self.table[i + 1] - self.table[i])
+        return row[0:3], row[3:6]
+
+    def to_dict(self):
+        return {'temperature_min': self.temperature_min,
+                'temperature_step': self.temperature_step,
+                'table': self.table.tolist()}
+
+    @staticmethod
+    def from_dict(d):
+        return ThermalBiasModel(d['temperature_min'], d['temperature_step'], d['table'])
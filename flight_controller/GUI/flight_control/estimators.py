@@ -0,0 +1,360 @@
+import math
+import time
+import numpy as np
+
+# Attitude estimators the IMU can run on every sample. Each one takes the specific force in
+# G's (+1 G on z when level) and the body rates in deg/s, costs a fixed number of scalar
+# operations per sample, and returns [roll, pitch] in degrees.
+# The quaternion estimators keep the body to world attitude (w, x, y, z), so roll and pitch
+# have the same signs as the complementary filter: roll follows +y acceleration and +x rate,
+# pitch follows -x acceleration and +y rate.
+
+DEG = math.pi / 180
+
+# update_batch runs the accelerometer correction once per batch, with the gyro already integrated
+ZERO_RATE = np.zeros(3)
+
+
+# roll and pitch in degrees of a body to world quaternion
+def quaternion_to_roll_pitch(q0, q1, q2, q3):
+    roll = math.atan2(q0 * q1 + q2 * q3, 0.5 - q1 * q1 - q2 * q2)
+    pitch = math.asin(max(-1.0, min(1.0, 2 * (q0 * q2 - q3 * q1))))
+    return np.array([roll / DEG, pitch / DEG])
+
+
+# the smallest rotation that tilts world up onto the measured specific force, yaw 0
+def quaternion_from_accel(ax, ay, az):
+    norm = math.sqrt(ax * ax + ay * ay + az * az)
+    if norm == 0:
+        return 1.0, 0.0, 0.0, 0.0
+    ax, ay, az = ax / norm, ay / norm, az / norm
+    if az >= 0:
+        s = math.sqrt(2 * (1 + az))
+        return 0.5 * s, ay / s, -ax / s, 0.0
+    s = math.sqrt(2 * (1 - az))
+    return ay / s, 0.5 * s, 0.0, -ax / s
+
+
+# seconds between samples from pigpio ticks in microseconds, which wrap at 2^32
+# previous_tick is the last tick of the previous batch, without it the first dt is 0
+def tick_dt(ticks, previous_tick=None):
+    ticks = np.asarray(ticks, dtype=np.float64)
+    start = ticks[0] if previous_tick is None else previous_tick
+    return np.diff(ticks, prepend=start) % 2 ** 32 / 1e6
+
+
+# batches at least this long have their rotations computed with numpy, shorter ones in a scalar
+# loop, which is faster until the fixed cost of the numpy calls is spread over enough samples
+VECTORIZE_MIN = 32
+
+
+# rotates the body to world quaternion q by every gyro sample of a batch, each with its own dt
+# gyro is (N,3) in deg/s and dt (N,) in seconds. Every sample is an exact rotation about its
+# rate vector; with coning each rotation vector is corrected by 1/12 of its cross product with
+# the previous one, for the motion between samples that the single rates miss.
+def integrate_gyro(q, gyro, dt, coning=False):
+    q0, q1, q2, q3 = q
+    if len(dt) >= VECTORIZE_MIN:
+        theta = np.asarray(gyro, dtype=np.float64) * (DEG * np.asarray(dt, dtype=np.float64))[:, None]
+        if coning:
+            a, b = theta[:-1], theta[1:]
+            theta[1:] += np.stack((a[:, 1] * b[:, 2] - a[:, 2] * b[:, 1],
+                                   a[:, 2] * b[:, 0] - a[:, 0] * b[:, 2],
+                                   a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]), axis=1) / 12
+        angle = np.sqrt(np.einsum('ij,ij->i', theta, theta))
+        rotations = np.empty((len(theta), 4))
+        rotations[:, 0] = np.cos(0.5 * angle)
+        # theta is 0 wherever the angle is, so the clamp only avoids dividing by 0
+        rotations[:, 1:] = theta * (np.sin(0.5 * angle) / np.maximum(angle, 1e-300))[:, None]
+        for r0, r1, r2, r3 in rotations.tolist():
+            q0, q1, q2, q3 = (q0 * r0 - q1 * r1 - q2 * r2 - q3 * r3,
+                              q0 * r1 + q1 * r0 + q2 * r3 - q3 * r2,
+                              q0 * r2 - q1 * r3 + q2 * r0 + q3 * r1,
+                              q0 * r3 + q1 * r2 - q2 * r1 + q3 * r0)
+    else:
+        # previous rotation vector, for the coning correction
+        px, py, pz = 0.0, 0.0, 0.0
+        for (gx, gy, gz), step in zip(np.asarray(gyro).tolist(), np.asarray(dt).tolist()):
+            k = DEG * step
+            x, y, z = gx * k, gy * k, gz * k
+            if coning:
+                x, y, z, px, py, pz = (x + (py * z - pz * y) / 12, y + (pz * x - px * z) / 12,
+                                       z + (px * y - py * x) / 12, x, y, z)
+            angle = math.sqrt(x * x + y * y + z * z)
+            r0 = math.cos(0.5 * angle)
+            k = math.sin(0.5 * angle) / angle if angle > 0 else 0.0
+            r1, r2, r3 = x * k, y * k, z * k
+            q0, q1, q2, q3 = (q0 * r0 - q1 * r1 - q2 * r2 - q3 * r3,
+                              q0 * r1 + q1 * r0 + q2 * r3 - q3 * r2,
+                              q0 * r2 - q1 * r3 + q2 * r0 + q3 * r1,
+                              q0 * r3 + q1 * r2 - q2 * r1 + q3 * r0)
+    norm = 1 / math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+    return q0 * norm, q1 * norm, q2 * norm, q3 * norm
+
+
+# the original complementary filter on roll and pitch, alpha is the weight of the gyro
+class ComplementaryFilter(object):
+    def __init__(self, alpha=0.98):
+        self.alpha = alpha
+        self.roll = 0.0
+        self.pitch = 0.0
+
+    def reset(self):
+        self.roll = 0.0
+        self.pitch = 0.0
+
+    def update(self, accel, gyro, dt):
+        ax, ay, az = accel.tolist()
+        gx, gy, gz = gyro.tolist()
+        roll_acc = math.atan2(ay, math.sqrt(ax * ax + az * az)) / DEG
+        pitch_acc = -math.atan2(ax, math.sqrt(ay * ay + az * az)) / DEG
+        alpha = self.alpha
+        self.roll = alpha * (self.roll + dt * gx) + (1 - alpha) * roll_acc
+        self.pitch = alpha * (self.pitch + dt * gy) + (1 - alpha) * pitch_acc
+        return np.array([self.roll, self.pitch])
+
+    # a batch of N samples: the gyro is summed over every dt and blended with the angles of
+    # the mean acceleration at alpha^N, the weight N single updates give it
+    # the angles are integrated directly, so there is nothing for coning to correct
+    def update_batch(self, accel, gyro, dt, coning=False):
+        ax, ay, az = np.mean(accel, axis=0).tolist()
+        gx, gy, gz = np.dot(dt, gyro).tolist()
+        roll_acc = math.atan2(ay, math.sqrt(ax * ax + az * az)) / DEG
+        pitch_acc = -math.atan2(ax, math.sqrt(ay * ay + az * az)) / DEG
+        alpha = self.alpha ** len(dt)
+        self.roll = alpha * (self.roll + gx) + (1 - alpha) * roll_acc
+        self.pitch = alpha * (self.pitch + gy) + (1 - alpha) * pitch_acc
+        return np.array([self.roll, self.pitch])
+
+
+# Madgwick's gradient descent filter, IMU form: the gyro rate is corrected by beta (rad/s)
+# along the gradient of the error between the measured and the predicted gravity direction
+class MadgwickFilter(object):
+    def __init__(self, beta=0.1):
+        self.beta = beta
+        self.reset()
+
+    def reset(self):
+        self.q = None
+
+    def update(self, accel, gyro, dt):
+        ax, ay, az = accel.tolist()
+        gx, gy, gz = gyro.tolist()
+        if self.q is None:
+            self.q = quaternion_from_accel(ax, ay, az)
+        q0, q1, q2, q3 = self.q
+        gx, gy, gz = gx * DEG, gy * DEG, gz * DEG
+
+        # rate of change of the quaternion from the gyro
+        qdot0 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz)
+        qdot1 = 0.5 * (q0 * gx + q2 * gz - q3 * gy)
+        qdot2 = 0.5 * (q0 * gy - q1 * gz + q3 * gx)
+        qdot3 = 0.5 * (q0 * gz + q1 * gy - q2 * gx)
+
+        norm = math.sqrt(ax * ax + ay * ay + az * az)
+        if norm > 0:
+            ax, ay, az = ax / norm, ay / norm, az / norm
+            # gradient of the gravity error, J'f
+            s0 = 4 * q0 * q2 * q2 + 2 * q2 * ax + 4 * q0 * q1 * q1 - 2 * q1 * ay
+            s1 = (4 * q1 * q3 * q3 - 2 * q3 * ax + 4 * q0 * q0 * q1 - 2 * q0 * ay - 4 * q1
+                  + 8 * q1 * q1 * q1 + 8 * q1 * q2 * q2 + 4 * q1 * az)
+            s2 = (4 * q0 * q0 * q2 + 2 * q0 * ax + 4 * q2 * q3 * q3 - 2 * q3 * ay - 4 * q2
+                  + 8 * q2 * q1 * q1 + 8 * q2 * q2 * q2 + 4 * q2 * az)
+            s3 = 4 * q1 * q1 * q3 - 2 * q1 * ax + 4 * q2 * q2 * q3 - 2 * q2 * ay
+            norm = math.sqrt(s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3)
+            if norm > 0:
+                k = self.beta / norm
+                qdot0 -= k * s0
+                qdot1 -= k * s1
+                qdot2 -= k * s2
+                qdot3 -= k * s3
+
+        q0 += qdot0 * dt
+        q1 += qdot1 * dt
+        q2 += qdot2 * dt
+        q3 += qdot3 * dt
+        norm = 1 / math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+        self.q = (q0 * norm, q1 * norm, q2 * norm, q3 * norm)
+        return quaternion_to_roll_pitch(*self.q)
+
+    # a batch of N samples, accel (N,3) in G's, gyro (N,3) in deg/s and dt (N,) in seconds:
+    # the gyro is integrated at the full sensor rate, then the mean acceleration corrects
+    # the attitude once over the whole batch
+    def update_batch(self, accel, gyro, dt, coning=False):
+        if self.q is None:
+            self.q = quaternion_from_accel(*np.mean(accel, axis=0).tolist())
+        self.q = integrate_gyro(self.q, gyro, dt, coning)
+        return self.update(np.mean(accel, axis=0), ZERO_RATE, float(np.sum(dt)))
+
+
+# Mahony's nonlinear complementary filter, IMU form: the cross product of the measured and the
+# predicted gravity direction is fed back into the gyro rate through a PI controller
+class MahonyFilter(object):
+    def __init__(self, kp=0.5, ki=0.0):
+        self.kp = kp
+        self.ki = ki
+        self.reset()
+
+    def reset(self):
+        self.q = None
+        # integral of the error, the gyro bias estimate in rad/s
+        self.integral = (0.0, 0.0, 0.0)
+
+    def update(self, accel, gyro, dt):
+        ax, ay, az = accel.tolist()
+        gx, gy, gz = gyro.tolist()
+        if self.q is None:
+            self.q = quaternion_from_accel(ax, ay, az)
+        q0, q1, q2, q3 = self.q
+        gx, gy, gz = gx * DEG, gy * DEG, gz * DEG
+
+        norm = math.sqrt(ax * ax + ay * ay + az * az)
+        if norm > 0:
+            ax, ay, az = ax / norm, ay / norm, az / norm
+            # predicted gravity direction, the last row of the rotation matrix
+            vx = 2 * (q1 * q3 - q0 * q2)
+            vy = 2 * (q0 * q1 + q2 * q3)
+            vz = q0 * q0 - q1 * q1 - q2 * q2 + q3 * q3
+            ex = ay * vz - az * vy
+            ey = az * vx - ax * vz
+            ez = ax * vy - ay * vx
+            if self.ki > 0:
+                ix, iy, iz = self.integral
+                k = self.ki * dt
+                self.integral = (ix + k * ex, iy + k * ey, iz + k * ez)
+                gx, gy, gz = gx + self.integral[0], gy + self.integral[1], gz + self.integral[2]
+            gx, gy, gz = gx + self.kp * ex, gy + self.kp * ey, gz + self.kp * ez
+
+        gx, gy, gz = 0.5 * dt * gx, 0.5 * dt * gy, 0.5 * dt * gz
+        q0, q1, q2, q3 = (q0 - q1 * gx - q2 * gy - q3 * gz,
+                          q1 + q0 * gx + q2 * gz - q3 * gy,
+                          q2 + q0 * gy - q1 * gz + q3 * gx,
+                          q3 + q0 * gz + q1 * gy - q2 * gx)
+        norm = 1 / math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+        self.q = (q0 * norm, q1 * norm, q2 * norm, q3 * norm)
+        return quaternion_to_roll_pitch(*self.q)
+
+    # a batch of N samples, accel (N,3) in G's, gyro (N,3) in deg/s and dt (N,) in seconds:
+    # the gyro is integrated at the full sensor rate, then the mean acceleration corrects
+    # the attitude once over the whole batch
+    def update_batch(self, accel, gyro, dt, coning=False):
+        if self.q is None:
+            self.q = quaternion_from_accel(*np.mean(accel, axis=0).tolist())
+        self.q = integrate_gyro(self.q, gyro, dt, coning)
+        return self.update(np.mean(accel, axis=0), ZERO_RATE, float(np.sum(dt)))
+
+
+ESTIMATORS = {'complementary': ComplementaryFilter,
+              'madgwick': MadgwickFilter,
+              'mahony': MahonyFilter}
+
+
+# builds an estimator by name, e.g. make_estimator('mahony', kp=1.0, ki=0.02)
+def make_estimator(name, **parameters):
+    if name not in ESTIMATORS:
+        raise ValueError('Unknown attitude estimator {0!r}, expected one of {1}'.format(name, sorted(ESTIMATORS)))
+    return ESTIMATORS[name](**parameters)
+
+
+# runs every estimator over the same samples, returns name -> (angles, seconds per update)
+# with batch > 1 the samples are passed to update_batch batch at a time, as a control loop
+# running batch times slower than the sensor would, and every sample of a batch gets its result
+def compare_estimators(estimators, ticks, accel, gyro, batch=1, coning=False):
+    dt = np.diff(ticks, prepend=ticks[0])
+    results = {}
+    for name, estimator in estimators.items():
+        estimator.reset()
+        angles = np.empty((len(ticks), 2))
+        start = time.perf_counter()
+        if batch > 1:
+            for i in range(0, len(ticks), batch):
+                angles[i:i + batch] = estimator.update_batch(accel[i:i + batch], gyro[i:i + batch],
+                                                             dt[i:i + batch], coning)
+            updates = -(-len(ticks) // batch)
+        else:
+            for i in range(len(ticks)):
+                angles[i] = estimator.update(accel[i], gyro[i], dt[i])
+            updates = len(ticks)
+        results[name] = (angles, (time.perf_counter() - start) / updates)
+    return results
+
+
+# a simulated 1 kHz recording of the vehicle rocking about roll and pitch, with noise and a
+# constant gyro bias, returns (ticks in s, accel in G's, gyro in deg/s, true [roll, pitch])
+def simulated_recording(duration=20.0, rate=1000.0, seed=1):
+    from sim_devices import rotate_inverse
+
+    rng = np.random.default_rng(seed)
+    count = int(duration * rate)
+    ticks = np.arange(count) / rate
+    gyro = np.column_stack((40 * np.sin(2 * np.pi * 0.5 * ticks),
+                            30 * np.cos(2 * np.pi * 0.3 * ticks),
+                            10 * np.sin(2 * np.pi * 0.1 * ticks)))
+    accel = np.empty((count, 3))
+    truth = np.empty((count, 2))
+    q = np.array([1.0, 0.0, 0.0, 0.0])
+    for i in range(count):
+        accel[i] = rotate_inverse(q, np.array([0.0, 0.0, 1.0]))
+        truth[i] = quaternion_to_roll_pitch(*q)
+        # exact rotation over one sample
+        w = gyro[i] * DEG / rate
+        angle = np.linalg.norm(w)
+        if angle > 0:
+            dq = np.concatenate(([math.cos(angle / 2)], math.sin(angle / 2) * w / angle))
+            q = np.array([q[0] * dq[0] - q[1] * dq[1] - q[2] * dq[2] - q[3] * dq[3],
+                          q[0] * dq[1] + q[1] * dq[0] + q[2] * dq[3] - q[3] * dq[2],
+                          q[0] * dq[2] - q[1] * dq[3] + q[2] * dq[0] + q[3] * dq[1],
+                          q[0] * dq[3] + q[1] * dq[2] - q[2] * dq[1] + q[3] * dq[0]])
+    accel += 0.02 * rng.standard_normal(accel.shape)
+    gyro = gyro + np.array([0.5, -0.3, 0.2]) + 0.1 * rng.standard_normal(gyro.shape)
+    return ticks, accel, gyro, truth
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python estimators.py [samples.npy]
+    # compares the estimators on a recording, either the simulated one or a saved FIFO or ring
+    # batch (any structured array with tick, accel and gyro fields, accel already offset corrected)
+    if len(sys.argv) > 1:
+        samples = np.load(sys.argv[1])
+        ticks = np.cumsum(np.diff(samples['tick'], prepend=samples['tick'][0]) % 2 ** 32) / 1e6
+        accel, gyro, truth = samples['accel'], samples['gyro'], None
+    else:
+        ticks, accel, gyro, truth = simulated_recording()
+
+    estimators = {'complementary': ComplementaryFilter(0.98),
+                  'madgwick': MadgwickFilter(0.1),
+                  'mahony': MahonyFilter(0.5),
+                  'mahony+ki': MahonyFilter(0.5, 0.05)}
+    # the first seconds are convergence from the initial attitude
+    settled = ticks >= ticks[0] + 2.0
+    reference = None
+    # every sample, a 10x slower loop integrating every sample, and the same loop keeping only
+    # the newest sample of each batch as calculate_angles used to
+    for title, batch, coning, newest_only in (('every sample', 1, False, False),
+                                              ('batches of 10', 10, False, False),
+                                              ('batches of 10, coning', 10, True, False),
+                                              ('newest of 10 only', 1, False, True)):
+        print(title)
+        if newest_only:
+            # one update per 10 ms control tick, scored at the sample it was computed from
+            rows = np.arange(9, len(ticks), 10)
+            results = compare_estimators(estimators, ticks[rows], accel[rows], gyro[rows])
+        else:
+            rows = np.arange(len(ticks))
+            results = compare_estimators(estimators, ticks, accel, gyro, batch, coning)
+        if reference is None:
+            reference = results['complementary'][0]
+        scored = settled[rows]
+        for name, (angles, seconds) in results.items():
+            # seconds is per update, one update per batch, or per 10 samples keeping the newest only
+            line = "{0:>14}: {1:6.2f} us per update, {2:6.2%} of a 1 kHz loop".format(
+                name, seconds * 1e6, seconds * 1000 / (10 if newest_only else batch))
+            if truth is not None:
+                error = np.sqrt(np.mean((angles[scored] - truth[rows[scored]]) ** 2, axis=0))
+                line += ", rms error roll {0:5.2f} deg pitch {1:5.2f} deg".format(error[0], error[1])
+            else:
+                spread = np.sqrt(np.mean((angles[scored] - reference[rows[scored]]) ** 2))
+                line += ", {0:5.2f} deg rms from the complementary filter".format(spread)
+            print(line)
@@ -3,7 +3,10 @@ import numpy as np
 from imu import *
 from motor import *
 from receiver import *
+from bus_stats import *
+from i2c_transport import PigpioTransport
 import threading
+import multiprocessing
 import time
 
 
@@ -13,8 +16,13 @@ class FlightController(object):
     # constructor for the flight control
     # initialize proportional gain, integral gain, derivative gain
     # boolean variable to determine if device is armed
+    # optional gpio pin wired to the IMU INT output to pace the loop by the sensor data rate
+    # optional calibration store to load the IMU offsets from instead of measuring them on every start
+    # optionally reads the sensors in a separate acquisition process so slow I/O never stalls the control loop
+    # optionally times every IMU bus transaction, see bus_statistics
     def __init__(self, kp_gain=np.array, ki_gain=np.array, kd_gain=np.array, the_receiver=Receiver,
-                 the_imu=IMU, the_motor=Motor):
+                 the_imu=IMU, the_motor=Motor, imu_int_gpio=None, calibration_store=None,
+                 acquisition_process=False, bus_stats=False):
         self.Kp = kp_gain
         self.Ki = ki_gain
         self.Kd = kd_gain
@@ -22,9 +30,18 @@ class FlightController(object):
         self.imu = the_imu
         self.motor = the_motor
         self.armed = False
+        # set by the kill switch, blocks arming until the arm switch has been turned off
+        self.kill_latched = False
         self.pi = None
         self.pi_online = False
         self.motor_output = np.array([0.0,0.0,0.0,0.0])
+        self.IMU_INT_GPIO = imu_int_gpio
+        self.calibration_store = calibration_store
+        self.acquisition_process = acquisition_process
+        self.ring = None
+        self.acquisition = None
+        self.acquisition_stop = None
+        self.bus_stats = bus_stats
 
     # getter for armed status
     @property
@@ -109,13 +126,21 @@ class FlightController(object):
         return passed
 
     # TODO: kill switch. May want separate methods for immediate and safe landing
-    # kill switch for the vehicle
+    # kill switch for the vehicle, disarms and stops the motors
+    # receiver.ARM keeps following the arm switch, so the latch only clears once it is turned off
     def kill_switch(self):
-        self.receiver.ARM = False
+        self.kill_latched = True
+        self.armed = False
+        self.motor_output = np.array([1.0, 1.0, 1.0, 1.0])
+        self.motor.stop(self.pi)
 
     # Updates current PID
     def compute_PID(self):
 
+        # a disarmed vehicle stops the timer chain so nothing drives the motors
+        if self.armed is False:
+            return
+
         # begin the thread
         threading.Timer(self.imu.sample_time, self.compute_PID).start()
 
@@ -125,8 +150,13 @@ class FlightController(object):
         # Maps control input into angles
         control_angles = self.receiver.map_control_input()
 
-        # Calculate Euler angles
-        self.imu.calculate_angles(self.pi)
+        # Calculate Euler angles, disarming if the IMU stops responding
+        try:
+            self.imu.calculate_angles(self.pi)
+        except (IOError, pigpio.error) as e:
+            print("Lost IMU Connection:", e)
+            self.kill_switch()
+            return
 
         # Compute errors in pitch and roll and yaw rate
         # error = setpoint - input
@@ -164,6 +194,36 @@ class FlightController(object):
         end_time = self.pi.get_current_tick()
         self.imu.actual_time_length_of_PID_loop = (start_time - end_time) / 1e6
 
+    # starts the acquisition process writing IMU samples into a shared memory ring
+    def start_acquisition(self, capacity=1024):
+        self.ring = SampleRing(capacity)
+        self.acquisition_stop = multiprocessing.Event()
+        self.acquisition = multiprocessing.Process(target=run_acquisition,
+                                                   args=(self.ring.name, self.acquisition_stop,
+                                                         self.imu.MPU6050_ADDR, self.IMU_INT_GPIO))
+        self.acquisition.daemon = True
+        self.acquisition.start()
+        self.imu.attach_ring(self.ring)
+        print("IMU acquisition process started")
+
+    # stops the acquisition process and frees the ring
+    def stop_acquisition(self):
+        if self.acquisition is None:
+            return
+        self.acquisition_stop.set()
+        self.acquisition.join(1.0)
+        self.imu.ring = None
+        self.ring.close()
+        self.ring.unlink()
+        self.ring = None
+        self.acquisition = None
+
+    # per device bus counters, see bus_stats.DeviceStats.summary, empty unless bus_stats is enabled
+    def bus_statistics(self):
+        if isinstance(self.imu.i2c, InstrumentedTransport):
+            return self.imu.i2c.statistics()
+        return {}
+
     # run the flight controller
     def run(self):
         self.pi = pigpio.pi()
@@ -200,12 +260,29 @@ class FlightController(object):
         self.pi.set_PWM_frequency(self.motor.MOTOR4, self.motor.PWM_frequency)
         print("PWM frequency set to ", self.motor.PWM_frequency)
 
+        # route the IMU through a transport that records latency, errors and stale samples per device
+        if self.bus_stats:
+            bus = InstrumentedTransport(self.imu.i2c if self.imu.i2c is not None else PigpioTransport(self.pi))
+            bus.name_device(1, self.imu.MPU6050_ADDR, 'mpu6050')
+            bus.watch_stale(1, self.imu.MPU6050_ADDR, ACCEL_XOUT_H)
+            self.imu.i2c = bus
+
         # setup IMU
         self.imu.setupMPU6050(self.pi)
 
         # determine acceleration and gyroscopic offsets
-        self.imu.update_accelerometer_offsets(self.pi)
-        self.imu.update_gyroscope_offsets(self.pi)
+        if self.calibration_store is not None:
+            self.imu.load_or_update_offsets(self.pi, self.calibration_store)
+        else:
+            self.imu.update_accelerometer_offsets(self.pi)
+            self.imu.update_gyroscope_offsets(self.pi)
+
+        # read the sensors in their own process, the control loop takes samples from shared memory
+        if self.acquisition_process:
+            self.start_acquisition()
+        # wait on the data ready interrupt instead of spinning on the data registers
+        elif self.IMU_INT_GPIO is not None:
+            self.imu.enable_data_ready(self.pi, self.IMU_INT_GPIO)
 
         # machine loop
         while True:
@@ -217,11 +294,18 @@ class FlightController(object):
             # Motor.set_motor_pulse(self.pi, self.motor.MOTOR4, 1)
 
             while self.armed is False:
-                if self.receiver.ARM is True:
+                # the arm switch has to be turned off and on again after the kill switch
+                if self.receiver.ARM is False:
+                    self.kill_latched = False
+                if self.receiver.ARM is True and self.kill_latched is False:
                     # perform pre-flight checks
                     if self.pre_flight_checks():
                         self.motor.arm(self.pi)
+                        # start integrating from the first sample of the flight
+                        self.imu.restart_estimation(self.pi)
                         self.armed = True
+                else:
+                    time.sleep(0.01)
 
             # flight loop
             while self.receiver.ARM is True and self.armed is True:
@@ -0,0 +1,76 @@
+from mpu6050 import *
+from ak8963 import *
+from i2c_transport import ZIP_END, ZIP_ON, ZIP_OFF, ZIP_ADDRESS, ZIP_READ, ZIP_WRITE
+
+
+# a list of register block reads on one or more devices, issued together as a single pigpio i2c_zip
+class I2CReadBatch(object):
+    def __init__(self):
+        # (name, address, register, count)
+        self.reads = []
+        self.command = None
+        self.length = 0
+
+    # adds a read of count bytes starting at register of the device at address
+    def add(self, name, address, register, count):
+        self.reads.append((name, address, register, count))
+        self.command = None
+        return self
+
+    # builds the zip command sequence once, it is reused on every execute
+    def build(self):
+        command = bytearray([ZIP_ON])
+        for name, address, register, count in self.reads:
+            command += bytearray([ZIP_ADDRESS, address, ZIP_WRITE, 1, register, ZIP_READ, count])
+        command += bytearray([ZIP_OFF, ZIP_END])
+        self.command = command
+        self.length = sum(read[3] for read in self.reads)
+        return command
+
+    # runs every read in one daemon round trip, returns {name: bytearray}
+    # handle can be any device opened on the bus, the zip sets the address of each read
+    def execute(self, pi, handle):
+        if self.command is None:
+            self.build()
+        count, data = pi.i2c_zip(handle, self.command)
+        if count != self.length:
+            raise IOError('Batched I2C read returned {0} of {1} bytes'.format(count, self.length))
+        results = {}
+        offset = 0
+        for name, address, register, count in self.reads:
+            results[name] = data[offset:offset + count]
+            offset += count
+        return results
+
+
+# one loop's worth of accelerometer, temperature, gyroscope and magnetometer data
+class MotionSample(object):
+    def __init__(self, tick, accel, temperature, gyro, mag, mag_ready, mag_overflow):
+        self.tick = tick
+        # acceleration in G's
+        self.accel = accel
+        # die temperature in degrees Celsius
+        self.temperature = temperature
+        # angular rate in degrees per second
+        self.gyro = gyro
+        # raw AK8963 field counts
+        self.mag = mag
+        # the AK8963 had new data, and the field did not overflow the sensor
+        self.mag_ready = mag_ready
+        self.mag_overflow = mag_overflow
+
+
+# reads the MPU6050 data block and the AK8963 status and data registers in one i2c_zip
+class MotionReader(object):
+    def __init__(self, mpu6050_addr=0x68, ak8963_addr=AK8963_ADDR):
+        self.batch = I2CReadBatch()
+        self.batch.add('mpu6050', mpu6050_addr, ACCEL_XOUT_H, SAMPLE_BLOCK_LENGTH)
+        self.batch.add('ak8963', ak8963_addr, ST1, MAG_BLOCK_LENGTH)
+        self.batch.build()
+
+    def read(self, pi, handle):
+        results = self.batch.execute(pi, handle)
+        tick = pi.get_current_tick()
+        sample = decode_sample(results['mpu6050'], tick)
+        mag, mag_ready, mag_overflow = decode_mag(results['ak8963'])
+        return MotionSample(tick, sample.accel, sample.temperature, sample.gyro, mag, mag_ready, mag_overflow)
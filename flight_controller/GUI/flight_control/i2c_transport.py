@@ -0,0 +1,303 @@
+import ctypes
+import fcntl
+import os
+import time
+
+# Interchangeable I2C transports for the sensor drivers.
+# Every transport implements the subset of the pigpio.pi I2C interface the drivers use
+# (i2c_open, i2c_close, i2c_read_byte_data, i2c_write_byte_data, i2c_read_i2c_block_data,
+# i2c_write_i2c_block_data, i2c_zip and get_current_tick), so any of them can be passed
+# wherever a driver expects pi.
+
+# ioctl request and message flag from linux/i2c-dev.h and linux/i2c.h
+I2C_RDWR = 0x0707
+I2C_M_RD = 0x0001
+
+# pigpio i2c_zip commands
+ZIP_END = 0
+ZIP_ESCAPE = 1
+ZIP_ON = 2
+ZIP_OFF = 3
+ZIP_ADDRESS = 4
+ZIP_FLAGS = 5
+ZIP_READ = 6
+ZIP_WRITE = 7
+
+
+# splits a pigpio i2c_zip command sequence into (address, is_read, data) messages
+# data is the bytes to write, or the number of bytes to read
+def parse_zip(command, address):
+    messages = []
+    escape = False
+    i = 0
+    while i < len(command) and command[i] != ZIP_END:
+        cmd = command[i]
+        i += 1
+        # parameters are one byte, or two little endian bytes after an escape command
+        width = 2 if escape else 1
+        padded = command[i:i + width] + bytearray(2)
+        param = padded[0] | (padded[1] << 8) if escape else padded[0]
+        escape = False
+        if cmd == ZIP_ESCAPE:
+            escape = True
+        elif cmd == ZIP_ADDRESS:
+            address = param
+            i += width
+        elif cmd == ZIP_FLAGS:
+            i += 2
+        elif cmd == ZIP_READ:
+            messages.append((address, True, param))
+            i += width
+        elif cmd == ZIP_WRITE:
+            i += width
+            messages.append((address, False, bytearray(command[i:i + param])))
+            i += param
+        elif cmd not in (ZIP_ON, ZIP_OFF):
+            raise ValueError('Unsupported i2c_zip command {0}'.format(cmd))
+    return messages
+
+
+# talks to the pigpio daemon, one socket round trip per call
+class PigpioTransport(object):
+    def __init__(self, pi=None):
+        if pi is None:
+            import pigpio
+            pi = pigpio.pi()
+        self.pi = pi
+
+    def i2c_open(self, bus, address, flags=0):
+        return self.pi.i2c_open(bus, address, flags)
+
+    def i2c_close(self, handle):
+        self.pi.i2c_close(handle)
+
+    def i2c_read_byte_data(self, handle, register):
+        return self.pi.i2c_read_byte_data(handle, register)
+
+    def i2c_write_byte_data(self, handle, register, value):
+        self.pi.i2c_write_byte_data(handle, register, value)
+
+    def i2c_read_i2c_block_data(self, handle, register, count):
+        return self.pi.i2c_read_i2c_block_data(handle, register, count)
+
+    def i2c_write_i2c_block_data(self, handle, register, data):
+        self.pi.i2c_write_i2c_block_data(handle, register, data)
+
+    def i2c_zip(self, handle, data):
+        return self.pi.i2c_zip(handle, data)
+
+    def get_current_tick(self):
+        return self.pi.get_current_tick()
+
+
+# struct i2c_msg from linux/i2c.h
+class _I2CMsg(ctypes.Structure):
+    _fields_ = [('addr', ctypes.c_uint16),
+                ('flags', ctypes.c_uint16),
+                ('len', ctypes.c_uint16),
+                ('buf', ctypes.POINTER(ctypes.c_uint8))]
+
+
+# struct i2c_rdwr_ioctl_data from linux/i2c-dev.h
+class _I2CRdwrData(ctypes.Structure):
+    _fields_ = [('msgs', ctypes.POINTER(_I2CMsg)),
+                ('nmsgs', ctypes.c_uint32)]
+
+
+# talks to /dev/i2c-N directly, register reads are a single combined I2C_RDWR transaction
+class I2CDevTransport(object):
+    def __init__(self):
+        # bus number -> file descriptor
+        self.bus_fds = {}
+        # handle -> (file descriptor, device address)
+        self.devices = {}
+        self.next_handle = 0
+
+    def i2c_open(self, bus, address, flags=0):
+        if bus not in self.bus_fds:
+            self.bus_fds[bus] = os.open('/dev/i2c-{0}'.format(bus), os.O_RDWR)
+        handle = self.next_handle
+        self.next_handle += 1
+        self.devices[handle] = (self.bus_fds[bus], address)
+        return handle
+
+    def i2c_close(self, handle):
+        fd, address = self.devices.pop(handle)
+        # close the bus once no device is using it
+        if all(device_fd != fd for device_fd, a in self.devices.values()):
+            for bus, bus_fd in list(self.bus_fds.items()):
+                if bus_fd == fd:
+                    del self.bus_fds[bus]
+            os.close(fd)
+
+    # issues (address, flags, data) messages as one transaction with repeated starts in between
+    def transfer(self, handle, messages):
+        fd, address = self.devices[handle]
+        msgs = (_I2CMsg * len(messages))()
+        buffers = []
+        for i, (msg_address, flags, data) in enumerate(messages):
+            buf = (ctypes.c_uint8 * len(data)).from_buffer(data)
+            buffers.append(buf)
+            msgs[i].addr = msg_address
+            msgs[i].flags = flags
+            msgs[i].len = len(data)
+            msgs[i].buf = ctypes.cast(buf, ctypes.POINTER(ctypes.c_uint8))
+        rdwr = _I2CRdwrData(msgs, len(messages))
+        fcntl.ioctl(fd, I2C_RDWR, rdwr)
+
+    def i2c_read_i2c_block_data(self, handle, register, count):
+        fd, address = self.devices[handle]
+        data = bytearray(count)
+        self.transfer(handle, [(address, 0, bytearray([register])), (address, I2C_M_RD, data)])
+        return count, data
+
+    def i2c_read_byte_data(self, handle, register):
+        return self.i2c_read_i2c_block_data(handle, register, 1)[1][0]
+
+    def i2c_write_i2c_block_data(self, handle, register, data):
+        fd, address = self.devices[handle]
+        self.transfer(handle, [(address, 0, bytearray([register]) + bytearray(data))])
+
+    def i2c_write_byte_data(self, handle, register, value):
+        self.i2c_write_i2c_block_data(handle, register, [value])
+
+    # runs a whole zip sequence, possibly spanning several devices, as one I2C_RDWR ioctl
+    def i2c_zip(self, handle, data):
+        fd, address = self.devices[handle]
+        messages = []
+        reads = []
+        for msg_address, is_read, payload in parse_zip(bytearray(data), address):
+            if is_read:
+                buf = bytearray(payload)
+                reads.append(buf)
+                messages.append((msg_address, I2C_M_RD, buf))
+            else:
+                messages.append((msg_address, 0, payload))
+        self.transfer(handle, messages)
+        result = bytearray().join(reads)
+        return len(result), result
+
+    def get_current_tick(self):
+        return (time.monotonic_ns() // 1000) & 0xFFFFFFFF
+
+
+# a device that is just 256 bytes of registers with auto incrementing addresses
+class RegisterMap(object):
+    def __init__(self, registers=None):
+        self.registers = bytearray(256)
+        if registers is not None:
+            for register, value in registers.items():
+                self.registers[register] = value
+
+    def read(self, register, count):
+        return bytearray(self.registers[(register + i) & 0xFF] for i in range(count))
+
+    def write(self, register, data):
+        for i, value in enumerate(data):
+            self.registers[(register + i) & 0xFF] = value & 0xFF
+
+
+# keeps every device in memory, for running the drivers without hardware
+class RegisterMapTransport(object):
+    def __init__(self, devices=None):
+        # (bus, address) -> device with read(register, count) and write(register, data)
+        self.devices = {}
+        if devices is not None:
+            self.devices.update(devices)
+        self.handles = {}
+        self.next_handle = 0
+
+    # attaches a device model to the bus, an empty RegisterMap if none is given
+    def add_device(self, bus, address, device=None):
+        if device is None:
+            device = RegisterMap()
+        self.devices[(bus, address)] = device
+        return device
+
+    def i2c_open(self, bus, address, flags=0):
+        if (bus, address) not in self.devices:
+            raise IOError('No device at address 0x{0:02X} on bus {1}'.format(address, bus))
+        handle = self.next_handle
+        self.next_handle += 1
+        self.handles[handle] = (bus, address)
+        return handle
+
+    def i2c_close(self, handle):
+        del self.handles[handle]
+
+    def device(self, handle):
+        return self.devices[self.handles[handle]]
+
+    def i2c_read_i2c_block_data(self, handle, register, count):
+        return count, self.device(handle).read(register, count)
+
+    def i2c_read_byte_data(self, handle, register):
+        return self.device(handle).read(register, 1)[0]
+
+    def i2c_write_i2c_block_data(self, handle, register, data):
+        self.device(handle).write(register, bytearray(data))
+
+    def i2c_write_byte_data(self, handle, register, value):
+        self.device(handle).write(register, bytearray([value]))
+
+    # a write sets the register pointer of the addressed device, a read continues from it
+    def i2c_zip(self, handle, data):
+        bus, address = self.handles[handle]
+        pointers = {}
+        result = bytearray()
+        for msg_address, is_read, payload in parse_zip(bytearray(data), address):
+            device = self.devices[(bus, msg_address)]
+            if is_read:
+                register = pointers.get(msg_address, 0)
+                result += device.read(register, payload)
+                pointers[msg_address] = register + payload
+            else:
+                pointers[msg_address] = payload[0]
+                if len(payload) > 1:
+                    device.write(payload[0], payload[1:])
+        return len(result), result
+
+    def get_current_tick(self):
+        return (time.monotonic_ns() // 1000) & 0xFFFFFFFF
+
+
+# returns the average time in microseconds of a six byte-read sample and a single block read
+def benchmark_transport(transport, bus=1, address=0x68, register=0x3B, iterations=1000):
+    handle = transport.i2c_open(bus, address, 0)
+    try:
+        start = time.perf_counter()
+        for i in range(iterations):
+            for offset in range(6):
+                transport.i2c_read_byte_data(handle, register + offset)
+        byte_time = (time.perf_counter() - start) / iterations * 1e6
+
+        start = time.perf_counter()
+        for i in range(iterations):
+            transport.i2c_read_i2c_block_data(handle, register, 6)
+        block_time = (time.perf_counter() - start) / iterations * 1e6
+    finally:
+        transport.i2c_close(handle)
+    return byte_time, block_time
+
+
+if __name__ == "__main__":
+    transports = []
+
+    memory = RegisterMapTransport()
+    memory.add_device(1, 0x68)
+    transports.append(('register map', memory))
+
+    if os.path.exists('/dev/i2c-1'):
+        transports.append(('i2c-dev', I2CDevTransport()))
+
+    try:
+        import pigpio
+        pi = pigpio.pi()
+        if pi.connected:
+            transports.append(('pigpio', PigpioTransport(pi)))
+    except ImportError:
+        pass
+
+    for name, transport in transports:
+        byte_time, block_time = benchmark_transport(transport)
+        print("{0:>12}: 6 byte reads {1:8.1f} us, 1 block read {2:8.1f} us".format(name, byte_time, block_time))
@@ -1,17 +1,61 @@
+import struct
+import time
 import numpy as np
+from mpu6050 import *
+from calibration import *
+from sample_ring import *
+from estimators import *
+
+# update_accelerometer_offsets and the calibrations store the mean plus 1 G on z as the offset,
+# so the offset corrected data reads -1 G on z when level; adding this back gives the
+# estimators the specific force, +1 G on z when level
+LEVEL_CORRECTION = np.array([0.0, 0.0, 2.0])
+
+# longest time step integrated in one go, a longer gap between samples (a stalled loop) is
+# integrated as this much instead of extrapolating the rates over the whole gap
+MAX_SAMPLE_DT = 0.05
+
+# seconds between die temperature reads in FIFO mode, the FIFO carries no temperature
+TEMPERATURE_PERIOD = 1.0
 
 
 # a class representing the IMU
+# I2C goes through the_i2c transport if one is given, otherwise through the pigpio pi passed to each method
+# the_estimator is an estimator object or name from estimators.py, the complementary filter
+# with the_alpha by default
 class IMU(object):
-    def __init__(self, the_MPU6050_ADDR, the_alpha):
+    def __init__(self, the_MPU6050_ADDR, the_alpha, the_i2c=None, the_estimator=None):
         self.MPU6050_ADDR = the_MPU6050_ADDR
         self.alpha = the_alpha
+        self.i2c = the_i2c
+        self.estimator = ComplementaryFilter(the_alpha) if the_estimator is None else the_estimator
         self.euler_state = np.array([0.0, 0.0])
         self.accel_data = np.array([0.0, 0.0, 0.0])
         self.gyro_data = np.array([0.0, 0.0, 0.0])
         self.acc_offsets = None
         self.gyro_offsets = None
+        # standard deviation of the samples the offsets were computed from
+        self.acc_std = None
+        self.gyro_std = None
+        # temperature dependent offsets, used instead of the fixed offsets when set
+        self.thermal_bias = None
         self.mpu6050_handle = None
+        # die temperature and pigpio tick of the most recent sample
+        self.temperature = None
+        self.last_sample_tick = None
+        # time.monotonic() of the last separate temperature read in FIFO mode
+        self.temperature_time = None
+        # hardware FIFO reader, None when polling the data registers
+        self.fifo = None
+        # data ready interrupt listener, None when polling the data registers
+        self.data_ready = None
+        # time between the two most recent samples in seconds
+        self.sample_dt = 0.0
+        # shared memory ring filled by an acquisition process, None when reading the sensor directly
+        self.ring = None
+        self.ring_seq = 0
+        # coning correction when integrating FIFO and ring batches
+        self.coning_correction = False
 
         # I term
         self.I_term = np.array([0.0,0.0,0.0])
@@ -71,164 +115,332 @@ class IMU(object):
     def mpu6050_handle(self, mpu6050_handle):
         self._mpu6050_handle = mpu6050_handle
 
+    # getter for the I2C transport
+    @property
+    def i2c(self):
+        return self._i2c
+
+    # setter for the I2C transport
+    @i2c.setter
+    def i2c(self, i2c):
+        self._i2c = i2c
+
+    # returns the object used for I2C access
+    def bus(self, pi):
+        return self.i2c if self.i2c is not None else pi
+
+    # getter for the attitude estimator
+    @property
+    def estimator(self):
+        return self._estimator
+
+    # setter for the attitude estimator, accepts a name such as 'madgwick' for one with default gains
+    @estimator.setter
+    def estimator(self, estimator):
+        self._estimator = make_estimator(estimator) if isinstance(estimator, str) else estimator
+
     # getter for alpha
     @property
     def alpha(self):
         return self._alpha
 
-    # setter for alpha
+    # setter for alpha, also the gain of the estimator when it is the complementary filter
     @alpha.setter
     def alpha(self, alpha):
         self._alpha = alpha
+        if isinstance(getattr(self, '_estimator', None), ComplementaryFilter):
+            self._estimator.alpha = alpha
 
     def update_accelerometer_offsets(self, pi):
-        sum_acc_x = 0
-        sum_acc_y = 0
-        sum_acc_z = 0
-
         iter_num = 100
 
-        for i in range(0, iter_num):
-            AcX = (pi.i2c_read_byte_data(self.mpu6050_handle, 0x3B) << 8) + pi.i2c_read_byte_data(self.mpu6050_handle, 0x3C)
-            AcY = (pi.i2c_read_byte_data(self.mpu6050_handle, 0x3D) << 8) + pi.i2c_read_byte_data(self.mpu6050_handle, 0x3E)
-            AcZ = (pi.i2c_read_byte_data(self.mpu6050_handle, 0x3F) << 8) + pi.i2c_read_byte_data(self.mpu6050_handle, 0x40)
-            if AcX > 32768:
-                AcX = AcX - 65536
-            if AcY > 32768:
-                AcY = AcY - 65536
-            if AcZ > 32768:
-                AcZ = AcZ - 65536
-
-            sum_acc_x += AcX
-            sum_acc_y += AcY
-            sum_acc_z += AcZ
-
-        AcX_mean = sum_acc_x / iter_num
-        AcY_mean = sum_acc_y / iter_num
-        AcZ_mean = sum_acc_z / iter_num
-
-        # Convert to G's
-        AcX_mean = AcX_mean / 65535 * 4
-        AcY_mean = AcY_mean / 65535 * 4
-        AcZ_mean = AcZ_mean / 65535 * 4
+        samples = np.array([self.read_sample(pi).accel for i in range(0, iter_num)])
+        acc_mean = samples.mean(axis=0)
+        self.acc_std = samples.std(axis=0)
 
-        self.acc_offsets = np.array([AcX_mean, AcY_mean, AcZ_mean + 1])
+        self.acc_offsets = np.array([acc_mean[0], acc_mean[1], acc_mean[2] + 1])
         print("Accelerometer offsets updated")
         print()
 
     def update_accelerometer_data(self, pi):
-        AcX = (pi.i2c_read_byte_data(self.mpu6050_handle, 0x3B) << 8) + pi.i2c_read_byte_data(self.mpu6050_handle, 0x3C)
-        AcY = (pi.i2c_read_byte_data(self.mpu6050_handle, 0x3D) << 8) + pi.i2c_read_byte_data(self.mpu6050_handle, 0x3E)
-        AcZ = (pi.i2c_read_byte_data(self.mpu6050_handle, 0x3F) << 8) + pi.i2c_read_byte_data(self.mpu6050_handle, 0x40)
-        if AcX > 32768:
-            AcX = AcX - 65536
-        if AcY > 32768:
-            AcY = AcY - 65536
-        if AcZ > 32768:
-            AcZ = AcZ - 65536
+        count, data = self.bus(pi).i2c_read_i2c_block_data(self.mpu6050_handle, ACCEL_XOUT_H, 6)
+        AcX, AcY, AcZ = struct.unpack('>3h', data)
 
         # Convert to G's
-        AcX = AcX * 4 / 65536
-        AcY = AcY * 4 / 65536
-        AcZ = AcZ * 4 / 65536
-
-        return np.array([AcX, AcY, AcZ])
+        return np.array([AcX * ACCEL_SCALE, AcY * ACCEL_SCALE, AcZ * ACCEL_SCALE])
 
     def update_gyroscope_offsets(self, pi):
-        sum_gy_x = 0
-        sum_gy_y = 0
-        sum_gy_z = 0
-
         iter_num = 100
 
-        for i in range(0, iter_num):
-            GyX = (pi.i2c_read_byte_data(self.mpu6050_handle, 0x43) << 8) + pi.i2c_read_byte_data(self.mpu6050_handle, 0x44)
-            GyY = (pi.i2c_read_byte_data(self.mpu6050_handle, 0x45) << 8) + pi.i2c_read_byte_data(self.mpu6050_handle, 0x46)
-            GyZ = (pi.i2c_read_byte_data(self.mpu6050_handle, 0x47) << 8) + pi.i2c_read_byte_data(self.mpu6050_handle, 0x48)
-            if GyX > 32768:
-                GyX = GyX - 65536
-            if GyY > 32768:
-                GyY = GyY - 65536
-            if GyZ > 32768:
-                GyZ = GyZ - 65536
-
-            sum_gy_x += GyX
-            sum_gy_y += GyY
-            sum_gy_z += GyZ
-
-        GyX_mean = sum_gy_x / iter_num
-        GyY_mean = sum_gy_y / iter_num
-        GyZ_mean = sum_gy_z / iter_num
-
-        GyX_mean = GyX_mean / 65.5
-        GyY_mean = GyY_mean / 65.5
-        GyZ_mean = GyZ_mean / 65.5
-
-        self.gyro_offsets = np.array([GyX_mean, GyY_mean, GyZ_mean])
+        samples = np.array([self.read_sample(pi).gyro for i in range(0, iter_num)])
+        self.gyro_std = samples.std(axis=0)
+
+        self.gyro_offsets = samples.mean(axis=0)
         print("Gyroscope offsets updated")
         print()
 
     def update_gyroscope_data(self, pi):
-        GyX = (pi.i2c_read_byte_data(self.mpu6050_handle, 0x43) << 8) + pi.i2c_read_byte_data(self.mpu6050_handle, 0x44)
-        GyY = (pi.i2c_read_byte_data(self.mpu6050_handle, 0x45) << 8) + pi.i2c_read_byte_data(self.mpu6050_handle, 0x46)
-        GyZ = (pi.i2c_read_byte_data(self.mpu6050_handle, 0x47) << 8) + pi.i2c_read_byte_data(self.mpu6050_handle, 0x48)
-        if GyX > 32768:
-            GyX = GyX - 65536
-        if GyY > 32768:
-            GyY = GyY - 65536
-        if GyZ > 32768:
-            GyZ = GyZ - 65536
-
-        GyX = GyX / 65.5
-        GyY = GyY / 65.5
-        GyZ = GyZ / 65.5
-
-        return np.array([GyX, GyY, GyZ])
-
-    def setupMPU6050(self, pi):
+        count, data = self.bus(pi).i2c_read_i2c_block_data(self.mpu6050_handle, GYRO_XOUT_H, 6)
+        GyX, GyY, GyZ = struct.unpack('>3h', data)
+
+        return np.array([GyX * GYRO_SCALE, GyY * GYRO_SCALE, GyZ * GYRO_SCALE])
+
+    # reads accelerometer, temperature and gyroscope in a single block transaction
+    # when the data ready interrupt is enabled this blocks until the sensor has a new sample
+    def read_sample(self, pi):
+        if self.data_ready is not None:
+            sample = self.data_ready.wait_sample(self.bus(pi))
+            if sample is None:
+                raise IOError('Timed out waiting for the IMU data ready interrupt')
+        else:
+            sample = read_sample(self.bus(pi), self.mpu6050_handle)
+
+        if self.last_sample_tick is not None:
+            self.sample_dt = ((sample.tick - self.last_sample_tick) & 0xFFFFFFFF) / 1e6
+        self.temperature = sample.temperature
+        self.last_sample_tick = sample.tick
+        return sample
+
+    # paces sampling with the MPU6050 INT pin wired to int_gpio
+    def enable_data_ready(self, pi, int_gpio):
+        self.data_ready = MPU6050DataReady(self.mpu6050_handle, int_gpio)
+        self.data_ready.start(pi)
+        self.last_sample_tick = None
+        print("IMU data ready interrupt enabled on GPIO", int_gpio)
+
+    # takes samples from a SampleRing written by an acquisition process instead of the bus
+    def attach_ring(self, ring):
+        self.ring = ring
+        self.ring_seq = ring.write_count()
+        self.last_sample_tick = None
+
+    # returns every valid sample written to the ring since the last call
+    def read_ring(self):
+        batch, self.ring_seq = self.ring.read_new(self.ring_seq)
+        if batch.size > 0 and (batch['flags'][-1] & FLAG_READ_ERROR):
+            raise IOError('IMU acquisition process failed to read the sensor')
+        batch = batch[(batch['flags'] & FLAG_READ_ERROR) == 0]
+        if batch.size > 0:
+            tick = batch['tick'][-1]
+            if self.last_sample_tick is not None:
+                self.sample_dt = ((int(tick) - int(self.last_sample_tick)) & 0xFFFFFFFF) / 1e6
+            self.temperature = batch['temperature'][-1]
+            self.last_sample_tick = tick
+        return batch
+
+    # collects count samples as (ticks, accel, gyro) arrays, drained from the FIFO when it is
+    # enabled and otherwise read one block at a time
+    def collect_samples(self, pi, count):
+        if self.fifo is not None:
+            batches = []
+            collected = 0
+            while collected < count:
+                batch = self.read_fifo(pi)
+                batches.append(batch)
+                collected += batch.size
+                time.sleep(0.005)
+            samples = np.concatenate(batches)[:count]
+            return samples['tick'], samples['accel'], samples['gyro']
+
+        ticks = np.empty(count)
+        accel = np.empty((count, 3))
+        gyro = np.empty((count, 3))
+        for i in range(0, count):
+            sample = self.read_sample(pi)
+            ticks[i] = sample.tick
+            accel[i] = sample.accel
+            gyro[i] = sample.gyro
+        return ticks, accel, gyro
+
+    # measures offsets and sensor noise from a long stationary recording
+    # the offsets are the outlier rejected means, and the returned NoiseCalibration
+    # provides the Kalman filter covariances
+    def calibrate_noise(self, pi, count=5000):
+        ticks, accel, gyro = self.collect_samples(pi, count)
+        # sample rate from the timestamps, which wrap every 2^32 microseconds
+        elapsed = np.sum(np.diff(ticks) % 2 ** 32) / 1e6
+        noise = NoiseCalibration(accel, gyro, (count - 1) / elapsed)
+
+        self.acc_offsets = noise.acc_bias + np.array([0.0, 0.0, 1.0])
+        self.gyro_offsets = noise.gyro_bias
+        self.acc_std = np.sqrt(noise.acc_variance)
+        self.gyro_std = np.sqrt(noise.gyro_variance)
+        print("Noise calibration complete at", noise.sample_rate, "Hz")
+        return noise
+
+    # records the offsets against die temperature while the board warms up, then fits a ThermalBiasModel
+    # the IMU must stay still for the whole recording
+    def calibrate_thermal(self, pi, duration=600.0, samples_per_point=200):
+        temperatures = []
+        acc_offsets = []
+        gyro_offsets = []
+        end_time = time.time() + duration
+        while time.time() < end_time:
+            temperature = 0.0
+            accel = np.zeros(3)
+            gyro = np.zeros(3)
+            for i in range(0, samples_per_point):
+                sample = self.read_sample(pi)
+                temperature += sample.temperature
+                accel += sample.accel
+                gyro += sample.gyro
+            temperatures.append(temperature / samples_per_point)
+            acc_offsets.append(accel / samples_per_point + np.array([0.0, 0.0, 1.0]))
+            gyro_offsets.append(gyro / samples_per_point)
+            print("Recorded offsets at", temperatures[-1], "C")
+
+        self.thermal_bias = ThermalBiasModel.fit(temperatures, np.array(acc_offsets), np.array(gyro_offsets))
+        return self.thermal_bias
+
+    # offsets to remove from the current sample
+    def current_offsets(self):
+        if self.thermal_bias is not None and self.temperature is not None:
+            return self.thermal_bias.offsets(self.temperature)
+        return self.acc_offsets, self.gyro_offsets
+
+    # loads the offsets from the calibration store, and only measures them again if the stored
+    # calibration is missing, too old or was made at a temperature too far from the current one
+    # without a thermal model to compensate for it
+    def load_or_update_offsets(self, pi, store, user_id='default', max_age=7 * 24 * 3600,
+                               max_temperature_delta=10.0):
+        who_am_i = self.bus(pi).i2c_read_byte_data(self.mpu6050_handle, WHO_AM_I)
+        temperature = self.read_sample(pi).temperature
+
+        calibration = store.load(who_am_i, user_id)
+        # a thermal model covers a different temperature, then only the age makes it stale
+        if calibration is not None and calibration.is_fresh(
+                temperature if calibration.thermal_bias is None else None, max_age, max_temperature_delta):
+            self.acc_offsets = calibration.acc_offsets
+            self.gyro_offsets = calibration.gyro_offsets
+            self.thermal_bias = calibration.thermal_bias
+            print("Offsets loaded from", store.path)
+            return calibration
+
+        self.update_accelerometer_offsets(pi)
+        self.update_gyroscope_offsets(pi)
+
+        # keep anything else that was stored for this sensor, e.g. magnetometer and mounting calibration
+        if calibration is None:
+            calibration = SensorCalibration(who_am_i, user_id)
+        calibration.temperature = self.temperature
+        calibration.acc_offsets = self.acc_offsets
+        calibration.gyro_offsets = self.gyro_offsets
+        if self.thermal_bias is not None:
+            calibration.thermal_bias = self.thermal_bias
+        calibration.statistics = {'samples': 100,
+                                  'acc_std': self.acc_std.tolist(),
+                                  'gyro_std': self.gyro_std.tolist()}
+        calibration.timestamp = time.time()
+        store.save(calibration)
+        print("Offsets saved to", store.path)
+        return calibration
+
+    # if fifo_rate is given, the hardware FIFO is filled with accel and gyro samples at that rate in Hz
+    def setupMPU6050(self, pi, fifo_rate=None):
+        bus = self.bus(pi)
+
         # opens connection at I2C bus 1
-        mpu6050_handler = pi.i2c_open(1, self.MPU6050_ADDR, 0)
+        mpu6050_handler = bus.i2c_open(1, self.MPU6050_ADDR, 0)
 
         # Configure things as done in:
         # https://github.com/tockn/MPU6050_tockn/blob/master/src/MPU6050_tockn.cpp
 
-        pi.i2c_write_byte_data(mpu6050_handler, 0x19, 0x00)
-        pi.i2c_write_byte_data(mpu6050_handler, 0x1a, 0x00)
-        pi.i2c_write_byte_data(mpu6050_handler, 0x1b, 0x08)
-        pi.i2c_write_byte_data(mpu6050_handler, 0x1c, 0x00)
+        bus.i2c_write_byte_data(mpu6050_handler, 0x19, 0x00)
+        bus.i2c_write_byte_data(mpu6050_handler, 0x1a, 0x00)
+        bus.i2c_write_byte_data(mpu6050_handler, 0x1b, 0x08)
+        bus.i2c_write_byte_data(mpu6050_handler, 0x1c, 0x00)
 
         # Wakes up MPU6050 by writing 0 to PWR_MGMT_1 register
-        pi.i2c_write_byte_data(mpu6050_handler, 0x6B, 0x02)
+        bus.i2c_write_byte_data(mpu6050_handler, 0x6B, 0x02)
 
-        pi.i2c_write_byte_data(mpu6050_handler, 0x38, 1)
+        bus.i2c_write_byte_data(mpu6050_handler, 0x38, 1)
 
         # Set G Scale
         # Acc_Config = pi.i2c_read_byte_data(mpu6050_handler,0x1C)
         # Acc_Config_4G = (Acc_Config | 1<<3) & (~1<<4)
 
         self.mpu6050_handle = mpu6050_handler
-        print("IMU setup complete")
-
-    def calculate_angles(self, pi):
 
-        # Get accelerometer and gyroscope data
-        self.accel_data = self.update_accelerometer_data(pi) - self.acc_offsets
-        self.gyro_data = self.update_gyroscope_data(pi) - self.gyro_offsets
+        if fifo_rate is not None:
+            self.fifo = MPU6050Fifo(mpu6050_handler, fifo_rate)
+            self.fifo.enable(bus)
+            print("IMU FIFO enabled at", self.fifo.sample_rate, "Hz")
 
-        # Estimate angle from accelerometer
-        pitch_acc = np.arctan2(self.accel_data[0], np.sqrt(self.accel_data[1] * self.accel_data[1] + self.accel_data[2]
-                                                           * self.accel_data[2])) * -1
-        roll_acc = np.arctan2(self.accel_data[1], np.sqrt(self.accel_data[0] * self.accel_data[0] + self.accel_data[2]
-                                                          * self.accel_data[2]))
+        print("IMU setup complete")
 
-        # Complementary Filter
-        acc_angles = np.array([roll_acc * 180 / np.pi, pitch_acc * 180 / np.pi])
-        gyro_pr = np.array([self.gyro_data[0], self.gyro_data[1]])
+    # returns every sample produced since the last call as a NumPy batch
+    # the die temperature is read separately every TEMPERATURE_PERIOD seconds for the thermal model
+    def read_fifo(self, pi):
+        bus = self.bus(pi)
+        batch = self.fifo.drain(bus)
+        if batch.size > 0:
+            self.last_sample_tick = batch['tick'][-1]
+        now = time.monotonic()
+        if self.temperature_time is None or now - self.temperature_time >= TEMPERATURE_PERIOD:
+            self.update_temperature(bus)
+            self.temperature_time = now
+        return batch
+
+    # reads TEMP_OUT, which the FIFO does not carry
+    def update_temperature(self, bus):
+        count, data = bus.i2c_read_i2c_block_data(self.mpu6050_handle, TEMP_OUT_H, 2)
+        self.temperature = temperature_from_raw(struct.unpack('>h', data)[0])
+
+    # forgets the previous sample and the estimator state, called when the flight loop starts so the
+    # first time step does not span the calibration or the disarmed idle time
+    def restart_estimation(self, pi):
+        self.last_sample_tick = None
+        self.sample_dt = 0.0
+        self.estimator.reset()
+        self.euler_state = np.array([0.0, 0.0])
+        # the FIFO has overflowed while nobody drained it and the ring holds the idle samples
+        if self.fifo is not None:
+            self.fifo.reset(self.bus(pi))
+        if self.ring is not None:
+            self.ring_seq = self.ring.write_count()
+
+    # with the FIFO or the ring every sample since the last call is integrated with its own dt,
+    # so a loop slower than the sensor still gets the attitude at the full sensor rate
+    def calculate_angles(self, pi):
+        previous_tick = self.last_sample_tick
+
+        # Get accelerometer and gyroscope data from one block read, or every new FIFO or ring sample
+        if self.ring is not None or self.fifo is not None:
+            batch = self.read_ring() if self.ring is not None else self.read_fifo(pi)
+            if batch.size == 0:
+                return
+            acc_offsets, gyro_offsets = self.current_offsets()
+            accel = batch['accel'] - acc_offsets
+            gyro = batch['gyro'] - gyro_offsets
+            self.accel_data = accel[-1]
+            self.gyro_data = gyro[-1]
+            dt = np.minimum(tick_dt(batch['tick'], previous_tick), MAX_SAMPLE_DT)
+            self.calculate_batch_angles(accel + LEVEL_CORRECTION, gyro, dt)
+            return
+
+        sample = self.read_sample(pi)
+
+        # temperature compensated when a thermal model is loaded
+        acc_offsets, gyro_offsets = self.current_offsets()
+        self.accel_data = sample.accel - acc_offsets
+        self.gyro_data = sample.gyro - gyro_offsets
 
         if self.sample_time < 0:
             self.sample_time = 0
 
-        self.euler_state = (self.alpha * (self.euler_state + self.sample_time * gyro_pr) + (1 - self.alpha) * acc_angles)
+        # the time since the previous sample, nothing to integrate for the first one
+        dt = min(self.sample_dt, MAX_SAMPLE_DT) if previous_tick is not None else 0.0
+
+        # roll and pitch from the attitude estimator
+        self.euler_state = self.estimator.update(self.accel_data + LEVEL_CORRECTION, self.gyro_data, dt)
+
+    # roll and pitch from a batch of samples, one at a time if the estimator has no update_batch
+    def calculate_batch_angles(self, accel, gyro, dt):
+        if hasattr(self.estimator, 'update_batch'):
+            self.euler_state = self.estimator.update_batch(accel, gyro, dt, self.coning_correction)
+        else:
+            for i in range(len(dt)):
+                self.euler_state = self.estimator.update(accel[i], gyro[i], dt[i])
 
     # checks the limitations on each variable to avoid reset windup
     def check_output_limitations(self, a, b, c):
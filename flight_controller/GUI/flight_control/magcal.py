@@ -0,0 +1,63 @@
+import sys
+import time
+import numpy as np
+import pigpio
+from mpu6050 import *
+from ak8963 import *
+from calibration import *
+
+# Magnetometer hard and soft iron calibration.
+# Run it, then slowly rotate the vehicle through every orientation until the sample count
+# is reached. The fit is saved to the calibration store, from which the flight scripts load
+# it and apply it as corrected = mag_matrix.dot(raw - mag_offset).
+
+
+# streams AK8963 samples until count new readings have been collected
+def collect_mag_samples(pi, ak8963_handle, count=3000):
+    samples = np.empty((count, 3))
+    n = 0
+    while n < count:
+        mag, mag_ready, mag_overflow = read_mag(pi, ak8963_handle)
+        if mag_ready and not mag_overflow:
+            samples[n] = mag
+            n += 1
+            if n % 100 == 0:
+                print(n, "/", count, "samples")
+        else:
+            # the AK8963 updates at 100 Hz in continuous mode 2
+            time.sleep(0.002)
+    return samples
+
+
+if __name__ == "__main__":
+    user_id = sys.argv[1] if len(sys.argv) > 1 else 'default'
+
+    pi = pigpio.pi()
+    mpu6050_handle = pi.i2c_open(1, 0x68, 0)
+    pi.i2c_write_byte_data(mpu6050_handle, PWR_MGMT_1, 0x02)
+    ak8963_handle = setup_ak8963(pi, mpu6050_handle)
+
+    print("Rotate the vehicle through every orientation")
+    samples = collect_mag_samples(pi, ak8963_handle)
+    mag_offset, mag_matrix = fit_ellipsoid(samples)
+
+    corrected = (samples - mag_offset).dot(mag_matrix.T)
+    norms = np.linalg.norm(corrected, axis=1)
+    print("Offset:", mag_offset)
+    print("Matrix:")
+    print(mag_matrix)
+    print("Corrected field strength {0:.1f} +- {1:.1f}".format(norms.mean(), norms.std()))
+
+    store = CalibrationStore()
+    who_am_i = pi.i2c_read_byte_data(mpu6050_handle, WHO_AM_I)
+    calibration = store.load(who_am_i, user_id)
+    if calibration is None:
+        calibration = SensorCalibration(who_am_i, user_id)
+    calibration.mag_offset = mag_offset
+    calibration.mag_matrix = mag_matrix
+    store.save(calibration)
+    print("Saved to", store.path)
+
+    pi.i2c_close(ak8963_handle)
+    pi.i2c_close(mpu6050_handle)
+    pi.stop()
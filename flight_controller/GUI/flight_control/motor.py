@@ -43,3 +43,10 @@ class Motor(object):
         Motor.set_motor_pulse(pi, self.MOTOR2, 1)
         Motor.set_motor_pulse(pi, self.MOTOR3, 1)
         Motor.set_motor_pulse(pi, self.MOTOR4, 1)
+
+    # drops every motor to the zero throttle pulse
+    def stop(self, pi):
+        Motor.set_motor_pulse(pi, self.MOTOR1, 1)
+        Motor.set_motor_pulse(pi, self.MOTOR2, 1)
+        Motor.set_motor_pulse(pi, self.MOTOR3, 1)
+        Motor.set_motor_pulse(pi, self.MOTOR4, 1)
@@ -0,0 +1,223 @@
+import struct
+import threading
+import numpy as np
+import pigpio
+
+# MPU6050 registers
+SMPLRT_DIV = 0x19
+CONFIG = 0x1A
+GYRO_CONFIG = 0x1B
+ACCEL_CONFIG = 0x1C
+FIFO_EN = 0x23
+INT_ENABLE = 0x38
+INT_STATUS = 0x3A
+ACCEL_XOUT_H = 0x3B
+TEMP_OUT_H = 0x41
+GYRO_XOUT_H = 0x43
+USER_CTRL = 0x6A
+PWR_MGMT_1 = 0x6B
+FIFO_COUNT_H = 0x72
+FIFO_R_W = 0x74
+WHO_AM_I = 0x75
+
+# FIFO_EN bits for the three gyro axes and the accelerometer
+FIFO_EN_XYZG_ACCEL = 0x78
+# USER_CTRL bits
+USER_CTRL_FIFO_EN = 0x40
+USER_CTRL_FIFO_RESET = 0x04
+
+# size of the hardware FIFO in bytes
+FIFO_SIZE = 1024
+# bytes per FIFO sample with accel and gyro enabled (accel is written first)
+FIFO_PACKET_LENGTH = 12
+# largest SMBus block read, rounded down to whole FIFO packets
+FIFO_MAX_BLOCK = 24
+
+# gyro output rate with the digital low pass filter disabled (DLPF_CFG 0 or 7) and enabled
+GYRO_OUTPUT_RATE = 8000
+GYRO_OUTPUT_RATE_DLPF = 1000
+
+# accel, temperature and gyro registers are contiguous from 0x3B to 0x48
+SAMPLE_BLOCK_LENGTH = 14
+
+# conversion factors for +-2 g accelerometer and +-500 deg/s gyroscope ranges
+ACCEL_SCALE = 4 / 65536
+GYRO_SCALE = 1 / 65.5
+
+# big endian signed 16 bit words: AcX, AcY, AcZ, Temp, GyX, GyY, GyZ
+_SAMPLE_STRUCT = struct.Struct('>7h')
+
+# a batch of decoded FIFO samples
+FIFO_SAMPLE_DTYPE = np.dtype([('tick', np.float64), ('accel', np.float64, (3,)), ('gyro', np.float64, (3,))])
+
+
+# a single decoded reading of the MPU6050 data registers
+class MPU6050Sample(object):
+    def __init__(self, tick, accel, temperature, gyro):
+        # pigpio tick in microseconds at which the registers were read
+        self.tick = tick
+        # acceleration in G's
+        self.accel = accel
+        # die temperature in degrees Celsius
+        self.temperature = temperature
+        # angular rate in degrees per second
+        self.gyro = gyro
+
+
+# converts a raw temperature reading into degrees Celsius (register map, section 4.18)
+def temperature_from_raw(raw):
+    return raw / 340 + 36.53
+
+
+# decodes the 14 byte 0x3B-0x48 register block into a sample
+def decode_sample(data, tick):
+    AcX, AcY, AcZ, temp, GyX, GyY, GyZ = _SAMPLE_STRUCT.unpack_from(data)
+    accel = np.array([AcX * ACCEL_SCALE, AcY * ACCEL_SCALE, AcZ * ACCEL_SCALE])
+    gyro = np.array([GyX * GYRO_SCALE, GyY * GYRO_SCALE, GyZ * GYRO_SCALE])
+    return MPU6050Sample(tick, accel, temperature_from_raw(temp), gyro)
+
+
+# reads the accel, temperature and gyro registers in one block transaction
+def read_raw_block(pi, handle):
+    count, data = pi.i2c_read_i2c_block_data(handle, ACCEL_XOUT_H, SAMPLE_BLOCK_LENGTH)
+    if count != SAMPLE_BLOCK_LENGTH:
+        raise IOError('Short MPU6050 block read: expected {0} bytes, got {1}'.format(SAMPLE_BLOCK_LENGTH, count))
+    return data
+
+
+# reads and decodes a timestamped sample
+def read_sample(pi, handle):
+    data = read_raw_block(pi, handle)
+    return decode_sample(data, pi.get_current_tick())
+
+
+# computes SMPLRT_DIV for the requested sample rate in Hz
+def sample_rate_divider(sample_rate, dlpf_enabled=False):
+    output_rate = GYRO_OUTPUT_RATE_DLPF if dlpf_enabled else GYRO_OUTPUT_RATE
+    divider = int(round(output_rate / sample_rate)) - 1
+    return min(max(divider, 0), 255)
+
+
+# decodes a whole number of FIFO packets into a batch of samples
+def decode_fifo(data, ticks):
+    raw = np.frombuffer(bytes(data), dtype='>i2').reshape(-1, FIFO_PACKET_LENGTH // 2)
+    batch = np.empty(raw.shape[0], dtype=FIFO_SAMPLE_DTYPE)
+    batch['tick'] = ticks
+    batch['accel'] = raw[:, 0:3] * ACCEL_SCALE
+    batch['gyro'] = raw[:, 3:6] * GYRO_SCALE
+    return batch
+
+
+# streams accel and gyro samples out of the MPU6050 hardware FIFO
+class MPU6050Fifo(object):
+    def __init__(self, handle, sample_rate, dlpf_enabled=False):
+        self.handle = handle
+        self.dlpf_enabled = dlpf_enabled
+        self.divider = sample_rate_divider(sample_rate, dlpf_enabled)
+        output_rate = GYRO_OUTPUT_RATE_DLPF if dlpf_enabled else GYRO_OUTPUT_RATE
+        # actual sample rate after rounding the divider
+        self.sample_rate = output_rate / (1 + self.divider)
+        # sample period in microseconds, used to reconstruct timestamps
+        self.period = 1e6 / self.sample_rate
+        # number of times the FIFO filled up and had to be reset
+        self.overflow_count = 0
+        # total number of samples delivered
+        self.sample_count = 0
+
+    # sets the sample rate and starts writing accel and gyro data into the FIFO
+    def enable(self, pi):
+        pi.i2c_write_byte_data(self.handle, SMPLRT_DIV, self.divider)
+        pi.i2c_write_byte_data(self.handle, FIFO_EN, FIFO_EN_XYZG_ACCEL)
+        self.reset(pi)
+
+    # stops writing to the FIFO
+    def disable(self, pi):
+        pi.i2c_write_byte_data(self.handle, FIFO_EN, 0x00)
+        pi.i2c_write_byte_data(self.handle, USER_CTRL, 0x00)
+
+    # clears the FIFO contents and re-enables it
+    def reset(self, pi):
+        pi.i2c_write_byte_data(self.handle, USER_CTRL, USER_CTRL_FIFO_RESET)
+        pi.i2c_write_byte_data(self.handle, USER_CTRL, USER_CTRL_FIFO_EN)
+
+    # number of bytes waiting in the FIFO
+    def read_count(self, pi):
+        count, data = pi.i2c_read_i2c_block_data(self.handle, FIFO_COUNT_H, 2)
+        return (data[0] << 8) | data[1]
+
+    # reads every complete sample in the FIFO and returns them as a batch
+    def drain(self, pi):
+        fifo_count = self.read_count(pi)
+        tick = pi.get_current_tick()
+
+        # once the FIFO is full the oldest bytes are overwritten and packet alignment is lost
+        if fifo_count >= FIFO_SIZE:
+            self.overflow_count += 1
+            self.reset(pi)
+            return np.empty(0, dtype=FIFO_SAMPLE_DTYPE)
+
+        n = fifo_count // FIFO_PACKET_LENGTH
+        remaining = n * FIFO_PACKET_LENGTH
+        data = bytearray()
+        while remaining > 0:
+            count, chunk = pi.i2c_read_i2c_block_data(self.handle, FIFO_R_W, min(remaining, FIFO_MAX_BLOCK))
+            if count <= 0:
+                raise IOError('MPU6050 FIFO read failed')
+            data += chunk[:count]
+            remaining -= count
+
+        # the newest sample was written just before FIFO_COUNT was read
+        ticks = tick - self.period * np.arange(n - 1, -1, -1)
+        self.sample_count += n
+        return decode_fifo(data, ticks)
+
+
+# waits for the MPU6050 data ready interrupt instead of polling the data registers
+class MPU6050DataReady(object):
+    def __init__(self, handle, int_gpio):
+        self.handle = handle
+        self.INT_GPIO = int_gpio
+        self.callback = None
+        self.ready = threading.Event()
+        # pigpio tick of the most recent data ready edge
+        self.edge_tick = None
+        # number of edges seen and samples actually read
+        self.edge_count = 0
+        self.read_count = 0
+        # edges that arrived before the previous sample was read
+        self.missed_count = 0
+        self.last_tick = None
+
+    # registers the edge callback on the interrupt pin
+    def start(self, pi):
+        # the INT pin is active high and pulses for 50 us on every new sample once
+        # DATA_RDY_EN is set in INT_ENABLE, which setupMPU6050 already does
+        pi.set_mode(self.INT_GPIO, pigpio.INPUT)
+        self.callback = pi.callback(self.INT_GPIO, pigpio.RISING_EDGE, self.cbf)
+
+    def stop(self):
+        if self.callback is not None:
+            self.callback.cancel()
+            self.callback = None
+
+    # runs in the pigpio callback thread, so only records the tick
+    def cbf(self, gpio, level, tick):
+        self.edge_tick = tick
+        self.edge_count += 1
+        self.ready.set()
+
+    # blocks until a new sample is ready, then reads it stamped with the interrupt tick
+    # returns None if no interrupt arrives within timeout seconds
+    def wait_sample(self, pi, timeout=0.1):
+        if not self.ready.wait(timeout):
+            return None
+        self.ready.clear()
+        tick = self.edge_tick
+        edges = self.edge_count
+
+        data = read_raw_block(pi, self.handle)
+
+        self.missed_count += max(edges - self.read_count - 1, 0)
+        self.read_count = edges
+        self.last_tick = tick
+        return decode_sample(data, tick)
@@ -0,0 +1,259 @@
+import math
+import time
+import numpy as np
+
+# Position and velocity from the accelerometer, the sonar and the GPS.
+# The world frame is x east, y north, z up, with its origin on the ground below the first GPS
+# fix; the attitude quaternions (w, x, y, z) rotate body to world, as the estimators.py filters
+# keep them, and need a heading referenced to north (from the magnetometer) for GPS to help.
+# Once the specific force is rotated into the world frame the three axes do not interact, so
+# each axis is its own [position, velocity] filter. The covariance is three 2x2 blocks kept as
+# their 3 unique entries, and every measurement is a scalar update on one axis: a prediction is
+# about 40 and an update about 15 scalar operations, with no matrices.
+# There is no accelerometer bias state. The bias is fixed in the body frame, so in the world
+# frame it turns with the attitude and a per axis random walk cannot follow it, while estimating
+# it in the body frame would couple the axes again. The offsets of the calibration store are
+# removed before predict, and what remains is covered by the acceleration noise.
+# Every timestamp is in seconds of time.monotonic(), the clock of the scheduler SensorState.
+
+G = 9.80665
+EARTH_RADIUS = 6371000.0
+DEG = math.pi / 180
+
+# accelerometer noise in m/s^2/sqrt(Hz), including the residual bias
+ACCEL_NOISE = 0.5
+
+# measurement standard deviations in m
+SONAR_STD = 0.03
+GPS_HORIZONTAL_STD = 2.5
+GPS_VERTICAL_STD = 5.0
+
+# measurements further than this many standard deviations from the prediction are rejected
+GATE = 5.0
+
+# LV-MaxSonar-EZ range limits in m, and the tilt beyond which the beam misses the ground below
+SONAR_MIN = 0.15
+SONAR_MAX = 6.45
+SONAR_MAX_TILT = 30.0
+
+# covariance of a new filter, position m^2, velocity (m/s)^2
+INITIAL_POSITION_COV = 100.0
+INITIAL_VELOCITY_COV = 1.0
+
+
+# what a position controller reads every loop
+class NavigationState(object):
+    def __init__(self, timestamp, position, velocity, position_std, velocity_std, sonar_age, gps_age):
+        self.timestamp = timestamp
+        # m and m/s in the world frame
+        self.position = position
+        self.velocity = velocity
+        self.position_std = position_std
+        self.velocity_std = velocity_std
+        # seconds since the last accepted measurement of each kind, infinite before the first
+        self.sonar_age = sonar_age
+        self.gps_age = gps_age
+
+
+class NavigationEKF(object):
+    def __init__(self, accel_noise=ACCEL_NOISE):
+        self.accel_noise = accel_noise
+        self.reset()
+
+    def reset(self):
+        # per axis [position, velocity]
+        self.x = [[0.0, 0.0] for axis in range(3)]
+        # per axis [pp, pv, vv]
+        self.P = [[INITIAL_POSITION_COV, 0.0, INITIAL_VELOCITY_COV] for axis in range(3)]
+        # attitude of the last prediction
+        self.q = (1.0, 0.0, 0.0, 0.0)
+        self.time = None
+        # (latitude, longitude, altitude) of the world origin, set by the first GPS fix
+        self.origin = None
+        self.last_sonar = None
+        self.last_gps = None
+        self.rejected_count = 0
+        # update counts of the SensorState entries already applied by consume
+        self.consumed = {}
+
+    # advances the state by dt seconds with the specific force accel (G's, +1 G on z when level)
+    # measured in the body frame with attitude q, at timestamp (time.monotonic() if not given)
+    def predict(self, accel, q, dt, timestamp=None):
+        self.q = q
+        w, x, y, z = q
+        fx, fy, fz = accel
+        # body to world, then remove gravity
+        ax = ((1 - 2 * (y * y + z * z)) * fx + 2 * (x * y - w * z) * fy + 2 * (x * z + w * y) * fz) * G
+        ay = (2 * (x * y + w * z) * fx + (1 - 2 * (x * x + z * z)) * fy + 2 * (y * z - w * x) * fz) * G
+        az = (2 * (x * z - w * y) * fx + 2 * (y * z + w * x) * fy + (1 - 2 * (x * x + y * y)) * fz - 1) * G
+
+        h = 0.5 * dt * dt
+        # continuous white acceleration noise over dt
+        qa = self.accel_noise * self.accel_noise
+        q_pp, q_pv, q_vv = qa * dt * dt * dt / 3, qa * h, qa * dt
+        for state, P, a in zip(self.x, self.P, (ax, ay, az)):
+            p, v = state
+            state[0] = p + v * dt + h * a
+            state[1] = v + a * dt
+            # F P F' with F = [[1, dt], [0, 1]]
+            pp, pv, vv = P
+            P[0] = pp + dt * (2 * pv + dt * vv) + q_pp
+            P[1] = pv + dt * vv + q_pv
+            P[2] = vv + q_vv
+        self.time = time.monotonic() if timestamp is None else timestamp
+
+    # scalar update of axis with a measurement of k times its position, returns False if gated out
+    def update_position(self, axis, measurement, variance, k=1.0):
+        state = self.x[axis]
+        P = self.P[axis]
+        pp, pv, vv = P
+        innovation = measurement - k * state[0]
+        S = k * k * pp + variance
+        if innovation * innovation > GATE * GATE * S:
+            self.rejected_count += 1
+            return False
+        g = k / S
+        state[0] += g * pp * innovation
+        state[1] += g * pv * innovation
+        g *= k
+        P[0] = pp - g * pp * pp
+        P[1] = pv - g * pp * pv
+        P[2] = vv - g * pv * pv
+        return True
+
+    # height above the ground in m, already tilt compensated
+    def update_altitude(self, altitude, std=SONAR_STD, timestamp=None):
+        if self.update_position(2, altitude, std * std):
+            self.last_sonar = self.time if timestamp is None else timestamp
+            return True
+        return False
+
+    # raw sonar range in m along the body -z axis, compensated with the attitude of the last prediction
+    def update_sonar(self, distance, timestamp=None):
+        w, x, y, z = self.q
+        # cosine of the tilt, the world z component of the body z axis
+        c = 1 - 2 * (x * x + y * y)
+        if not SONAR_MIN <= distance <= SONAR_MAX or c < math.cos(SONAR_MAX_TILT * DEG):
+            self.rejected_count += 1
+            return False
+        # the range to flat ground is altitude / c
+        if self.update_position(2, distance, SONAR_STD * SONAR_STD, 1 / c):
+            self.last_sonar = self.time if timestamp is None else timestamp
+            return True
+        return False
+
+    # latitude and longitude in degrees, altitude above sea level in m
+    # the first fix becomes the origin, placed so that it does not move the altitude estimate
+    def update_gps(self, latitude, longitude, altitude, horizontal_std=GPS_HORIZONTAL_STD,
+                   vertical_std=GPS_VERTICAL_STD, timestamp=None):
+        if self.origin is None:
+            self.origin = (latitude, longitude, altitude - self.x[2][0])
+            for axis in (0, 1):
+                self.x[axis][0] = 0.0
+                self.P[axis][0] = horizontal_std * horizontal_std
+                self.P[axis][1] = 0.0
+            self.last_gps = self.time if timestamp is None else timestamp
+            return True
+        east, north = self.local_position(latitude, longitude)
+        accepted = self.update_position(0, east, horizontal_std * horizontal_std)
+        accepted = self.update_position(1, north, horizontal_std * horizontal_std) and accepted
+        self.update_position(2, altitude - self.origin[2], vertical_std * vertical_std)
+        if accepted:
+            self.last_gps = self.time if timestamp is None else timestamp
+        return accepted
+
+    # east and north in m of a position relative to the origin, flat earth around the origin,
+    # which unlike Web Mercator keeps true distances at any latitude
+    def local_position(self, latitude, longitude):
+        latitude0, longitude0 = self.origin[0], self.origin[1]
+        return ((longitude - longitude0) * DEG * EARTH_RADIUS * math.cos(latitude0 * DEG),
+                (latitude - latitude0) * DEG * EARTH_RADIUS)
+
+    # applies the 'sonar' (m) and 'gps' (latitude, longitude, altitude) entries of a scheduler
+    # SensorState that arrived since the last call, as they arrive and at whatever rate
+    # the SensorState timestamps are time.monotonic(), the same clock as the predict timestamps
+    def consume(self, sensor_state):
+        for name in ('sonar', 'gps'):
+            value, timestamp, count = sensor_state.get(name)
+            if count == self.consumed.get(name, 0):
+                continue
+            self.consumed[name] = count
+            if name == 'sonar':
+                self.update_sonar(value, timestamp)
+            else:
+                self.update_gps(value[0], value[1], value[2], timestamp=timestamp)
+
+    def state(self, now=None):
+        now = self.time if now is None else now
+        return NavigationState(self.time,
+                               np.array([state[0] for state in self.x]),
+                               np.array([state[1] for state in self.x]),
+                               np.sqrt([P[0] for P in self.P]),
+                               np.sqrt([P[2] for P in self.P]),
+                               float('inf') if self.last_sonar is None or now is None else now - self.last_sonar,
+                               float('inf') if self.last_gps is None or now is None else now - self.last_gps)
+
+
+if __name__ == "__main__":
+    from sim_devices import rotate_inverse
+
+    # a 60 s flight around a 10 m circle starting at the origin, with the altitude varying
+    # around 2 m and the vehicle rocking in roll and pitch, IMU at 1 kHz, sonar at 20 Hz and
+    # GPS at 5 Hz, and the body frame accelerometer bias left after the calibration offsets
+    rng = np.random.default_rng(2)
+    rate, duration = 1000, 60.0
+    count = int(rate * duration)
+    t = np.arange(count) / rate
+    omega = 2 * np.pi / 20
+    position = np.column_stack((10 * np.cos(omega * t) - 10, 10 * np.sin(omega * t), 2 + 0.5 * np.sin(0.5 * t)))
+    acceleration = np.column_stack((-10 * omega ** 2 * np.cos(omega * t), -10 * omega ** 2 * np.sin(omega * t),
+                                    -0.125 * np.sin(0.5 * t)))
+    roll, pitch, yaw = 10 * DEG * np.sin(0.7 * t) / 2, 8 * DEG * np.cos(0.4 * t) / 2, omega * t / 2
+    cr, sr, cp, sp, cy, sy = np.cos(roll), np.sin(roll), np.cos(pitch), np.sin(pitch), np.cos(yaw), np.sin(yaw)
+    quaternions = np.column_stack((cr * cp * cy + sr * sp * sy, sr * cp * cy - cr * sp * sy,
+                                   cr * sp * cy + sr * cp * sy, cr * cp * sy - sr * sp * cy))
+    bias = np.array([0.003, -0.002, 0.005])
+    accel = np.array([rotate_inverse(quaternions[i], acceleration[i] / G + [0.0, 0.0, 1.0]) for i in range(count)])
+    accel += bias + 0.01 * rng.standard_normal(accel.shape)
+    tilt_cos = 1 - 2 * (quaternions[:, 1] ** 2 + quaternions[:, 2] ** 2)
+    sonar = position[:, 2] / tilt_cos + 0.02 * rng.standard_normal(count)
+    latitude0, longitude0, altitude0 = 42.4477, -76.4838, 250.0
+    gps = np.column_stack((latitude0 + (position[:, 1] + 1.5 * rng.standard_normal(count)) / (DEG * EARTH_RADIUS),
+                           longitude0 + (position[:, 0] + 1.5 * rng.standard_normal(count))
+                           / (DEG * EARTH_RADIUS * math.cos(latitude0 * DEG)),
+                           altitude0 + position[:, 2] + 3.0 * rng.standard_normal(count)))
+
+    ekf = NavigationEKF()
+    estimate = np.empty((count, 3))
+    predict_time = update_time = 0.0
+    updates = 0
+    q_list = [tuple(q) for q in quaternions.tolist()]
+    accel_list = [tuple(a) for a in accel.tolist()]
+    for i in range(count):
+        start = time.perf_counter()
+        ekf.predict(accel_list[i], q_list[i], 1.0 / rate, t[i])
+        predict_time += time.perf_counter() - start
+        start = time.perf_counter()
+        if i % 50 == 0:
+            ekf.update_sonar(sonar[i])
+            updates += 1
+        if i % 200 == 0:
+            if ekf.origin is None:
+                # a noise free first fix, so the estimate and the truth share their origin
+                ekf.update_gps(latitude0, longitude0, altitude0 + position[i, 2])
+            else:
+                ekf.update_gps(*gps[i])
+            updates += 1
+        update_time += time.perf_counter() - start
+        estimate[i] = ekf.x[0][0], ekf.x[1][0], ekf.x[2][0]
+
+    settled = t >= 10.0
+    error = np.sqrt(np.mean((estimate[settled] - position[settled]) ** 2, axis=0))
+    gps_steps = np.arange(0, count, 200)[t[np.arange(0, count, 200)] >= 10.0]
+    gps_error = np.sqrt(np.mean(((gps[gps_steps, :2] - [latitude0, longitude0])
+                                 * [DEG * EARTH_RADIUS, DEG * EARTH_RADIUS * math.cos(latitude0 * DEG)]
+                                 - position[gps_steps][:, [1, 0]]) ** 2, axis=0))
+    print("predict {0:.1f} us, {1:.1f} us per measurement update".format(predict_time / count * 1e6,
+                                                                         update_time / updates * 1e6))
+    print("rms position error: east {0:.2f} m, north {1:.2f} m, up {2:.3f} m (raw GPS {3:.2f} m, {4:.2f} m)".format(
+        error[0], error[1], error[2], gps_error[1], gps_error[0]))
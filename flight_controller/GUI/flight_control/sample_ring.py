@@ -0,0 +1,239 @@
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+# A fixed size ring of sensor samples in shared memory, written by one acquisition process
+# and read by any number of other processes. There are no locks: every slot carries the
+# sequence number of the sample in it and the header carries the number of samples written,
+# so a reader can tell which samples are new and detect a slot overwritten while copying it.
+
+# sample flags
+FLAG_ACCEL = 0x01
+FLAG_GYRO = 0x02
+FLAG_MAG = 0x04
+FLAG_MAG_OVERFLOW = 0x08
+# the acquisition process failed to read the sensors, the other fields are not valid
+FLAG_READ_ERROR = 0x80
+
+SAMPLE_DTYPE = np.dtype([('seq', np.int64),
+                         ('tick', np.float64),
+                         ('accel', np.float64, (3,)),
+                         ('gyro', np.float64, (3,)),
+                         ('mag', np.float64, (3,)),
+                         ('temperature', np.float64),
+                         ('flags', np.uint32)])
+
+# header words, padded to a cache line so the samples start aligned
+_HEADER_WRITE_COUNT = 0
+_HEADER_CAPACITY = 1
+_HEADER_COUNTERS = 2
+_HEADER_SIZE = 64
+
+
+# bytes taken by count counter words, padded to whole cache lines
+def _counters_size(count):
+    return -(-count * 8 // _HEADER_SIZE) * _HEADER_SIZE
+
+
+class SampleRing(object):
+    # creates a new ring of capacity samples, or attaches to an existing one by name
+    # counters reserves that many int64 words next to the header for the writer's own statistics
+    def __init__(self, capacity=1024, name=None, create=True, counters=0):
+        if create:
+            size = _HEADER_SIZE + _counters_size(counters) + capacity * SAMPLE_DTYPE.itemsize
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.header = np.ndarray((_HEADER_SIZE // 8,), dtype=np.int64, buffer=self.shm.buf)
+        if create:
+            self.header[:] = 0
+            self.header[_HEADER_CAPACITY] = capacity
+            self.header[_HEADER_COUNTERS] = counters
+        self.capacity = int(self.header[_HEADER_CAPACITY])
+        counters = int(self.header[_HEADER_COUNTERS])
+        self.counters = np.ndarray((counters,), dtype=np.int64, buffer=self.shm.buf, offset=_HEADER_SIZE)
+        if create:
+            self.counters[:] = 0
+        self.samples = np.ndarray((self.capacity,), dtype=SAMPLE_DTYPE, buffer=self.shm.buf,
+                                  offset=_HEADER_SIZE + _counters_size(counters))
+        if create:
+            self.samples['seq'] = -1
+        self.owner = create
+        # samples a reader missed because the writer lapped it
+        self.overrun_count = 0
+
+    # attaches to a ring created by another process
+    @classmethod
+    def attach(cls, name):
+        return cls(name=name, create=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # number of samples written so far, the sequence number of the next sample
+    def write_count(self):
+        return int(self.header[_HEADER_WRITE_COUNT])
+
+    # appends a sample, only one process may write
+    def write(self, tick, accel, gyro, mag=None, temperature=0.0, flags=FLAG_ACCEL | FLAG_GYRO):
+        seq = int(self.header[_HEADER_WRITE_COUNT])
+        slot = self.samples[seq % self.capacity]
+        # invalidate the slot first so a reader copying it can see it changed
+        slot['seq'] = -1
+        slot['tick'] = tick
+        slot['accel'] = accel
+        slot['gyro'] = gyro
+        if mag is not None:
+            slot['mag'] = mag
+            flags |= FLAG_MAG
+        slot['temperature'] = temperature
+        slot['flags'] = flags
+        slot['seq'] = seq
+        # publish
+        self.header[_HEADER_WRITE_COUNT] = seq + 1
+
+    # returns a copy of the newest sample, or None if nothing was written yet
+    def latest(self):
+        while True:
+            count = int(self.header[_HEADER_WRITE_COUNT])
+            if count == 0:
+                return None
+            slot = self.samples[(count - 1) % self.capacity]
+            # seqlock: the slot is only valid if its shared seq was the expected one both before
+            # and after the copy, the writer sets it to -1 while it overwrites the slot
+            if slot['seq'] == count - 1:
+                sample = slot.copy()
+                if slot['seq'] == count - 1:
+                    return sample
+            # the writer wrapped around onto this slot while it was copied, try the new newest
+
+    # returns (samples, next_seq) with every sample from sequence number seq onwards
+    # pass next_seq back in on the following call
+    def read_new(self, seq):
+        count = int(self.header[_HEADER_WRITE_COUNT])
+        start = max(seq, count - self.capacity)
+        self.overrun_count += start - seq
+        if start >= count:
+            return np.empty(0, dtype=SAMPLE_DTYPE), count
+        expected = np.arange(start, count)
+        slots = expected % self.capacity
+        # seqlock: a slot is only valid if its shared seq was the expected one both before and
+        # after the copy, a seq taken from the copy alone can predate a concurrent overwrite
+        before = self.samples['seq'][slots]
+        batch = self.samples[slots]
+        after = self.samples['seq'][slots]
+        valid = (before == expected) & (after == expected)
+        if not valid.all():
+            self.overrun_count += int((~valid).sum())
+            batch = batch[valid]
+        return batch, count
+
+    # blocks until a sample after seq is written, returns (samples, next_seq)
+    # samples is empty if nothing arrives within timeout seconds
+    def wait_new(self, seq, timeout=0.1, interval=0.0002):
+        end = time.monotonic() + timeout
+        while int(self.header[_HEADER_WRITE_COUNT]) <= seq and time.monotonic() < end:
+            time.sleep(interval)
+        return self.read_new(seq)
+
+    # blocks until a sample after seq is written, returns (newest sample, next_seq) skipping any
+    # older ones, or (None, seq) if nothing arrives within timeout seconds
+    def wait_latest(self, seq, timeout=0.1, interval=0.0002):
+        end = time.monotonic() + timeout
+        while int(self.header[_HEADER_WRITE_COUNT]) <= seq:
+            if time.monotonic() >= end:
+                return None, seq
+            time.sleep(interval)
+        sample = self.latest()
+        return sample, int(sample['seq']) + 1
+
+    def close(self):
+        self.header = None
+        self.counters = None
+        self.samples = None
+        self.shm.close()
+
+    # frees the shared memory, called by the process that created the ring
+    def unlink(self):
+        self.shm.unlink()
+
+
+# entry point of the acquisition process: reads the MPU6050 and AK8963 together and writes
+# each sample into the ring until stop is set. If int_gpio is given each read is triggered by
+# the data ready interrupt and stamped with its tick, otherwise reads are paced by period seconds
+def run_acquisition(ring_name, stop, mpu6050_addr=0x68, int_gpio=None, period=0.001):
+    import pigpio
+    from i2c_batch import MotionReader
+    from mpu6050 import MPU6050DataReady
+
+    ring = SampleRing.attach(ring_name)
+    pi = pigpio.pi()
+    handle = pi.i2c_open(1, mpu6050_addr, 0)
+    reader = MotionReader(mpu6050_addr)
+    data_ready = None
+    if int_gpio is not None:
+        data_ready = MPU6050DataReady(handle, int_gpio)
+        data_ready.start(pi)
+
+    try:
+        next_time = time.monotonic()
+        while not stop.is_set():
+            tick = None
+            if data_ready is not None:
+                if not data_ready.ready.wait(0.1):
+                    ring.write(0, np.zeros(3), np.zeros(3), flags=FLAG_READ_ERROR)
+                    continue
+                data_ready.ready.clear()
+                tick = data_ready.edge_tick
+            else:
+                next_time += period
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            try:
+                sample = reader.read(pi, handle)
+            except (IOError, pigpio.error):
+                ring.write(0, np.zeros(3), np.zeros(3), flags=FLAG_READ_ERROR)
+                continue
+
+            flags = FLAG_ACCEL | FLAG_GYRO
+            if sample.mag_overflow:
+                flags |= FLAG_MAG_OVERFLOW
+            ring.write(sample.tick if tick is None else tick, sample.accel, sample.gyro,
+                       sample.mag if sample.mag_ready else None, sample.temperature, flags)
+    finally:
+        if data_ready is not None:
+            data_ready.stop()
+        pi.i2c_close(handle)
+        pi.stop()
+        ring.close()
+
+
+if __name__ == "__main__":
+    import multiprocessing
+
+    # writer and reader in separate processes, reporting how far the reader falls behind
+    def writer(name, count):
+        ring = SampleRing.attach(name)
+        for i in range(count):
+            ring.write(i, np.ones(3), np.ones(3), np.ones(3))
+        ring.close()
+
+    ring = SampleRing(4096)
+    count = 100000
+    process = multiprocessing.Process(target=writer, args=(ring.name, count))
+    start = time.perf_counter()
+    process.start()
+    seq = 0
+    received = 0
+    while seq < count:
+        batch, seq = ring.wait_new(seq, timeout=1.0)
+        received += batch.size
+    process.join()
+    elapsed = time.perf_counter() - start
+    print("{0} samples in {1:.3f} s ({2:.1f} us each), {3} received, {4} overrun".format(
+        count, elapsed, elapsed / count * 1e6, received, ring.overrun_count))
+    ring.close()
+    ring.unlink()
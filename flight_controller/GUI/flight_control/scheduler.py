@@ -0,0 +1,292 @@
+import heapq
+import struct
+import threading
+import time
+import numpy as np
+from mpu6050 import *
+from ak8963 import *
+
+# Runs every sensor at its own native rate instead of reading all of them once per loop.
+# Fast bus reads share one scheduler thread and run earliest deadline first; sources that
+# block (a serial GPS, a sonar waiting for its echo) get a thread each so they can never
+# delay the fast ones. Every source publishes into one SensorState.
+
+# default rates in Hz
+GYRO_RATE = 1000
+ACCEL_RATE = 500
+MAG_RATE = 100
+SONAR_RATE = 20
+GPS_RATE = 5
+
+# errors a failed read raises, counted instead of ending the thread the task runs in
+# pigpio raises pigpio.error rather than IOError
+try:
+    import pigpio
+    READ_ERRORS = (IOError, OSError, ValueError, pigpio.error)
+except ImportError:
+    READ_ERRORS = (IOError, OSError, ValueError)
+
+# sonar pulse width conversion, 147 us per inch
+SONAR_US_PER_INCH = 147
+INCH = 0.0254
+
+
+# the latest value of every source with the time it was measured
+class SensorState(object):
+    def __init__(self):
+        # name -> (value, timestamp, update count)
+        self.values = {}
+
+    # each entry is replaced by a new tuple, so readers in other threads never see half an update
+    def update(self, name, value, timestamp):
+        previous = self.values.get(name)
+        self.values[name] = (value, timestamp, 1 if previous is None else previous[2] + 1)
+
+    # returns (value, timestamp, update count), or (None, None, 0) before the first update
+    def get(self, name):
+        return self.values.get(name, (None, None, 0))
+
+    # seconds since name was last updated, infinite if it never was
+    def age(self, name, now=None):
+        timestamp = self.get(name)[1]
+        if timestamp is None:
+            return float('inf')
+        return (time.monotonic() if now is None else now) - timestamp
+
+    # a consistent copy of every entry
+    def snapshot(self):
+        return dict(self.values)
+
+
+# a source read at a fixed rate, read() returns the new value or None if there is nothing new
+class SensorTask(object):
+    def __init__(self, name, rate, read, blocking=False):
+        self.name = name
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.read = read
+        self.blocking = blocking
+        self.next_time = 0.0
+        # reads that produced a value, reads that had nothing new, deadlines skipped because
+        # the task was late, reads that raised
+        self.update_count = 0
+        self.empty_count = 0
+        self.missed_count = 0
+        self.error_count = 0
+        # seconds spent in read()
+        self.busy_time = 0.0
+
+    # runs one read and publishes the result
+    def run(self, state):
+        start = time.monotonic()
+        try:
+            value = self.read()
+        except READ_ERRORS:
+            self.error_count += 1
+            value = None
+        end = time.monotonic()
+        self.busy_time += end - start
+        if value is None:
+            self.empty_count += 1
+        else:
+            self.update_count += 1
+            state.update(self.name, value, start)
+
+    # moves the deadline on by one period, skipping any already missed
+    def advance(self, now):
+        self.next_time += self.period
+        if self.next_time < now:
+            missed = int((now - self.next_time) / self.period) + 1
+            self.missed_count += missed
+            self.next_time += missed * self.period
+
+
+class MultiRateScheduler(object):
+    def __init__(self, state=None):
+        self.state = SensorState() if state is None else state
+        self.tasks = []
+        self.running = False
+        self.threads = []
+
+    # adds a source, blocking sources get their own thread
+    def add(self, name, rate, read, blocking=False):
+        task = SensorTask(name, rate, read, blocking)
+        self.tasks.append(task)
+        return task
+
+    def task(self, name):
+        for task in self.tasks:
+            if task.name == name:
+                return task
+        return None
+
+    def start(self):
+        self.running = True
+        now = time.monotonic()
+        for task in self.tasks:
+            task.next_time = now
+        fast = [task for task in self.tasks if not task.blocking]
+        if fast:
+            self.threads.append(threading.Thread(target=self.run_fast, args=(fast,)))
+        for task in self.tasks:
+            if task.blocking:
+                self.threads.append(threading.Thread(target=self.run_blocking, args=(task,)))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join(1.0)
+        self.threads = []
+
+    # earliest deadline first over the non blocking tasks
+    def run_fast(self, tasks):
+        queue = [(task.next_time, i) for i, task in enumerate(tasks)]
+        heapq.heapify(queue)
+        while self.running:
+            due, i = queue[0]
+            delay = due - time.monotonic()
+            if delay > 0.0002:
+                time.sleep(delay - 0.0001)
+                continue
+            task = tasks[i]
+            task.run(self.state)
+            task.advance(time.monotonic())
+            heapq.heapreplace(queue, (task.next_time, i))
+
+    def run_blocking(self, task):
+        while self.running:
+            delay = task.next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            task.run(self.state)
+            task.advance(time.monotonic())
+
+    # rate actually achieved by each task since start, and its share of one core
+    def statistics(self, elapsed):
+        stats = {}
+        for task in self.tasks:
+            stats[task.name] = {'rate': task.update_count / elapsed, 'target': task.rate,
+                                'empty': task.empty_count, 'missed': task.missed_count,
+                                'errors': task.error_count, 'load': task.busy_time / elapsed}
+        return stats
+
+
+# gyroscope registers only, in deg/s
+def gyro_source(pi, mpu6050_handle):
+    def read():
+        count, data = pi.i2c_read_i2c_block_data(mpu6050_handle, GYRO_XOUT_H, 6)
+        return np.array(struct.unpack('>3h', data)) * GYRO_SCALE
+    return read
+
+
+# accelerometer registers only, in G's
+def accel_source(pi, mpu6050_handle):
+    def read():
+        count, data = pi.i2c_read_i2c_block_data(mpu6050_handle, ACCEL_XOUT_H, 6)
+        return np.array(struct.unpack('>3h', data)) * ACCEL_SCALE
+    return read
+
+
+# AK8963 field counts, None when the sensor has no new measurement
+def mag_source(pi, ak8963_handle):
+    def read():
+        mag, ready, overflow = read_mag(pi, ak8963_handle)
+        if not ready or overflow:
+            return None
+        return mag
+    return read
+
+
+# LV-MaxSonar-EZ pulse width output, the edge callback only records the pulse and the
+# task converts the newest one to meters
+class SonarPulseSource(object):
+    def __init__(self, pi, gpio):
+        import pigpio
+        self.rising = None
+        self.width = None
+        # pulses measured, and the count when the task last read one
+        self.pulse_count = 0
+        self.read_count = 0
+        pi.set_mode(gpio, pigpio.INPUT)
+        self.callback = pi.callback(gpio, pigpio.EITHER_EDGE, self.cbf)
+
+    def cbf(self, gpio, level, tick):
+        if level == 1:
+            self.rising = tick
+        elif level == 0 and self.rising is not None:
+            self.width = (tick - self.rising) & 0xFFFFFFFF
+            self.pulse_count += 1
+
+    def __call__(self):
+        if self.pulse_count == self.read_count:
+            return None
+        self.read_count = self.pulse_count
+        return self.width / SONAR_US_PER_INCH * INCH
+
+
+# (latitude, longitude, altitude) from the $GPGGA sentences of a serial NMEA receiver such as
+# the BU-353S4, blocks on the port so it has to run as a blocking task
+class NMEASource(object):
+    def __init__(self, port):
+        self.port = port
+
+    def __call__(self):
+        line = self.port.readline().decode('ascii', 'replace')
+        fields = line.split(',')
+        if fields[0] != '$GPGGA' or len(fields) < 10 or not fields[2] or fields[6] == '0':
+            return None
+        latitude = self.dms_to_dec(float(fields[2]))
+        if fields[3] == 'S':
+            latitude = -latitude
+        longitude = self.dms_to_dec(float(fields[4]))
+        if fields[5] == 'W':
+            longitude = -longitude
+        altitude = float(fields[9]) if fields[9] else 0.0
+        return np.array([latitude, longitude, altitude])
+
+    # ddmm.mmmm to decimal degrees
+    @staticmethod
+    def dms_to_dec(x):
+        minutes = x % 100
+        degrees = float(int(x / 100))
+        return degrees + minutes / 60
+
+
+# a scheduler with the MPU9250 gyro, accel and magnetometer at their default rates, and the
+# sonar and GPS if given
+def build_scheduler(pi, mpu6050_handle, ak8963_handle=None, sonar=None, gps=None, state=None):
+    scheduler = MultiRateScheduler(state)
+    scheduler.add('gyro', GYRO_RATE, gyro_source(pi, mpu6050_handle))
+    scheduler.add('accel', ACCEL_RATE, accel_source(pi, mpu6050_handle))
+    if ak8963_handle is not None:
+        scheduler.add('mag', MAG_RATE, mag_source(pi, ak8963_handle))
+    if sonar is not None:
+        scheduler.add('sonar', SONAR_RATE, sonar)
+    if gps is not None:
+        scheduler.add('gps', GPS_RATE, gps, blocking=True)
+    return scheduler
+
+
+if __name__ == "__main__":
+    from sim_devices import sim_transport, RotatingTrajectory
+
+    # the full schedule against simulated sensors with a realistic bus latency
+    transport = sim_transport(RotatingTrajectory(), latency=100e-6)
+    mpu6050_handle = transport.i2c_open(1, 0x68, 0)
+    transport.i2c_write_byte_data(mpu6050_handle, GYRO_CONFIG, 0x08)
+    ak8963_handle = setup_ak8963(transport, mpu6050_handle)
+
+    scheduler = build_scheduler(transport, mpu6050_handle, ak8963_handle)
+    start = time.monotonic()
+    scheduler.start()
+    time.sleep(2.0)
+    scheduler.stop()
+    elapsed = time.monotonic() - start
+
+    for name, stats in scheduler.statistics(elapsed).items():
+        print("{0:>6}: {1:7.1f} Hz of {2:5d} Hz, {3} missed, {4} empty, {5:5.1%} load".format(
+            name, stats['rate'], stats['target'], stats['missed'], stats['empty'], stats['load']))
+    print("bus transactions per second: {0:.0f}".format(transport.transaction_count / elapsed))
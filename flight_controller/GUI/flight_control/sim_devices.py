@@ -0,0 +1,517 @@
+import math
+import random
+import struct
+import time
+import numpy as np
+from i2c_transport import RegisterMap, RegisterMapTransport
+
+# In-process models of the MPU6050, AK8963 and BNO055 register maps, driven by a motion
+# trajectory, so the acquisition and control code can be run and profiled without a Pi.
+# Attach them to a RegisterMapTransport (see sim_transport) and pass that wherever a driver
+# expects pi; SimBNO055Serial wraps the BNO055 model as the serial port of the BNO055 class.
+
+STANDARD_GRAVITY = 9.80665
+
+
+# rotates v from the body frame to the world frame by the unit quaternion q = (w, x, y, z)
+def rotate(q, v):
+    w, x, y, z = q
+    vx, vy, vz = v
+    # t = 2 (q_vec x v)
+    tx = 2 * (y * vz - z * vy)
+    ty = 2 * (z * vx - x * vz)
+    tz = 2 * (x * vy - y * vx)
+    return np.array([vx + w * tx + y * tz - z * ty,
+                     vy + w * ty + z * tx - x * tz,
+                     vz + w * tz + x * ty - y * tx])
+
+
+# rotates v from the world frame into the body frame
+def rotate_inverse(q, v):
+    return rotate((q[0], -q[1], -q[2], -q[3]), v)
+
+
+# the true motion of the vehicle at one instant
+class MotionState(object):
+    def __init__(self, quaternion, gyro, linear_accel, mag_field, temperature):
+        # body to world attitude (w, x, y, z)
+        self.quaternion = quaternion
+        # angular rate in the body frame in deg/s
+        self.gyro = gyro
+        # acceleration without gravity in the world frame in G's
+        self.linear_accel = linear_accel
+        # earth field in the world frame in micro-Tesla
+        self.mag_field = mag_field
+        # sensor die temperature in degrees Celsius
+        self.temperature = temperature
+
+    # what an accelerometer measures in the body frame, in G's (+1 G on z when level)
+    def specific_force(self):
+        return rotate_inverse(self.quaternion, self.linear_accel + np.array([0.0, 0.0, 1.0]))
+
+    # what a magnetometer measures in the body frame, in micro-Tesla
+    def body_field(self):
+        return rotate_inverse(self.quaternion, self.mag_field)
+
+
+# level and still
+class StationaryTrajectory(object):
+    def __init__(self, quaternion=(1.0, 0.0, 0.0, 0.0), mag_field=(20.0, 0.0, -45.0), temperature=30.0):
+        self.quaternion = np.asarray(quaternion, dtype=float)
+        self.mag_field = np.asarray(mag_field, dtype=float)
+        self.temperature = temperature
+
+    def state(self, t):
+        return MotionState(self.quaternion, np.zeros(3), np.zeros(3), self.mag_field, self.temperature)
+
+
+# constant rotation about a body axis, e.g. to exercise the magnetometer calibration
+class RotatingTrajectory(object):
+    def __init__(self, rate=(0.0, 0.0, 30.0), mag_field=(20.0, 0.0, -45.0), temperature=30.0):
+        # deg/s in the body frame
+        self.rate = np.asarray(rate, dtype=float)
+        self.mag_field = np.asarray(mag_field, dtype=float)
+        self.temperature = temperature
+
+    def state(self, t):
+        speed = np.linalg.norm(self.rate)
+        if speed == 0:
+            quaternion = np.array([1.0, 0.0, 0.0, 0.0])
+        else:
+            half_angle = math.radians(speed * t) / 2
+            axis = self.rate / speed
+            quaternion = np.concatenate(([math.cos(half_angle)], math.sin(half_angle) * axis))
+        return MotionState(quaternion, self.rate, np.zeros(3), self.mag_field, self.temperature)
+
+
+# plays back a recorded log, interpolating between rows and looping at the end
+class RecordedTrajectory(object):
+    def __init__(self, times, quaternions, gyro, linear_accel=None, mag_field=(20.0, 0.0, -45.0),
+                 temperatures=None):
+        self.times = np.asarray(times, dtype=float) - times[0]
+        self.quaternions = np.asarray(quaternions, dtype=float)
+        self.gyro = np.asarray(gyro, dtype=float)
+        n = self.times.size
+        self.linear_accel = np.zeros((n, 3)) if linear_accel is None else np.asarray(linear_accel, dtype=float)
+        self.mag_field = np.asarray(mag_field, dtype=float)
+        self.temperatures = np.full(n, 30.0) if temperatures is None else np.asarray(temperatures, dtype=float)
+        self.duration = self.times[-1]
+
+    def state(self, t):
+        if self.duration > 0:
+            t = t % self.duration
+        i = min(max(np.searchsorted(self.times, t) - 1, 0), self.times.size - 2)
+        span = self.times[i + 1] - self.times[i]
+        f = 0.0 if span <= 0 else (t - self.times[i]) / span
+
+        # normalized linear interpolation is accurate for the short steps of a log
+        q0 = self.quaternions[i]
+        q1 = self.quaternions[i + 1]
+        if np.dot(q0, q1) < 0:
+            q1 = -q1
+        quaternion = q0 + f * (q1 - q0)
+        quaternion /= np.linalg.norm(quaternion)
+
+        gyro = self.gyro[i] + f * (self.gyro[i + 1] - self.gyro[i])
+        linear_accel = self.linear_accel[i] + f * (self.linear_accel[i + 1] - self.linear_accel[i])
+        temperature = self.temperatures[i] + f * (self.temperatures[i + 1] - self.temperatures[i])
+        return MotionState(quaternion, gyro, linear_accel, self.mag_field, temperature)
+
+
+# clamps and packs a float into a signed 16 bit register value
+def to_int16(value):
+    return int(min(max(round(value), -32768), 32767))
+
+
+# a device whose registers follow a trajectory, time is taken from clock in seconds
+class SimDevice(RegisterMap):
+    def __init__(self, trajectory=None, clock=time.monotonic):
+        RegisterMap.__init__(self)
+        self.trajectory = StationaryTrajectory() if trajectory is None else trajectory
+        self.clock = clock
+        self.start_time = clock()
+
+    def elapsed(self):
+        return self.clock() - self.start_time
+
+
+# MPU6050 (or the MPU6050 part of an MPU9250)
+class SimMPU6050(SimDevice):
+    def __init__(self, trajectory=None, clock=time.monotonic, who_am_i=0x68):
+        SimDevice.__init__(self, trajectory, clock)
+        self.registers[0x75] = who_am_i
+        # PWR_MGMT_1 resets to sleep mode
+        self.registers[0x6B] = 0x40
+        self.fifo = bytearray()
+        self.fifo_overflowed = False
+        # time of the last sample written into the FIFO
+        self.fifo_time = None
+
+    # sample rate in Hz from SMPLRT_DIV and DLPF_CFG
+    def sample_rate(self):
+        dlpf_cfg = self.registers[0x1A] & 0x07
+        output_rate = 8000 if dlpf_cfg in (0, 7) else 1000
+        return output_rate / (1 + self.registers[0x19])
+
+    # accel, temperature and gyro registers for the given time, in register order
+    def sample_bytes(self, t):
+        state = self.trajectory.state(t)
+        # LSB per G for AFS_SEL 0..3 and LSB per deg/s for FS_SEL 0..3
+        accel_lsb = 16384 >> ((self.registers[0x1C] >> 3) & 0x03)
+        gyro_lsb = 131.0 / (1 << ((self.registers[0x1B] >> 3) & 0x03))
+        accel = state.specific_force() * accel_lsb
+        gyro = state.gyro * gyro_lsb
+        temp = (state.temperature - 36.53) * 340
+        return struct.pack('>7h', to_int16(accel[0]), to_int16(accel[1]), to_int16(accel[2]), to_int16(temp),
+                           to_int16(gyro[0]), to_int16(gyro[1]), to_int16(gyro[2]))
+
+    # writes every sample due since the last update into the FIFO
+    def update_fifo(self, now):
+        fifo_en = self.registers[0x23]
+        if not self.registers[0x6A] & 0x40 or fifo_en == 0:
+            self.fifo_time = None
+            return
+        period = 1 / self.sample_rate()
+        if self.fifo_time is None:
+            self.fifo_time = now
+            return
+        while self.fifo_time + period <= now:
+            self.fifo_time += period
+            data = self.sample_bytes(self.fifo_time - self.start_time)
+            # FIFO_EN bits: TEMP 7, XG 6, YG 5, ZG 4, ACCEL 3, written in register order
+            packet = bytearray()
+            if fifo_en & 0x08:
+                packet += data[0:6]
+            if fifo_en & 0x80:
+                packet += data[6:8]
+            for bit, offset in ((0x40, 8), (0x20, 10), (0x10, 12)):
+                if fifo_en & bit:
+                    packet += data[offset:offset + 2]
+            self.fifo += packet
+            # the oldest bytes are dropped once the 1024 byte FIFO is full
+            if len(self.fifo) > 1024:
+                del self.fifo[:len(self.fifo) - 1024]
+                self.fifo_overflowed = True
+                self.registers[0x3A] |= 0x10
+
+    def read(self, register, count):
+        now = self.clock()
+        self.update_fifo(now)
+        data = bytearray()
+        for i in range(count):
+            r = (register + i) & 0xFF
+            if r == 0x74:
+                # reads of FIFO_R_W pop the FIFO without advancing the register address
+                data += self.fifo[0:count - i]
+                del self.fifo[0:count - i]
+                data += bytearray(count - len(data))
+                return data
+            if 0x3B <= r <= 0x48:
+                if i == 0 or r == 0x3B:
+                    block = self.sample_bytes(now - self.start_time)
+                data.append(block[r - 0x3B])
+            elif r == 0x72:
+                data.append((len(self.fifo) >> 8) & 0xFF)
+            elif r == 0x73:
+                data.append(len(self.fifo) & 0xFF)
+            elif r == 0x3A:
+                # INT_STATUS clears on read, data ready is always set
+                data.append(self.registers[r] | 0x01)
+                self.registers[r] = 0
+            else:
+                data.append(self.registers[r])
+        return data
+
+    def write(self, register, data):
+        now = self.clock()
+        self.update_fifo(now)
+        RegisterMap.write(self, register, data)
+        # USER_CTRL FIFO_RESET is self clearing
+        if register <= 0x6A < register + len(data) and self.registers[0x6A] & 0x04:
+            self.fifo = bytearray()
+            self.fifo_overflowed = False
+            self.fifo_time = None
+            self.registers[0x6A] &= ~0x04 & 0xFF
+        # starts the sample clock if this write enabled the FIFO
+        self.update_fifo(now)
+
+
+# AK8963 magnetometer
+class SimAK8963(SimDevice):
+    def __init__(self, trajectory=None, clock=time.monotonic):
+        SimDevice.__init__(self, trajectory, clock)
+        # WIA
+        self.registers[0x00] = 0x48
+        # time of the newest measurement that has not been read yet
+        self.measurement_time = None
+        self.last_read_time = None
+
+    # measurement rate in Hz for the CNTL1 mode, 0 when not measuring continuously
+    def measurement_rate(self):
+        mode = self.registers[0x0A] & 0x0F
+        return {0x02: 8.0, 0x06: 100.0}.get(mode, 0.0)
+
+    def read(self, register, count):
+        now = self.clock()
+        rate = self.measurement_rate()
+        if rate > 0:
+            period = 1 / rate
+            latest = self.start_time + math.floor((now - self.start_time) / period) * period
+            if self.last_read_time is None or latest > self.last_read_time:
+                # ST1 DRDY set, DOR if a measurement was skipped
+                skipped = self.last_read_time is not None and latest - self.last_read_time > period * 1.5
+                self.registers[0x02] = 0x01 | (0x02 if skipped else 0x00)
+                state = self.trajectory.state(latest - self.start_time)
+                # 0.15 uT per LSB in 16 bit output mode, 0.6 in 14 bit mode
+                scale = 0.15 if self.registers[0x0A] & 0x10 else 0.6
+                field = state.body_field() / scale
+                self.registers[0x03:0x09] = struct.pack('<3h', to_int16(field[0]), to_int16(field[1]),
+                                                        to_int16(field[2]))
+                self.registers[0x09] = 0x10 if self.registers[0x0A] & 0x10 else 0x00
+                self.measurement_time = latest
+
+        data = RegisterMap.read(self, register, count)
+        # reading ST2 ends the read and clears data ready
+        if register <= 0x09 < register + count:
+            self.registers[0x02] = 0x00
+            self.last_read_time = self.measurement_time
+        return data
+
+
+# BNO055 page 0 data registers, scaled with the default units (UNIT_SEL = 0)
+class SimBNO055(SimDevice):
+    def __init__(self, trajectory=None, clock=time.monotonic):
+        SimDevice.__init__(self, trajectory, clock)
+        self.page1 = bytearray(256)
+        self.reset()
+
+    # power on values of the identification and status registers
+    def reset(self):
+        self.registers[:] = bytearray(256)
+        self.registers[0x00] = 0xA0
+        self.registers[0x01] = 0xFB
+        self.registers[0x02] = 0x32
+        self.registers[0x03] = 0x0F
+        self.registers[0x04] = 0x11
+        self.registers[0x05] = 0x03
+        self.registers[0x06] = 0x15
+        self.registers[0x36] = 0x0F
+        self.registers[0x39] = 0x00
+        self.registers[0x41] = 0x24
+
+    # fills the output registers from the trajectory when a fusion mode is running
+    def update_outputs(self, t):
+        mode = self.registers[0x3D] & 0x0F
+        if mode == 0:
+            self.registers[0x39] = 0x00
+            return
+        # SYS_STATUS 5 = fusion running, 6 = running without fusion
+        self.registers[0x39] = 0x05 if mode >= 0x08 else 0x06
+        self.registers[0x35] = 0xFF
+
+        state = self.trajectory.state(t)
+        w, x, y, z = state.quaternion
+        heading = math.degrees(math.atan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))) % 360
+        roll = math.degrees(math.atan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y)))
+        pitch = math.degrees(math.asin(min(max(2 * (w * y - z * x), -1.0), 1.0)))
+        gravity = rotate_inverse(state.quaternion, np.array([0.0, 0.0, STANDARD_GRAVITY]))
+        linear = rotate_inverse(state.quaternion, state.linear_accel * STANDARD_GRAVITY)
+        accel = gravity + linear
+        mag = state.body_field()
+        # gyro in dps (16 LSB) or rps (900 LSB) depending on UNIT_SEL bit 1
+        gyro = np.radians(state.gyro) * 900 if self.registers[0x3B] & 0x02 else state.gyro * 16
+
+        values = [accel * 100, mag * 16, gyro, np.array([heading, roll, pitch]) * 16,
+                  np.array([w, x, y, z]) * (1 << 14), linear * 100, gravity * 100]
+        self.registers[0x08:0x34] = struct.pack('<22h', *[to_int16(v) for vector in values for v in vector])
+        self.registers[0x34] = int(round(state.temperature)) & 0xFF
+
+    def read(self, register, count):
+        if self.registers[0x07] == 1:
+            return bytearray(self.page1[(register + i) & 0xFF] for i in range(count))
+        self.update_outputs(self.elapsed())
+        return RegisterMap.read(self, register, count)
+
+    def write(self, register, data):
+        if self.registers[0x07] == 1 and register != 0x07:
+            for i, value in enumerate(data):
+                self.page1[(register + i) & 0xFF] = value & 0xFF
+            return
+        RegisterMap.write(self, register, data)
+        # SYS_TRIGGER RST_SYS
+        if register <= 0x3F < register + len(data) and self.registers[0x3F] & 0x20:
+            self.reset()
+
+
+# the BNO055 UART interface, implementing the pyserial calls the BNO055 class uses so it
+# can be passed as its serial port. Framing from the BNO055 UART application note:
+#   write  0xAA 0x00 reg len data..  ->  0xEE 0x01
+#   read   0xAA 0x01 reg len         ->  0xBB len data..  or  0xEE status
+class SimBNO055Serial(object):
+    def __init__(self, device=None, latency=0.0, bus_error_rate=0.0):
+        self.device = SimBNO055() if device is None else device
+        # seconds from the end of a command to its response, on top of the 115200 baud transfer
+        self.latency = latency
+        # fraction of commands answered with a 0xEE 0x07 bus over run error
+        self.bus_error_rate = bus_error_rate
+        self.timeout = 1
+        # responses with the time they become readable
+        self.pending = []
+        self.rx = bytearray()
+        self.tx = bytearray()
+
+    # time to shift the given number of bytes at 115200 baud, 10 bits per byte
+    def transfer_time(self, length):
+        return length * 10 / 115200.0
+
+    # moves responses that have arrived into the receive buffer
+    def receive(self):
+        now = time.perf_counter()
+        while self.pending and self.pending[0][0] <= now:
+            self.rx += self.pending.pop(0)[1]
+
+    def respond(self, data):
+        ready = time.perf_counter() + self.latency + self.transfer_time(len(data))
+        if self.pending:
+            ready = max(ready, self.pending[-1][0] + self.transfer_time(len(data)))
+        self.pending.append((ready, bytearray(data)))
+
+    def write(self, data):
+        self.tx += bytearray(data)
+        while len(self.tx) >= 4:
+            if self.tx[0] != 0xAA:
+                # the real chip ignores bytes until the next start byte
+                del self.tx[0]
+                continue
+            register = self.tx[2]
+            length = self.tx[3]
+            if self.tx[1] in (0x00, 0x01) and random.random() < self.bus_error_rate:
+                del self.tx[:4 + (length if self.tx[1] == 0x00 else 0)]
+                self.respond([0xEE, 0x07])
+            elif self.tx[1] == 0x00:
+                if len(self.tx) < 4 + length:
+                    break
+                payload = self.tx[4:4 + length]
+                del self.tx[:4 + length]
+                self.device.write(register, payload)
+                # a system reset is never acknowledged
+                if not (register == 0x3F and payload[0] & 0x20):
+                    self.respond([0xEE, 0x01])
+            elif self.tx[1] == 0x01:
+                del self.tx[:4]
+                # 0xEE 0x0A is a read length error
+                if length == 0 or length > 128:
+                    self.respond([0xEE, 0x0A])
+                else:
+                    self.respond(bytearray([0xBB, length]) + self.device.read(register, length))
+            else:
+                del self.tx[:4]
+                self.respond([0xEE, 0x06])
+        return len(data)
+
+    # blocks up to timeout seconds for size bytes, like a pyserial port
+    def read(self, size=1):
+        end = time.perf_counter() + self.timeout
+        self.receive()
+        while len(self.rx) < size and self.pending and self.pending[0][0] <= end:
+            time.sleep(max(self.pending[0][0] - time.perf_counter(), 0))
+            self.receive()
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        return data
+
+    @property
+    def in_waiting(self):
+        self.receive()
+        return len(self.rx)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def flushInput(self):
+        self.receive()
+        self.rx = bytearray()
+
+    def reset_input_buffer(self):
+        self.flushInput()
+
+    def close(self):
+        pass
+
+
+# adds per transaction latency to a RegisterMapTransport, to mimic a real bus
+class SimTransport(RegisterMapTransport):
+    def __init__(self, devices=None, latency=0.0):
+        RegisterMapTransport.__init__(self, devices)
+        # seconds each transaction takes
+        self.latency = latency
+        self.transaction_count = 0
+
+    # busy waits, sleeping is far too coarse for tens of microseconds
+    def delay(self):
+        self.transaction_count += 1
+        if self.latency > 0:
+            end = time.perf_counter() + self.latency
+            while time.perf_counter() < end:
+                pass
+
+    def i2c_read_i2c_block_data(self, handle, register, count):
+        self.delay()
+        return RegisterMapTransport.i2c_read_i2c_block_data(self, handle, register, count)
+
+    def i2c_read_byte_data(self, handle, register):
+        self.delay()
+        return RegisterMapTransport.i2c_read_byte_data(self, handle, register)
+
+    def i2c_write_i2c_block_data(self, handle, register, data):
+        self.delay()
+        RegisterMapTransport.i2c_write_i2c_block_data(self, handle, register, data)
+
+    def i2c_write_byte_data(self, handle, register, value):
+        self.delay()
+        RegisterMapTransport.i2c_write_byte_data(self, handle, register, value)
+
+    def i2c_zip(self, handle, data):
+        self.delay()
+        return RegisterMapTransport.i2c_zip(self, handle, data)
+
+
+# a transport with a simulated MPU9250 (MPU6050 + AK8963) and BNO055 all following one trajectory
+def sim_transport(trajectory=None, latency=0.0, clock=time.monotonic, bus=1):
+    transport = SimTransport(latency=latency)
+    transport.add_device(bus, 0x68, SimMPU6050(trajectory, clock, who_am_i=0x71))
+    transport.add_device(bus, 0x0C, SimAK8963(trajectory, clock))
+    transport.add_device(bus, 0x28, SimBNO055(trajectory, clock))
+    return transport
+
+
+if __name__ == "__main__":
+    from i2c_transport import benchmark_transport
+    from i2c_batch import MotionReader
+    from imu import IMU
+
+    # the same acquisition code at bus latencies from none to roughly a pigpio daemon round trip
+    for latency in (0.0, 100e-6, 300e-6):
+        transport = sim_transport(RotatingTrajectory(), latency=latency)
+        byte_time, block_time = benchmark_transport(transport, iterations=200)
+
+        handle = transport.i2c_open(1, 0x68, 0)
+        reader = MotionReader()
+        start = time.perf_counter()
+        for i in range(200):
+            reader.read(transport, handle)
+        zip_time = (time.perf_counter() - start) / 200 * 1e6
+
+        imu = IMU(0x68, 0.98, transport)
+        imu.setupMPU6050(None)
+        # what update_accelerometer_offsets measures on a perfect sensor
+        imu.acc_offsets = np.array([0.0, 0.0, 2.0])
+        imu.gyro_offsets = np.zeros(3)
+        start = time.perf_counter()
+        for i in range(200):
+            imu.calculate_angles(None)
+        angle_time = (time.perf_counter() - start) / 200 * 1e6
+
+        print("latency {0:5.0f} us: 6 byte reads {1:8.1f} us, block read {2:8.1f} us, "
+              "mpu+mag zip {3:8.1f} us, calculate_angles {4:8.1f} us".format(latency * 1e6, byte_time, block_time,
+                                                                            zip_time, angle_time))
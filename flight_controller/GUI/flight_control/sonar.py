@@ -0,0 +1,139 @@
+import math
+import time
+
+# Altitude from the LV-MaxSonar-EZ pulse width output.
+# The pigpio edge callback only stores each pulse width and the time of its falling edge in a
+# fixed ring, everything else runs in the consumer: read() takes the median of the last WINDOW
+# pulses, averages the ones close to it, and tilt compensates with the latest attitude.
+# Times are time.monotonic() seconds, the clock of the scheduler SensorState and NavigationEKF,
+# so an altitude from read() can be passed to NavigationEKF.update_altitude as it is.
+
+# pulse width conversion, 147 us per inch
+US_PER_INCH = 147
+INCH = 0.0254
+# the sensor reports 6 inches for anything closer, kept as it is, and 254 inches when nothing
+# is in range
+MAX_RANGE = 254 * INCH
+# pulses kept in the ring, and the most recent ones the median is taken over
+RING_SIZE = 16
+WINDOW = 5
+# pulses further than this from the median, in m, are outliers
+OUTLIER = 0.15
+# beyond this tilt in degrees the beam no longer hits the ground below
+MAX_TILT = 30.0
+# attitude snapshots further than this in seconds from the end of the pulse are not used
+MAX_ATTITUDE_AGE = 0.2
+
+
+class SonarAltitude(object):
+    # pi is a pigpio.pi, or None to feed edges to cbf directly
+    def __init__(self, pi, gpio, rate=20.0, clock=time.monotonic):
+        self.clock = clock
+        self.widths = [0] * RING_SIZE
+        self.times = [0.0] * RING_SIZE
+        # pulses written, the slot of pulse n is n % RING_SIZE
+        self.count = 0
+        self.rising = None
+        # minimum time between two altitudes in seconds
+        self.period = 1.0 / rate
+        # pulse count and time of the last altitude returned
+        self.read_count = 0
+        self.read_time = None
+        # (q, time), replaced as a whole so the callback thread never sees half an update
+        self.attitude = ((1.0, 0.0, 0.0, 0.0), None)
+        self.min_cos = math.cos(math.radians(MAX_TILT))
+        self.rejected_count = 0
+        # the last (time, altitude in m) returned
+        self.latest = None
+        self.callback = None
+        if pi is not None:
+            import pigpio
+            pi.set_mode(gpio, pigpio.INPUT)
+            self.callback = pi.callback(gpio, pigpio.EITHER_EDGE, self.cbf)
+
+    def cbf(self, gpio, level, tick):
+        # rising edge, store the tick
+        if level == 1:
+            self.rising = tick
+        # falling edge, store the width, wrapped to 32 bits in case of tick wraparound
+        elif level == 0 and self.rising is not None:
+            slot = self.count % RING_SIZE
+            self.widths[slot] = (tick - self.rising) & 0xFFFFFFFF
+            self.times[slot] = self.clock()
+            self.count += 1
+
+    # attitude quaternion (w, x, y, z) to compensate with and the time it was measured at,
+    # now if not given
+    def set_attitude(self, q, timestamp=None):
+        self.attitude = (tuple(q), self.clock() if timestamp is None else timestamp)
+
+    # returns (time, altitude in m) when a new pulse arrived and at least 1 / rate has passed
+    # since the last altitude, None otherwise or when the pulses or the tilt give no valid altitude
+    def read(self):
+        count = self.count
+        if count == self.read_count:
+            return None
+        now = self.clock()
+        if self.read_time is not None and now - self.read_time < self.period:
+            return None
+        self.read_count = count
+        self.read_time = now
+
+        n = min(count, WINDOW)
+        slots = [(count - 1 - i) % RING_SIZE for i in range(n)]
+        ranges = sorted(self.widths[slot] / US_PER_INCH * INCH for slot in slots)
+        timestamp = self.times[slots[0]]
+        median = ranges[n // 2] if n % 2 else 0.5 * (ranges[n // 2 - 1] + ranges[n // 2])
+        kept = [r for r in ranges if abs(r - median) <= OUTLIER and r < MAX_RANGE]
+        # the majority has to agree
+        if 2 * len(kept) <= n:
+            self.rejected_count += 1
+            return None
+
+        # range times the cosine of the tilt, the world z component of the body z axis
+        q, q_time = self.attitude
+        c = 1 - 2 * (q[1] * q[1] + q[2] * q[2])
+        # the snapshot may be newer than the pulse
+        stale = q_time is not None and abs(timestamp - q_time) > MAX_ATTITUDE_AGE
+        if c < self.min_cos or stale:
+            self.rejected_count += 1
+            return None
+        self.latest = (timestamp, sum(kept) / len(kept) * c)
+        return self.latest
+
+    def stop(self):
+        if self.callback is not None:
+            self.callback.cancel()
+            self.callback = None
+
+
+if __name__ == "__main__":
+    import random
+    from navigation import NavigationEKF
+
+    # pulses at the sensor's 20 Hz for 10 s on a simulated clock, 2 m below a vehicle tilted
+    # 20 degrees in roll, with one pulse in ten an outlier, read every 10 ms
+    now = [0.0]
+    sonar = SonarAltitude(None, 5, clock=lambda: now[0])
+    ekf = NavigationEKF()
+    roll = math.radians(20)
+    q = (math.cos(roll / 2), math.sin(roll / 2), 0.0, 0.0)
+    rng = random.Random(1)
+    tick = 0
+    altitudes = []
+    for step in range(1000):
+        now[0] = step * 0.01
+        ekf.predict((0.0, 0.0, 1.0), (1.0, 0.0, 0.0, 0.0), 0.01, now[0])
+        if step % 5 == 0:
+            distance = 2.0 / math.cos(roll) + (3.0 if step % 50 == 25 else 0.01 * rng.gauss(0, 1))
+            sonar.cbf(5, 1, tick)
+            tick += int(distance / INCH * US_PER_INCH)
+            sonar.cbf(5, 0, tick)
+        sonar.set_attitude(q)
+        altitude = sonar.read()
+        if altitude is not None:
+            altitudes.append(altitude[1])
+            ekf.update_altitude(altitude[1], timestamp=altitude[0])
+    print("{0} altitudes in 10 s, mean {1:.3f} m, {2} rejected, filter {3:.3f} m, sonar age {4:.3f} s".format(
+        len(altitudes), sum(altitudes) / len(altitudes), sonar.rejected_count, ekf.x[2][0],
+        ekf.state().sonar_age))